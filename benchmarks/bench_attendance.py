@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+attendance decoding benchmark
+
+pure python decode_attendance against the numpy columnar decoder, for
+the 8, 16 and 40 bytes record layouts.
+"""
+import os
+import sys
+import time
+from datetime import datetime
+from struct import pack
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(CWD)
+sys.path.append(ROOT_DIR)
+
+from zk.base import decode_attendance, encode_time
+from zk.columnar import decode_attendance_numpy, numpy
+from zk.user import User, UserTable
+
+if numpy is None:
+    sys.exit("numpy is not installed")
+
+RECORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+users = UserTable(User(uid, str(uid), 0, user_id=str(uid)) for uid in range(1, 5001))
+when = pack('<I', encode_time(datetime(2019, 3, 7, 8, 30, 15)))
+layouts = {
+    8: pack('<HB4sB', 42, 1, when, 0),
+    16: pack('<I4sBB2sI', 42, when, 1, 0, b'', 0),
+    40: pack('<H24sB4sB8s', 42, b'42', 1, when, 0, b''),
+}
+
+for record_size, record in sorted(layouts.items()):
+    data = record * RECORDS
+    start = time.time()
+    columns = decode_attendance_numpy(data, record_size, users)
+    vectorized = time.time() - start
+    start = time.time()
+    records = list(decode_attendance(data, record_size, users))
+    python = time.time() - start
+    assert len(records) == len(columns['uid']) == RECORDS
+    print ('{} bytes x {} records: python {:.2f}s numpy {:.3f}s ({:.0f}x)'.format(
+        record_size, RECORDS, python, vectorized, python / vectorized))
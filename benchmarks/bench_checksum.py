@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+"""
+packet header/checksum micro benchmark
+
+compares the previous tuple walking checksum against the current
+buffer based one, for 8 bytes, 1 KB and 64 KB payloads.
+"""
+import os
+import sys
+import timeit
+from struct import pack, unpack
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(CWD)
+sys.path.append(ROOT_DIR)
+
+from zk import const
+from zk.base import create_header
+
+
+def legacy_create_header(command, command_string, session_id, reply_id):
+    buf = pack('<4H', command, 0, session_id, reply_id) + command_string
+    buf = unpack('8B' + '%sB' % len(command_string), buf)
+    checksum = unpack('H', legacy_create_checksum(buf))[0]
+    reply_id += 1
+    if reply_id >= const.USHRT_MAX:
+        reply_id -= const.USHRT_MAX
+    buf = pack('<4H', command, checksum, session_id, reply_id)
+    return buf + command_string
+
+
+def legacy_create_checksum(p):
+    l = len(p)
+    checksum = 0
+    while l > 1:
+        checksum += unpack('H', pack('BB', p[0], p[1]))[0]
+        p = p[2:]
+        if checksum > const.USHRT_MAX:
+            checksum -= const.USHRT_MAX
+        l -= 2
+    if l:
+        checksum = checksum + p[-1]
+    while checksum > const.USHRT_MAX:
+        checksum -= const.USHRT_MAX
+    checksum = ~checksum
+    while checksum < 0:
+        checksum += const.USHRT_MAX
+    return pack('H', checksum)
+
+
+def bench(label, fn, number):
+    best = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print ('  {:<8} {:>12.2f} us/packet'.format(label, best * 1e6))
+    return best
+
+
+for size, number in [(8, 20000), (1024, 2000), (64 * 1024, 5)]:
+    payload = os.urandom(size)
+    assert legacy_create_header(const.CMD_DATA, payload, 0x1234, 7) == create_header(const.CMD_DATA, payload, 0x1234, 7)
+    print ('payload {} bytes'.format(size))
+    old = bench('legacy', lambda: legacy_create_header(const.CMD_DATA, payload, 0x1234, 7), number)
+    new = bench('current', lambda: create_header(const.CMD_DATA, payload, 0x1234, 7), number * 10)
+    print ('  speedup  {:>12.1f}x'.format(old / new))
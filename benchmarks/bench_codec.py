@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""
+struct codec micro benchmark
+
+format strings parsed on every call (pack/unpack on slices, as the protocol
+code used to do) against the precompiled Structs of zk.codec with
+pack_into/unpack_from, per packet (header, tcp top) and per record (users,
+templates, attendance).
+"""
+import os
+import sys
+import timeit
+from struct import pack, pack_into, unpack
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(CWD)
+sys.path.append(ROOT_DIR)
+
+from zk import codec
+
+NUMBER = 200000
+
+packet = pack('<HHI', 0x5050, 0x7282, 16) + pack('<4H', 1500, 1234, 42, 7) + b'\x00' * 1024
+header = bytearray(8)
+user_28 = pack('<HB5s8sIxBhI', 1, 0, b'123', b'user', 0, 1, 0, 51) * 2
+user_72 = pack('<HB8s24sIx7sx24s', 1, 0, b'123', b'user', 0, b'1', b'51') * 2
+template = pack('<HHbb', 16, 1, 0, 1) + b'\x00' * 10
+attendance_8 = pack('<HB4sB', 1, 0, b'\x00' * 4, 0) * 2
+attendance_16 = pack('<I4sBB2sI', 1, b'\x00' * 4, 0, 0, b'\x00' * 2, 0) * 2
+attendance_40 = pack('<H24sB4sB8s', 1, b'1', 0, b'\x00' * 4, 0, b'') * 2
+
+CASES = [
+    ('header pack',
+        lambda: pack_into('<4H', header, 0, 1500, 1234, 42, 7),
+        lambda: codec.HEADER.pack_into(header, 0, 1500, 1234, 42, 7)),
+    ('header unpack',
+        lambda: unpack('<4H', packet[8:16]),
+        lambda: codec.HEADER.unpack_from(packet, 8)),
+    ('tcp top pack',
+        lambda: pack('<HHI', 0x5050, 0x7282, 1024),
+        lambda: codec.TCP_TOP.pack(0x5050, 0x7282, 1024)),
+    ('tcp top unpack',
+        lambda: unpack('<HHI', packet[:8]),
+        lambda: codec.TCP_TOP.unpack_from(packet)),
+    ('checksum words',
+        lambda: unpack('<%iH' % 512, packet[:1024]),
+        lambda: codec.words(512).unpack_from(packet)),
+    ('user 28',
+        lambda: unpack('<HB5s8sIxBhI', user_28[28:56]),
+        lambda: codec.USER_28.unpack_from(user_28, 28)),
+    ('user 72',
+        lambda: unpack('<HB8s24sIx7sx24s', user_72[72:144]),
+        lambda: codec.USER_72.unpack_from(user_72, 72)),
+    ('template',
+        lambda: unpack('HHbb', template[:6]),
+        lambda: codec.TEMPLATE.unpack_from(template)),
+    ('attendance 8',
+        lambda: unpack('HB4sB', attendance_8[8:16]),
+        lambda: codec.ATTENDANCE_8.unpack_from(attendance_8, 8)),
+    ('attendance 16',
+        lambda: unpack('<I4sBB2sI', attendance_16[16:32]),
+        lambda: codec.ATTENDANCE_16.unpack_from(attendance_16, 16)),
+    ('attendance 40',
+        lambda: unpack('<H24sB4sB8s', attendance_40[40:80]),
+        lambda: codec.ATTENDANCE_40.unpack_from(attendance_40, 40)),
+]
+
+for name, literal, compiled in CASES:
+    assert literal() == compiled()
+    old = min(timeit.repeat(literal, number=NUMBER, repeat=3))
+    new = min(timeit.repeat(compiled, number=NUMBER, repeat=3))
+    print ('{:<15} {:>7.1f}ns -> {:>7.1f}ns ({:.2f}x)'.format(
+        name, old / NUMBER * 1e9, new / NUMBER * 1e9, old / new))
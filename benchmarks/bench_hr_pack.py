@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+"""
+high rate upload packing benchmark
+
+the previous bytes += concatenation of users, table and templates against
+pack_usertemplates (one preallocated buffer), for 2k, 5k and 10k users with
+two 600 bytes templates each.
+"""
+import os
+import sys
+import time
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(CWD)
+sys.path.append(ROOT_DIR)
+
+from zk import codec
+from zk.base import pack_usertemplates, split_usertemplates
+from zk.finger import Finger
+from zk.user import User
+
+
+def legacy_pack(usertemplates, user_packet_size):
+    upack = b""
+    fpack = b""
+    table = b""
+    fnum = 0x10
+    tstart = 0
+    for user, fingers in usertemplates:
+        if user_packet_size == 28:
+            upack += user.repack29()
+        else:
+            upack += user.repack73()
+        for finger in fingers:
+            tfp = finger.repack_only()
+            table += codec.TEMPLATE_ENTRY.pack(2, user.uid, fnum + finger.fid, tstart)
+            tstart += len(tfp)
+            fpack += tfp
+    head = codec.HR_HEAD.pack(len(upack), len(table), len(fpack))
+    return head + upack + table + fpack
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+for count in [2000, 5000, 10000]:
+    usertemplates = [(User(uid, 'user %i' % uid, 0, '123', '1', str(uid)), [Finger(uid, fid, 1, os.urandom(600)) for fid in range(2)]) for uid in range(1, count + 1)]
+    old, packet = timed(legacy_pack, usertemplates, 72)
+    new, buffer = timed(pack_usertemplates, usertemplates, 72)
+    assert bytes(buffer) == packet
+    batched, batches = timed(lambda: [pack_usertemplates(batch, 72, size) for start, batch, size in split_usertemplates(usertemplates, 72)])
+    print ('{:>6} users ({:.1f} MB): bytes += {:.2f}s, preallocated {:.3f}s, in {} batches {:.3f}s'.format(
+        count, len(packet) / 1e6, old, new, len(batches), batched))
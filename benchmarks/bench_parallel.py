@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+parallel attendance decoding benchmark
+
+decode_attendance in process against decode_attendance_parallel (shared
+memory shards), timestamps decoded in both cases, for the 8, 16 and 40
+bytes record layouts.
+"""
+import os
+import sys
+import time
+from datetime import datetime
+from struct import pack
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(CWD)
+sys.path.append(ROOT_DIR)
+
+from zk.base import decode_attendance, encode_time
+from zk.parallel import decode_attendance_parallel
+from zk.user import User, UserTable
+
+RECORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+PROCESSES = int(sys.argv[2]) if len(sys.argv) > 2 else None
+users = UserTable(User(uid, str(uid), 0, user_id=str(uid)) for uid in range(1, 5001))
+when = pack('<I', encode_time(datetime(2019, 3, 7, 8, 30, 15)))
+layouts = {
+    8: pack('<HB4sB', 42, 1, when, 0),
+    16: pack('<I4sBB2sI', 42, when, 1, 0, b'', 0),
+    40: pack('<H24sB4sB8s', 42, b'42', 1, when, 0, b''),
+}
+
+if __name__ == '__main__':
+    for record_size, record in sorted(layouts.items()):
+        data = record * RECORDS
+        start = time.time()
+        records = list(decode_attendance(data, record_size, users))
+        for attendance in records:
+            attendance.timestamp
+        serial = time.time() - start
+        start = time.time()
+        shards = decode_attendance_parallel(data, record_size, users, PROCESSES)
+        parallel = time.time() - start
+        assert len(records) == len(shards) == RECORDS
+        print ('{} bytes x {} records: one process {:.2f}s, pool {:.2f}s ({:.1f}x)'.format(
+            record_size, RECORDS, serial, parallel, serial / parallel))
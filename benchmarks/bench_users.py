@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+"""
+users table decoding benchmark
+
+the previous slicing parser (ljust + userdata[72:] per record, any() rescan
+for the next user_id) against decode_users/next_user_ids, for 10k and 50k
+users in both record layouts.
+"""
+import os
+import sys
+import time
+from struct import pack, unpack
+
+CWD = os.path.dirname(os.path.realpath(__file__))
+ROOT_DIR = os.path.dirname(CWD)
+sys.path.append(ROOT_DIR)
+
+from zk.base import decode_users, next_user_ids
+from zk.user import User
+
+
+def legacy_decode_users(userdata, users, encoding='UTF-8'):
+    result = []
+    total_size = unpack("I", userdata[:4])[0]
+    user_packet_size = total_size / users
+    userdata = userdata[4:]
+    if user_packet_size == 28:
+        while len(userdata) >= 28:
+            uid, privilege, password, name, card, group_id, timezone, user_id = unpack('<HB5s8sIxBhI', userdata.ljust(28, b'\x00')[:28])
+            password = (password.split(b'\x00')[0]).decode(encoding, errors='ignore')
+            name = (name.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+            group_id = str(group_id)
+            user_id = str(user_id)
+            if not name:
+                name = "NN-%s" % user_id
+            result.append(User(uid, name, privilege, password, group_id, user_id, card))
+            userdata = userdata[28:]
+    else:
+        while len(userdata) >= 72:
+            uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', userdata.ljust(72, b'\x00')[:72])
+            password = (password.split(b'\x00')[0]).decode(encoding, errors='ignore')
+            name = (name.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+            group_id = (group_id.split(b'\x00')[0]).decode(encoding, errors='ignore').strip()
+            user_id = (user_id.split(b'\x00')[0]).decode(encoding, errors='ignore')
+            if not name:
+                name = "NN-%s" % user_id
+            result.append(User(uid, name, privilege, password, group_id, user_id, card))
+            userdata = userdata[72:]
+    return result, user_packet_size
+
+
+def legacy_next_user_ids(users):
+    max_uid = 0
+    for user in users:
+        if user.uid > max_uid: max_uid = user.uid
+    max_uid += 1
+    next_uid = max_uid
+    next_user_id = str(max_uid)
+    while True:
+        if any(u for u in users if u.user_id == next_user_id):
+            max_uid += 1
+            next_user_id = str(max_uid)
+        else:
+            break
+    return next_uid, next_user_id
+
+
+def users_table(count, size):
+    if size == 28:
+        records = [pack('<HB5s8sIxBhI', uid, 0, b'123', ('user %i' % uid).encode(), 0, 1, 0, uid + 50) for uid in range(1, count + 1)]
+    else:
+        records = [pack('<HB8s24sIx7sx24s', uid, 0, b'123', ('user %i' % uid).encode(), 0, b'1', str(uid + 50).encode()) for uid in range(1, count + 1)]
+    return pack('<I', count * size) + b''.join(records)
+
+
+def timed(fn, *args):
+    start = time.time()
+    result = fn(*args)
+    return time.time() - start, result
+
+
+for count in [10000, 50000]:
+    for size in [28, 72]:
+        data = users_table(count, size)
+        old, (old_users, _) = timed(legacy_decode_users, data, count)
+        new, (new_users, _) = timed(decode_users, data, count)
+        assert [u.json_pack() for u in old_users] == [u.json_pack() for u in new_users]
+        old_next, old_ids = timed(legacy_next_user_ids, old_users)
+        new_next, new_ids = timed(next_user_ids, new_users)
+        assert old_ids == new_ids
+        print ('{:>6} users x {} bytes: decode {:.3f}s -> {:.3f}s ({:.0f}x), next ids {:.3f}s -> {:.4f}s'.format(
+            count, size, old, new, old / new, old_next, new_next))
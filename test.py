@@ -5,7 +5,16 @@ import sys
 import os
 import unittest
 import codecs
+import copy
 import json
+import pickle
+import tempfile
+import socket as socket_module
+import threading
+import time
+from datetime import datetime
+from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, timeout
+from struct import pack, unpack
 
 if sys.version_info[0] < 3:
     from mock import patch, Mock, MagicMock
@@ -14,13 +23,25 @@ else:
     
 mock_socket = MagicMock(name='zk.socket')
 sys.modules['zk.socket'] = mock_socket
-from zk import ZK, const
-from zk.base import ZK_helper
-from zk.user import User
+from zk import ZK, codec, const
+from zk.cache import OptionsCache
+from zk.pool import ZKPool
+from zk.listener import LiveListener, LiveMultiplexer, Subscription, BLOCK, DROP_NEWEST, DROP_OLDEST, selectors
+from zk.base import ZK_helper, create_checksum, decode_attendance, decode_templates, decode_users, diff_usertemplates, encode_time, iter_aligned, next_user_ids, pack_usertemplates, split_event_packets, split_usertemplates
+from zk.columnar import decode_attendance_columns, numpy
+from zk.parallel import decode_attendance_parallel, decode_templates_parallel, shared_memory
+from zk.user import User, UserTable
 from zk.finger import Finger
 from zk.attendance import Attendance
 from zk.exception import ZKErrorResponse, ZKNetworkError
 
+try:
+    import asyncio
+    from zk.aio import AsyncZK
+    from zk.fleet import ZKFleet
+except (ImportError, SyntaxError):
+    asyncio = None
+
 try:
     unittest.TestCase.assertRaisesRegex
 except AttributeError:
@@ -49,6 +70,187 @@ def dump(obj, nested_level=0, output=sys.stdout):
         print >> output, '%s%s' % (nested_level * spacing, obj)
 
 
+def serve_events(server, events, received):
+    """
+    tcp device acking every command, sending events once registered (the
+    first packet split in two reads, the others together), commands kept
+    in received
+    """
+    conn = server.accept()[0]
+    stream = b''
+    while True:
+        while len(stream) < 8 or len(stream) < 8 + unpack('<HHI', stream[:8])[2]:
+            data = conn.recv(1024)
+            if not data:
+                conn.close()
+                server.close()
+                return
+            stream += data
+        length = unpack('<HHI', stream[:8])[2]
+        command, _checksum, _session_id, reply_id = unpack('<4H', stream[8:16])
+        payload, stream = stream[16:8 + length], stream[8 + length:]
+        received.append((command, payload))
+        if command == const.CMD_ACK_OK:
+            continue # event ACK
+        conn.send(tcp_packet(const.CMD_ACK_OK, reply_id, b'\x00' * 92 if command == const.CMD_GET_FREE_SIZES else b'', 0x1234))
+        if command == const.CMD_REG_EVENT and payload == pack('<I', const.EF_ATTLOG):
+            packets = b''.join(tcp_packet(const.CMD_REG_EVENT, 0, event, 0x1234) for event in events)
+            conn.sendall(packets[:20])
+            time.sleep(0.05)
+            conn.sendall(packets[20:])
+        if command == const.CMD_EXIT:
+            conn.close()
+            server.close()
+            return
+
+
+class CaptureConn(object):
+    """ connected ZK stand in, live_capture yields events then timeouts (None) """
+    verbose = False
+
+    def __init__(self, events):
+        self.events = events
+        self.end_live_capture = False
+
+    def live_capture(self, new_timeout=10):
+        events = list(self.events)
+        while not self.end_live_capture:
+            yield events.pop(0) if events else None
+            if not events:
+                time.sleep(0.01)
+
+def recv_into(sock):
+    """ serve socket.recv_into from the same responses as socket.recv """
+    def _recv_into(buf, nbytes=0):
+        data = sock.recv(nbytes or len(buf))
+        buf[:len(data)] = data
+        return len(data)
+    return _recv_into
+
+def tcp_packet(command, reply_id, payload=b'', session_id=0):
+    """ build a tcp packet as sent by the device (checksum not checked) """
+    return pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, len(payload) + 8) + pack('<4H', command, 0, session_id, reply_id) + payload
+def serve_ack(server, count):
+    """ answer CMD_ACK_OK to count commands, on a listening tcp or a bound udp socket """
+    if server.type == SOCK_STREAM:
+        conn = server.accept()[0]
+        for _ in range(count):
+            reply_id = unpack('<4H', conn.recv(1024)[8:16])[3]
+            conn.send(tcp_packet(const.CMD_ACK_OK, reply_id, session_id=0x1234))
+        conn.close()
+    else:
+        for _ in range(count):
+            data, address = server.recvfrom(1024)
+            server.sendto(tcp_packet(const.CMD_ACK_OK, unpack('<4H', data[:8])[3], session_id=0x1234)[8:], address)
+    server.close()
+
+def serve_session(server, received, wait=None, answered=None, split=False):
+    """
+    answer CMD_ACK_OK (session 0x1234) until CMD_EXIT, on a listening tcp or a
+    bound udp socket, the commands go to received. the connect reply waits
+    for the wait event and sets answered; split sends the tcp one in two parts
+    """
+    tcp = server.type == SOCK_STREAM
+    conn = server.accept()[0] if tcp else server
+    conn.settimeout(5)
+    try:
+        while True:
+            data, address = (conn.recv(1024), None) if tcp else conn.recvfrom(1024)
+            if not data:
+                break
+            command, _checksum, _session_id, reply_id = unpack('<4H', data[8:16] if tcp else data[:8])
+            received.append(command)
+            reply = tcp_packet(const.CMD_ACK_OK, reply_id, session_id=0x1234)
+            if command == const.CMD_CONNECT and wait:
+                wait.wait(5)
+            if not tcp:
+                conn.sendto(reply[8:], address)
+            elif command == const.CMD_CONNECT and split:
+                conn.send(reply[:6])
+                time.sleep(0.1)
+                conn.send(reply[6:])
+            else:
+                conn.send(reply)
+            if command == const.CMD_CONNECT and answered:
+                answered.set()
+            if command == const.CMD_EXIT:
+                break
+    except socket_module.error:
+        pass
+    conn.close()
+    if tcp:
+        server.close()
+
+def serve_upload(server, max_chunk, received, refuse=0):
+    """ tcp device accepting CMD_DATA chunks up to max_chunk bytes into received (the first refuse ones are refused), until CMD_EXIT """
+    conn = server.accept()[0]
+    stream = b''
+    while True:
+        while len(stream) < 8 or len(stream) < 8 + unpack('<HHI', stream[:8])[2]:
+            stream += conn.recv(0x10000)
+        length = unpack('<HHI', stream[:8])[2]
+        command, _checksum, _session_id, reply_id = unpack('<4H', stream[8:16])
+        payload, stream = stream[16:8 + length], stream[8 + length:]
+        response = const.CMD_ACK_OK
+        if command == const.CMD_FREE_DATA:
+            del received[:]
+        elif command == const.CMD_DATA:
+            if len(payload) > max_chunk or refuse > 0:
+                refuse -= 1
+                response = const.CMD_ACK_ERROR
+            else:
+                received.append(payload)
+        conn.send(tcp_packet(response, reply_id, session_id=0x1234))
+        if command == const.CMD_EXIT:
+            break
+    conn.close()
+    server.close()
+
+
+if asyncio:
+    class FakeDevice(asyncio.Protocol):
+        """ tcp device answering each command with the payloads in replies[command], silent if none """
+        def __init__(self, replies):
+            self.replies = replies
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.buf = b''
+
+        def data_received(self, data):
+            self.buf += data
+            while len(self.buf) >= 16:
+                length = unpack('<I', self.buf[4:8])[0]
+                if len(self.buf) < 8 + length:
+                    break
+                command, _, _, reply_id = unpack('<4H', self.buf[8:16])
+                self.buf = self.buf[8 + length:]
+                if not self.replies.get(command):
+                    continue
+                for response, payload in self.replies[command].pop(0):
+                    self.transport.write(tcp_packet(response, reply_id, payload, 0x1234))
+
+    class AckDevice(asyncio.Protocol):
+        """ tcp device acknowledging every command (but the refuse[command]th one), (command, payload) kept in received """
+        def __init__(self, received, refuse=None):
+            self.received = received
+            self.refuse = refuse or {}
+
+        def connection_made(self, transport):
+            self.transport = transport
+            self.buf = b''
+
+        def data_received(self, data):
+            self.buf += data
+            while len(self.buf) >= 16 and len(self.buf) >= 8 + unpack('<I', self.buf[4:8])[0]:
+                length = unpack('<I', self.buf[4:8])[0]
+                command, _, _, reply_id = unpack('<4H', self.buf[8:16])
+                self.received.append((command, self.buf[16:8 + length]))
+                self.buf = self.buf[8 + length:]
+                refused = [c for c, payload in self.received].count(command) == self.refuse.get(command)
+                self.transport.write(tcp_packet(const.CMD_ACK_ERROR if refused else const.CMD_ACK_OK, reply_id, b'', 0x1234))
+
+
 class PYZKTest(unittest.TestCase):
     def setup(self):
 
@@ -243,6 +445,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for free_data TODO: generate proper sequenced response
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for exit      TODO: generate proper sequenced response
         ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
         #begin
         zk = ZK('192.168.1.201') #, verbose=True)
         conn = zk.connect()
@@ -314,6 +517,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for free_data TODO: generate proper sequenced response
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # CMD_ACK_OK for exit      TODO: generate proper sequenced response
         ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
         #begin
         zk = ZK('192.168.1.201') # , verbose=True)
         conn = zk.connect()
@@ -420,6 +624,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('5050827d08000000d007fcf701003200', 'hex'),  # tcp CMD_ACK_OK
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # tcp random CMD_ACK_OK TODO: generate proper sequenced response
         ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
         #begin
         zk = ZK('192.168.1.201') #, verbose=True)
         conn = zk.connect()
@@ -450,6 +655,7 @@ class PYZKTest(unittest.TestCase):
             codecs.decode('5050827d08000000d007fcf701003200', 'hex'),  # tcp CMD_ACK_OK
             codecs.decode('5050827d08000000d00745b2cf451b00', 'hex'),  # tcp random CMD_ACK_OK TODO: generate proper sequenced response
         ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
         #begin
         zk = ZK('192.168.1.201')#, verbose=True)
         conn = zk.connect()
@@ -514,6 +720,800 @@ class PYZKTest(unittest.TestCase):
             self.assertEqual(att.user_id, "1140064", "incorrect user_id %s" % att.user_id)
         conn.disconnect()
 
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_read_with_buffer_window(self, helper, socket):
+        """ pipelined buffer read, replies matched by reply_id """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        data = bytes(bytearray(range(256))) * 300 # 76800 bytes, two chunks
+        first, second = data[:0xFFC0], data[0xFFC0:]
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 1, b'\x00' + pack('<I', len(data)) + b'\x00' * 4), # prepare buffer
+            tcp_packet(const.CMD_PREPARE_DATA, 2, pack('<II', len(first), 0)),
+            tcp_packet(const.CMD_DATA, 2, first[:1000]),
+            tcp_packet(const.CMD_DATA, 2, first[1000:]),
+            tcp_packet(const.CMD_ACK_OK, 2),
+            tcp_packet(const.CMD_DATA, 3, second),
+            tcp_packet(const.CMD_ACK_OK, 4), # free data
+            tcp_packet(const.CMD_ACK_OK, 5), # exit
+        ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
+        #begin
+        zk = ZK('192.168.1.201', read_window=2)
+        conn = zk.connect()
+        sut, size = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        self.assertEqual(size, len(data))
+        self.assertEqual(bytes(sut), data)
+        sent = [unpack('<H6xii', call[0][0][8:]) for call in socket.return_value.send.call_args_list[2:4]]
+        self.assertEqual(sent, [(const._CMD_READ_BUFFER, 0, 0xFFC0), (const._CMD_READ_BUFFER, 0xFFC0, len(second))])
+        self.assertEqual(conn.read_window, 2)
+        conn.disconnect()
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_read_with_buffer_window_refused(self, helper, socket):
+        """ refused pipelined read, the chunks are read again one at a time """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        data = bytes(bytearray(range(256))) * 300 # 76800 bytes, two chunks
+        first, second = data[:0xFFC0], data[0xFFC0:]
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 1, b'\x00' + pack('<I', len(data)) + b'\x00' * 4), # prepare buffer
+            tcp_packet(const.CMD_ACK_ERROR, 2), # window refused
+            timeout('timed out'), # drained
+            tcp_packet(const.CMD_PREPARE_DATA, 4, pack('<II', len(first), 0)), # first chunk, alone
+            tcp_packet(const.CMD_DATA, 4, first[:1000]),
+            tcp_packet(const.CMD_DATA, 4, first[1000:]),
+            tcp_packet(const.CMD_ACK_OK, 4),
+            tcp_packet(const.CMD_DATA, 5, second), # second chunk, alone
+            tcp_packet(const.CMD_ACK_OK, 6), # free data
+            tcp_packet(const.CMD_ACK_OK, 7), # exit
+        ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
+        #begin
+        zk = ZK('192.168.1.201', read_window=2)
+        conn = zk.connect()
+        sut, size = conn.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        self.assertEqual(size, len(data))
+        self.assertEqual(bytes(sut), data)
+        sent = [unpack('<H6xii', call[0][0][8:]) for call in socket.return_value.send.call_args_list[2:6]]
+        self.assertEqual(sent, [(const._CMD_READ_BUFFER, 0, 0xFFC0), (const._CMD_READ_BUFFER, 0xFFC0, len(second))] * 2)
+        self.assertEqual(conn.read_window, 1)
+        conn.disconnect()
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_iter_with_buffer_close(self, helper, socket):
+        """ chunks are yielded as read, free_data even when closed early """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        first = b'\x01' * 0xFFC0
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 1, b'\x00' + pack('<I', 0x20000) + b'\x00' * 4), # prepare buffer
+            tcp_packet(const.CMD_DATA, 2, first),
+            tcp_packet(const.CMD_ACK_OK, 3), # free data
+            tcp_packet(const.CMD_ACK_OK, 4), # exit
+        ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
+        #begin
+        zk = ZK('192.168.1.201')
+        conn = zk.connect()
+        chunks = conn.iter_with_buffer(const.CMD_ATTLOG_RRQ)
+        self.assertEqual(bytes(next(chunks)), first)
+        chunks.close()
+        self.assertEqual(unpack('<H', socket.return_value.send.call_args[0][0][8:10])[0], const.CMD_FREE_DATA)
+        conn.disconnect()
+
+    def test_iter_aligned(self):
+        """ records split between chunks are carried over """
+        data = bytes(bytearray(range(100)))
+        chunks = [data[:7], data[7:9], data[9:40], data[40:41], data[41:]]
+        blocks = list(iter_aligned(chunks, 8))
+        for block in blocks:
+            self.assertEqual(len(block) % 8, 0)
+        self.assertEqual(b''.join(block.tobytes() for block in blocks), data[:96])
+
+    def test_iter_aligned_straddle(self):
+        """ a record straddling two chunks comes back whole, with its bytes """
+        records = [pack('<II', i, i * 3) for i in range(4)]
+        data = b''.join(records)
+        blocks = list(iter_aligned([data[:13], data[13:]], 8)) # record 1 is split 5 + 3
+        self.assertEqual([block.tobytes() for block in blocks], [records[0], records[1], b''.join(records[2:])])
+        self.assertEqual(unpack('<II', blocks[1]), (1, 3))
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_iter_attendance(self, helper, socket):
+        """ 40 bytes records decoded while downloading, one split between chunks """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        zk = ZK('192.168.1.201')
+        records = 1700
+        when = datetime(2019, 3, 7, 8, 30, 15)
+        data = pack('<I', records * 40) + b''.join(
+            pack('<H24sB4sB8s', i, str(i).encode(), 1, pack('<I', encode_time(when)), 0, b'') for i in range(records)
+        )
+        first, second = data[:0xFFC0], data[0xFFC0:]
+        sizes = tcp_packet(const.CMD_ACK_OK, 1, pack('20i', *([0] * 8 + [records] + [0] * 11)))
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            sizes, sizes, # read_sizes, get_users / read_sizes (no users)
+            tcp_packet(const.CMD_ACK_OK, 1, b'\x00' + pack('<I', len(data)) + b'\x00' * 4), # prepare buffer
+            tcp_packet(const.CMD_DATA, 2, first),
+            tcp_packet(const.CMD_DATA, 3, second),
+            tcp_packet(const.CMD_ACK_OK, 4), # free data
+            tcp_packet(const.CMD_ACK_OK, 5), # exit
+        ]
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
+        #begin
+        conn = zk.connect()
+        attendances = list(conn.iter_attendance())
+        self.assertEqual(len(attendances), records)
+        self.assertEqual([a.uid for a in attendances], list(range(records)))
+        split = attendances[0xFFC0 // 40]
+        self.assertEqual(split.user_id, str(0xFFC0 // 40))
+        self.assertEqual(split.timestamp, when)
+        conn.disconnect()
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_get_new_attendance(self, helper, socket):
+        """ only the records past the cursor are read, full read when the log changed """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        zk = ZK('192.168.1.201')
+        when = encode_time(datetime(2019, 3, 7, 8, 30, 15))
+        def log(first, count):
+            return [pack('<H24sB4sB8s', i, str(i).encode(), 1, pack('<I', when), 0, b'') for i in range(first, first + count)]
+        def poll(records):
+            data = pack('<I', len(records) * 40) + b''.join(records)
+            return [
+                tcp_packet(const.CMD_ACK_OK, 1, pack('20i', *([0] * 8 + [len(records)] + [0] * 11))), # sizes
+                tcp_packet(const.CMD_ACK_OK, 1, b'\x00' + pack('<I', len(data)) + b'\x00' * 4), # prepare buffer
+                tcp_packet(const.CMD_DATA, 2, data[:4]), # header
+                tcp_packet(const.CMD_DATA, 3, data[4:164]), # fingerprint
+            ]
+        first, second, rotated = log(0, 10), log(0, 12), log(5, 12)
+        socket.return_value.recv.side_effect = [tcp_packet(const.CMD_ACK_OK, 0)] + \
+            poll(first) + [tcp_packet(const.CMD_DATA, 4, b''.join(first)), tcp_packet(const.CMD_ACK_OK, 5)] + \
+            poll(second) + [tcp_packet(const.CMD_DATA, 4, b''.join(second[10:])), tcp_packet(const.CMD_ACK_OK, 5)] + \
+            poll(rotated) + [tcp_packet(const.CMD_DATA, 4, b''.join(rotated)), tcp_packet(const.CMD_ACK_OK, 5)] + \
+            [tcp_packet(const.CMD_ACK_OK, 6)] # exit
+        socket.return_value.recv_into.side_effect = recv_into(socket.return_value)
+        def last_read():
+            for call in reversed(socket.return_value.send.call_args_list):
+                if unpack('<H', call[0][0][8:10])[0] == const._CMD_READ_BUFFER:
+                    return unpack('<ii', call[0][0][16:24])
+        #begin
+        conn = zk.connect()
+        attendances, cursor = conn.get_new_attendance()
+        self.assertEqual(len(attendances), 10)
+        self.assertEqual(cursor['records'], 10)
+        attendances, cursor = conn.get_new_attendance(cursor)
+        self.assertEqual(last_read(), (4 + 10 * 40, 2 * 40))
+        self.assertEqual([a.uid for a in attendances], [10, 11])
+        self.assertEqual(cursor['records'], 12)
+        attendances, cursor = conn.get_new_attendance(cursor)
+        self.assertEqual(last_read(), (4, 12 * 40))
+        self.assertEqual([a.uid for a in attendances], list(range(5, 17)))
+        conn.disconnect()
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_pool_session(self, helper, socket):
+        """ sessions reused between borrows, reconnected on network errors, only read commands sent again """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 1), # unlock
+            timeout('timed out'), # get_lock_state, session dropped by the device
+            tcp_packet(const.CMD_ACK_OK, 0), # reconnect
+            tcp_packet(const.CMD_ACK_OK, 1), # get_lock_state again
+            timeout('timed out'), # unlock, session dropped again
+            tcp_packet(const.CMD_ACK_OK, 0), # reconnect, unlock not sent again
+            tcp_packet(const.CMD_ACK_OK, 1, pack('I', encode_time(datetime(2019, 3, 7)))), # keepalive
+            tcp_packet(const.CMD_ACK_OK, 2), # exit
+        ]
+        with ZKPool(keepalive=0) as pool:
+            with pool.session('192.168.1.201') as conn:
+                self.assertTrue(conn.unlock())
+            self.assertEqual(len(pool), 1)
+            with pool.session('192.168.1.201') as conn:
+                self.assertTrue(conn.get_lock_state())
+                self.assertRaises(ZKNetworkError, conn.unlock)
+                conn.end_live_capture = True
+                conn.read_window = 4
+                self.assertEqual((conn.conn.end_live_capture, conn.conn.read_window), (True, 4))
+                self.assertEqual(conn.read_window, 4)
+            self.assertEqual(len(pool), 1)
+            pool.ping_idle()
+            self.assertEqual(len(pool), 1)
+        self.assertEqual(len(pool), 0)
+        commands = [unpack('<H', call[0][0][8:10])[0] for call in socket.return_value.send.call_args_list]
+        self.assertEqual(commands, [
+            const.CMD_CONNECT, const.CMD_UNLOCK, const.CMD_DOORSTATE_RRQ, const.CMD_CONNECT,
+            const.CMD_DOORSTATE_RRQ, const.CMD_UNLOCK, const.CMD_CONNECT, const.CMD_GET_TIME, const.CMD_EXIT
+        ])
+
+    @patch('zk.base.ZK_helper')
+    def test_fast_connect_tcp(self, helper):
+        """ fast connect: no ping nor tcp probe, tcp session wins """
+        server = socket_module.socket(AF_INET, SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        thread = threading.Thread(target=serve_ack, args=(server, 2))
+        thread.start()
+        zk = ZK('127.0.0.1', port=server.getsockname()[1], timeout=5, fast_connect=True)
+        conn = zk.connect()
+        self.assertTrue(conn.tcp)
+        self.assertEqual(conn.user_packet_size, 72)
+        conn.disconnect()
+        thread.join()
+        self.assertFalse(helper.return_value.test_ping.called)
+        self.assertFalse(helper.return_value.test_tcp.called)
+
+    @patch('zk.base.ZK_helper')
+    def test_fast_connect_udp(self, helper):
+        """ fast connect: tcp refused, udp session wins """
+        server = socket_module.socket(AF_INET, SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        thread = threading.Thread(target=serve_ack, args=(server, 2))
+        thread.start()
+        zk = ZK('127.0.0.1', port=server.getsockname()[1], timeout=5, fast_connect=True)
+        conn = zk.connect()
+        self.assertFalse(conn.tcp)
+        self.assertEqual(conn.user_packet_size, 28)
+        conn.disconnect()
+        thread.join()
+        self.assertFalse(helper.return_value.test_tcp.called)
+
+    @patch('zk.base.ZK_helper')
+    def test_fast_connect_tcp_short_read(self, helper):
+        """ fast connect: a tcp reply read in two parts still wins """
+        server = socket_module.socket(AF_INET, SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+        thread = threading.Thread(target=serve_session, args=(server, received), kwargs={'split': True})
+        thread.start()
+        conn = ZK('127.0.0.1', port=server.getsockname()[1], timeout=2, fast_connect=True).connect()
+        self.assertTrue(conn.tcp)
+        conn.disconnect()
+        thread.join()
+        self.assertEqual(received, [const.CMD_CONNECT, const.CMD_EXIT])
+
+    @patch('zk.base.ZK_helper')
+    def test_fast_connect_loser_exit(self, helper):
+        """ fast connect: both transports answer, the losing session gets CMD_EXIT """
+        tcp_server = socket_module.socket(AF_INET, SOCK_STREAM)
+        tcp_server.bind(('127.0.0.1', 0))
+        tcp_server.listen(1)
+        port = tcp_server.getsockname()[1]
+        udp_server = socket_module.socket(AF_INET, SOCK_DGRAM)
+        udp_server.bind(('127.0.0.1', port))
+        answered = threading.Event()
+        tcp_received, udp_received = [], []
+        threads = [
+            threading.Thread(target=serve_session, args=(udp_server, udp_received), kwargs={'answered': answered}),
+            threading.Thread(target=serve_session, args=(tcp_server, tcp_received), kwargs={'wait': answered}), # answers once udp did
+        ]
+        for thread in threads:
+            thread.start()
+        conn = ZK('127.0.0.1', port=port, timeout=5, fast_connect=True).connect()
+        conn.disconnect()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(tcp_received, [const.CMD_CONNECT, const.CMD_EXIT])
+        self.assertEqual(udp_received, [const.CMD_CONNECT, const.CMD_EXIT])
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_options_cache(self, helper, socket):
+        """ static options read once, then from the cache saved by another run """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 1, b'~SerialNumber=DGD9190019050335134\x00'),
+            tcp_packet(const.CMD_ACK_OK, 2, b'~Platform=ZMM220_TFT\x00'),
+            tcp_packet(const.CMD_ACK_ERROR, 3), # ~ExtendFmt not supported
+            tcp_packet(const.CMD_ACK_OK, 4), tcp_packet(const.CMD_ACK_OK, 5), # _clear_error
+            tcp_packet(const.CMD_ACK_OK, 6), tcp_packet(const.CMD_ACK_OK, 7),
+            tcp_packet(const.CMD_ACK_OK, 8), # exit
+            tcp_packet(const.CMD_ACK_OK, 0), # connect (second run)
+            tcp_packet(const.CMD_ACK_OK, 1, b'~SerialNumber=DGD9190019050335134\x00'), # once per connection
+            tcp_packet(const.CMD_ACK_OK, 2, b'~Platform=ZMM220_TFT\x00'), # after invalidate
+            tcp_packet(const.CMD_ACK_OK, 3), # exit
+            tcp_packet(const.CMD_ACK_OK, 0), # connect, another device on the same address
+            tcp_packet(const.CMD_ACK_OK, 1, b'~SerialNumber=A8N5230560263\x00'),
+            tcp_packet(const.CMD_ACK_OK, 2, b'~Platform=JZ4725_TFT\x00'),
+            tcp_packet(const.CMD_ACK_OK, 3), # exit
+        ]
+        path = os.path.join(tempfile.mkdtemp(), 'options.json')
+        with OptionsCache(path=path) as cache:
+            conn = ZK('192.168.1.201', options_cache=cache).connect()
+            self.assertEqual(conn.get_platform(), 'ZMM220_TFT')
+            self.assertEqual(conn.get_platform(), 'ZMM220_TFT')
+            self.assertIsNone(conn.get_extend_fmt())
+            self.assertIsNone(conn.get_extend_fmt())
+            conn.disconnect()
+        cache = OptionsCache(path=path)
+        self.assertEqual(len(cache), 2)
+        conn = ZK('192.168.1.201', options_cache=cache).connect()
+        self.assertEqual(conn.get_serialnumber(), 'DGD9190019050335134')
+        self.assertEqual(conn.get_platform(), 'ZMM220_TFT')
+        self.assertIsNone(conn.get_extend_fmt())
+        cache.invalidate('DGD9190019050335134', '~Platform')
+        self.assertEqual(conn.get_platform(), 'ZMM220_TFT')
+        self.assertEqual(conn.get_serialnumber(), 'DGD9190019050335134')
+        conn.disconnect()
+        conn = ZK('192.168.1.201', options_cache=cache).connect()
+        self.assertEqual(conn.get_platform(), 'JZ4725_TFT')
+        conn.disconnect()
+        self.assertEqual(socket.return_value.send.call_count, 17)
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_get_options(self, helper, socket):
+        """ options requested at once, replies matched by reply_id, network errors not cleared """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 2, b'NetMask=255.255.255.0\x00'),
+            tcp_packet(const.CMD_ACK_OK, 1, b'IPAddress=192.168.1.201\x00'),
+            tcp_packet(const.CMD_ACK_ERROR, 3), # GATEIPAddress
+            tcp_packet(const.CMD_ACK_OK, 4), # exit
+        ]
+        conn = ZK('192.168.1.201').connect()
+        self.assertEqual(conn.get_network_params(), {'ip': '192.168.1.201', 'mask': '255.255.255.0', 'gateway': ''})
+        conn.disconnect()
+        sent = [call[0][0] for call in socket.return_value.send.call_args_list]
+        self.assertEqual([packet[16:] for packet in sent[1:4]], [b'IPAddress\x00', b'NetMask\x00', b'GATEIPAddress\x00'])
+        self.assertEqual(len(sent), 5)
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_get_options_fallback(self, helper, socket):
+        """ after a reply that doesn't match, the other keys are read one by one, errors cleared once """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_ERROR, 1), # ~ExtendFmt
+            tcp_packet(const.CMD_ACK_OK, 9, b'FaceFunOn=1\x00'), # not a pending reply
+            timeout(), # drained
+            tcp_packet(const.CMD_ACK_ERROR, 4), # FaceFunOn, one by one
+            tcp_packet(const.CMD_ACK_OK, 5, b'MAC=00:17:61:C8:EC:17\x00'),
+            tcp_packet(const.CMD_ACK_OK, 6), tcp_packet(const.CMD_ACK_OK, 7), # _clear_error
+            tcp_packet(const.CMD_ACK_OK, 8), tcp_packet(const.CMD_ACK_OK, 9),
+            tcp_packet(const.CMD_ACK_OK, 10), # exit
+        ]
+        conn = ZK('192.168.1.201').connect()
+        self.assertEqual(conn.get_options(['~ExtendFmt', 'FaceFunOn', 'MAC']), {'~ExtendFmt': None, 'FaceFunOn': None, 'MAC': '00:17:61:C8:EC:17'})
+        conn.disconnect()
+        sent = [call[0][0] for call in socket.return_value.send.call_args_list]
+        commands = [(unpack('<H', packet[8:10])[0], packet[16:]) for packet in sent[1:-1]]
+        self.assertEqual(commands, [(const.CMD_OPTIONS_RRQ, key) for key in (b'~ExtendFmt\x00', b'FaceFunOn\x00', b'MAC\x00', b'FaceFunOn\x00', b'MAC\x00')] +
+                         [(command, b'~ExtendFmt\x00') for command in (const.CMD_ACK_ERROR, const.CMD_ACK_UNKNOWN, const.CMD_ACK_UNKNOWN, const.CMD_ACK_UNKNOWN)])
+
+    def test_user_table(self):
+        """ indexed lookups, first match wins, indexes follow list changes """
+        users = UserTable([User(1, 'a', 0, user_id='10'), User(2, 'b', 0, user_id='20'), User(3, 'c', 0, user_id='10')])
+        self.assertEqual(users.by_uid(2).name, 'b')
+        self.assertEqual(users.by_user_id('10').uid, 1)
+        self.assertIsNone(users.by_uid(4))
+        users.append(User(4, 'd', 0, user_id='40'))
+        self.assertEqual(users.by_user_id('40').uid, 4)
+        del users[0]
+        self.assertEqual(users.by_user_id('10').uid, 3)
+        self.assertIsNone(users.by_uid(1))
+        self.assertEqual(len(users), 3)
+        self.assertIsInstance(users, list)
+
+    @unittest.skipIf(numpy is None, "numpy required")
+    def test_attendance_columns(self):
+        """ numpy decoder gives the same values as decode_attendance """
+        users = UserTable([User(1, 'a', 0, user_id='100'), User(7, 'b', 0, user_id='7')])
+        times = [encode_time(datetime(2000 + i % 30, i % 12 + 1, i % 28 + 1, i % 24, i % 60, (i * 7) % 60)) for i in range(300)]
+        layouts = {
+            8: b''.join(pack('<HB4sB', i % 9, i % 5, pack('<I', t), i % 3) for i, t in enumerate(times)),
+            16: b''.join(pack('<I4sBB2sI', (100, 7, 1, 55)[i % 4], pack('<I', t), i % 5, i % 3, b'', 0) for i, t in enumerate(times)),
+            40: b''.join(pack('<H24sB4sB8s', i, str(i % 17).encode(), i % 5, pack('<I', t), i % 3, b'') for i, t in enumerate(times)),
+            49: b''.join(pack('<H24sB4sB17s', i, str(i).encode(), 1, pack('<I', t), 0, b'') for i, t in enumerate(times)),
+        }
+        for record_size, data in layouts.items():
+            expected = [(a.uid, a.user_id, a.timestamp, a.status, a.punch) for a in decode_attendance(data, record_size, users)]
+            columns = decode_attendance_columns(memoryview(data), record_size, users)
+            got = list(zip(columns['uid'].tolist(), columns['user_id'].tolist(), columns['timestamp'].astype(object).tolist(),
+                           columns['status'].tolist(), columns['punch'].tolist()))
+            self.assertEqual(got, expected, "record size %i" % record_size)
+
+    def test_codec_layouts(self):
+        """ every registered layout is little endian and round trips at its size """
+        sizes = {
+            'HEADER': 8, 'TCP_TOP': 8, 'COMMAND': 2, 'UINT': 4, 'INT': 4, 'USHORT': 2, 'INT_PAIR': 8,
+            'PREPARE_BUFFER': 11, 'SIZES': 80, 'FACES': 12,
+            'USER_28': 28, 'USER_72': 72, 'USER_WRQ_28': 28, 'USER_WRQ_72': 72, 'USER_29': 29, 'USER_73': 73,
+            'TEMPLATE': 6, 'TEMPLATE_ONLY': 2, 'TEMPLATE_ENTRY': 8, 'HR_HEAD': 12,
+            'ATTENDANCE_8': 8, 'ATTENDANCE_16': 16, 'ATTENDANCE_40': 40,
+        }
+        layouts = [(name, getattr(codec, name)) for name in sorted(sizes)] + [('EVENTS %i' % size, record) for size, record in sorted(codec.EVENTS.items())]
+        for name, record in layouts:
+            expected = sizes.get(name) or int(name.split()[1])
+            self.assertEqual(record.size, expected, name)
+            self.assertIn(record.format[:1], ('<', b'<'), name)
+            values = record.unpack(bytes(bytearray(range(1, expected + 1))))
+            packed = record.pack(*values)
+            self.assertEqual(len(packed), expected, name)
+            self.assertEqual(record.unpack(packed), values, name)
+            buffer = bytearray(expected + 3)
+            record.pack_into(buffer, 3, *values)
+            self.assertEqual(record.unpack_from(buffer, 3), values, name)
+        self.assertEqual(codec.HEADER.pack(1, 2, 3, 4), b'\x01\x00\x02\x00\x03\x00\x04\x00')
+        self.assertEqual(codec.TEMPLATE.pack(0x0102, 3, 4, 1), b'\x02\x01\x03\x00\x04\x01')
+        self.assertEqual(codec.ATTENDANCE_8.unpack(b'\x01\x02\x03abcd\x05'), (0x0201, 3, b'abcd', 5))
+        self.assertEqual(codec.words(3).unpack(b'\x01\x00\x02\x00\x03\x00'), (1, 2, 3))
+
+    def test_decode_users(self):
+        """ 28 and 72 bytes user records, as the loop decoder read them """
+        def reference(userdata, count): # the per record loop decode_users replaced
+            size = unpack('I', userdata[:4])[0] // count
+            userdata = userdata[4:]
+            users = []
+            while len(userdata) >= size:
+                if size == 28:
+                    uid, privilege, password, name, card, group_id, timezone, user_id = unpack('<HB5s8sIxBhI', userdata[:28])
+                    group_id, user_id = str(group_id), str(user_id)
+                else:
+                    uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', userdata[:72])
+                    group_id = group_id.split(b'\x00')[0].decode('UTF-8', 'ignore').strip()
+                    user_id = user_id.split(b'\x00')[0].decode('UTF-8', 'ignore')
+                password = password.split(b'\x00')[0].decode('UTF-8', 'ignore')
+                name = name.split(b'\x00')[0].decode('UTF-8', 'ignore').strip() or "NN-%s" % user_id
+                users.append((uid, name, privilege, password, group_id, user_id, card))
+                userdata = userdata[size:]
+            return users
+        rows = [(1, 0, b'123', b'ana', 1001, 1, 4), (2, 14, b'', b'', 0, 2, 5), (3, 0, b'9', b' bob ', 7, 1, 1)]
+        records = {
+            28: [pack('<HB5s8sIxBhI', uid, privilege, password, name, card, group_id, 0, user_id) for uid, privilege, password, name, card, group_id, user_id in rows],
+            72: [pack('<HB8s24sIx7sx24s', uid, privilege, password, name, card, str(group_id).encode(), str(user_id).encode()) for uid, privilege, password, name, card, group_id, user_id in rows],
+        }
+        for size, packed in records.items():
+            body = b''.join(packed)
+            for userdata in (pack('<I', len(body)) + body, pack('<I', len(body)) + body + packed[0][:size // 2]): # trailing partial record
+                users, user_packet_size = decode_users(bytearray(userdata), len(rows))
+                self.assertEqual(user_packet_size, size)
+                self.assertIsInstance(users, UserTable)
+                got = [(u.uid, u.name, u.privilege, u.password, u.group_id, u.user_id, u.card) for u in users]
+                self.assertEqual(got, reference(userdata, len(rows)), "record size %i" % size)
+                self.assertEqual(got[1][1], 'NN-5')
+                self.assertEqual(got[2][1], 'bob')
+                self.assertEqual(users.by_user_id('4').uid, 1)
+                self.assertEqual(next_user_ids(users), (4, '6')) # user ids 4 and 5 are taken
+        self.assertEqual(next_user_ids([]), (1, '1'))
+        self.assertEqual(next_user_ids([User(5, 'a', 0, user_id='6'), User(2, 'b', 0, user_id='7')]), (6, '8'))
+
+    def test_slotted_models(self):
+        """ no __dict__, derived fields computed on demand, equality kept """
+        template = codecs.decode("0123456789ABCDEF0123", "hex")
+        finger = Finger(26, 1, 1, template)
+        self.assertFalse(hasattr(finger, '__dict__'))
+        self.assertEqual(finger.size, 10)
+        self.assertEqual(finger.mark, b'0123456789abcdef...456789abcdef0123')
+        self.assertEqual(finger, Finger(26, 1, 1, bytes(template)))
+        self.assertNotEqual(finger, Finger(26, 2, 1, template))
+        user = User(1, 'a', 0, user_id='100')
+        self.assertFalse(hasattr(user, '__dict__'))
+        self.assertEqual(User.json_unpack(user.json_pack()).json_pack(), user.json_pack())
+        when = datetime(2019, 3, 7, 8, 30, 15)
+        attendance = Attendance.packed('100', pack('<I', encode_time(when)), 1, 0, 1)
+        self.assertFalse(hasattr(attendance, '__dict__'))
+        self.assertEqual(attendance.timestamp, when)
+        self.assertEqual(Attendance.packed('100', b'\x13\x03\x07\x08\x1e\x0f', 1).timestamp, when)
+
+    def test_decode_templates(self):
+        """ templates are views on the buffer until their bytes are needed """
+        raw = [os.urandom(n) for n in (500, 1243, 17)]
+        body = b''.join(pack('<HHbb', len(t) + 6, uid, 0, 1) + t for uid, t in enumerate(raw))
+        data = bytearray(pack('<i', len(body)) + body + b'\x00' * 10)
+        fingers = decode_templates(data)
+        self.assertEqual([f.size for f in fingers], [500, 1243, 17])
+        self.assertIsInstance(fingers[1]._template, memoryview)
+        self.assertEqual(fingers[1].mark, codecs.encode(raw[1][:8], 'hex') + b'...' + codecs.encode(raw[1][-8:], 'hex'))
+        self.assertIsInstance(fingers[1]._template, memoryview)
+        self.assertEqual(fingers[1].template, raw[1])
+        self.assertIsInstance(fingers[1]._template, bytes)
+        self.assertEqual(fingers[2].repack(), pack('<HHbb', 23, 2, 0, 1) + raw[2])
+        self.assertEqual(fingers[0], Finger(0, 0, 1, raw[0]))
+
+    def test_finger_pickle(self):
+        """ a Finger still holding a view pickles and copies its bytes """
+        raw = os.urandom(300)
+        body = pack('<HHbb', len(raw) + 6, 7, 3, 1) + raw
+        finger = decode_templates(bytearray(pack('<i', len(body)) + body))[0]
+        self.assertIsInstance(finger._template, memoryview)
+        for clone in (pickle.loads(pickle.dumps(finger)), copy.deepcopy(finger), copy.copy(finger)):
+            self.assertIsInstance(clone._template, bytes)
+            self.assertEqual((clone.uid, clone.fid, clone.valid, clone.template), (7, 3, 1, raw))
+            self.assertEqual(clone, finger)
+
+    @unittest.skipIf(shared_memory is None, "no multiprocessing.shared_memory")
+    @patch('zk.parallel.MIN_SHARD', 10)
+    def test_parallel_decode(self):
+        """ shards decoded in processes, same records in the same order """
+        users = UserTable([User(1, 'a', 0, user_id='100'), User(7, 'b', 0, user_id='7')])
+        times = [encode_time(datetime(2000 + i % 30, i % 12 + 1, i % 28 + 1, i % 24, i % 60, 0)) for i in range(203)]
+        layouts = {
+            8: b''.join(pack('<HB4sB', i % 9, i % 5, pack('<I', t), i % 3) for i, t in enumerate(times)),
+            16: b''.join(pack('<I4sBB2sI', (100, 7, 1, 55)[i % 4], pack('<I', t), i % 5, i % 3, b'', 0) for i, t in enumerate(times)),
+            49: b''.join(pack('<H24sB4sB17s', i, str(i).encode(), 1, pack('<I', t), 0, b'') for i, t in enumerate(times)),
+        }
+        for record_size, data in layouts.items():
+            expected = [(a.uid, a.user_id, a.timestamp, a.status, a.punch) for a in decode_attendance(data, record_size, users)]
+            got = [(a.uid, a.user_id, a.timestamp, a.status, a.punch) for a in decode_attendance_parallel(memoryview(data), record_size, users, 3)]
+            self.assertEqual(got, expected, "record size %i" % record_size)
+        table = b''.join(pack('<HHbb', 6 + i % 30, i, i % 10, 1) + bytes(bytearray([i % 256] * (i % 30))) for i in range(101))
+        templatedata = pack('<i', len(table)) + table
+        self.assertEqual(decode_templates_parallel(templatedata, 3), decode_templates(templatedata))
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_sync_usertemplates(self, helper, socket):
+        """ only the differences are sent, one refresh at the end """
+        device_users = UserTable([User(1, 'a', 0, user_id='1'), User(2, 'b', 0, user_id='2'), User(3, 'c', 0, user_id='3')])
+        device_fingers = [Finger(1, 0, 1, b'\x01' * 10), Finger(1, 1, 1, b'\x02' * 10), Finger(2, 0, 1, b'\x03' * 10), Finger(3, 0, 1, b'\x04' * 10)]
+        users = [User(1, 'a', 0, user_id='1'), User(2, 'bb', 0, user_id='2'), User(4, 'd', 0, user_id='4')]
+        fingers = [Finger(1, 0, 1, b'\x01' * 10), Finger(1, 1, 1, b'\x05' * 10), Finger(2, 0, 1, b'\x03' * 10), Finger(4, 3, 1, b'\x06' * 10)]
+        report = diff_usertemplates(device_users, device_fingers, users, fingers)
+        self.assertEqual([u.uid for u in report['users_added']], [4])
+        self.assertEqual([u.uid for u in report['users_changed']], [2])
+        self.assertEqual([u.uid for u in report['users_removed']], [3])
+        self.assertEqual([(f.uid, f.fid) for f in report['templates_added']], [(4, 3)])
+        self.assertEqual([(f.uid, f.fid) for f in report['templates_changed']], [(1, 1)])
+        self.assertEqual([(f.uid, f.fid) for f in report['templates_removed']], [(3, 0)])
+        self.assertRaises(ZKErrorResponse, diff_usertemplates, device_users, device_fingers, users, fingers + [Finger(9, 0, 1, b'')])
+        zk = ZK('192.168.1.201')
+        with patch.object(ZK, 'get_users', return_value=device_users), \
+                patch.object(ZK, 'get_templates', return_value=device_fingers), \
+                patch.object(ZK, 'delete_user_template') as delete_template, \
+                patch.object(ZK, 'delete_user') as delete_user, \
+                patch.object(ZK, 'HR_save_usertemplates') as save, \
+                patch.object(ZK, 'refresh_data') as refresh:
+            zk.sync_usertemplates(users, fingers)
+            delete_template.assert_not_called() # (3, 0) goes with its user
+            delete_user.assert_called_once_with(3, refresh=False)
+            uploaded = save.call_args[0][0]
+            self.assertEqual([(user.uid, [(f.uid, f.fid) for f in fs]) for user, fs in uploaded], [(1, [(1, 1)]), (2, []), (4, [(4, 3)])])
+            self.assertEqual(save.call_args[1], {'refresh': False})
+            self.assertEqual(refresh.call_count, 1)
+            save.reset_mock()
+            refresh.reset_mock()
+            zk.sync_usertemplates(device_users, device_fingers) # nothing changed
+            save.assert_not_called()
+            refresh.assert_not_called()
+            save.side_effect = ZKErrorResponse("Can't save usertemplates (1 of 2 batches failed)")
+            self.assertRaises(ZKErrorResponse, zk.sync_usertemplates, users, fingers) # partial upload isn't a success
+            self.assertEqual(refresh.call_count, 1) # what was saved is still refreshed
+        self.assertEqual((zk.next_uid, zk.next_user_id), (4, '4'))
+
+    @patch('zk.base.socket')
+    @patch('zk.base.ZK_helper')
+    def test_tcp_hr_save_batches(self, helper, socket):
+        """ roster split in packets under batch_size, errors per batch, one refresh, then raise """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        socket.return_value.recv.side_effect = [
+            tcp_packet(const.CMD_ACK_OK, 0), # connect
+            tcp_packet(const.CMD_ACK_OK, 1), # save batch 1
+            tcp_packet(const.CMD_ACK_ERROR, 2), # save batch 2
+            tcp_packet(const.CMD_ACK_OK, 3), # save batch 3
+            tcp_packet(const.CMD_ACK_OK, 4), # refresh
+            tcp_packet(const.CMD_ACK_OK, 5), # exit
+        ]
+        usertemplates = [(User(uid, 'u%i' % uid, 0, '', '1', str(uid)), [Finger(uid, fid, 1, b'\x01' * 100) for fid in range(uid % 3)]) for uid in range(1, 31)]
+        conn = ZK('192.168.1.201').connect()
+        with patch.object(ZK, '_send_with_buffer') as send:
+            with self.assertRaises(ZKErrorResponse) as failed:
+                conn.HR_save_usertemplates(usertemplates, batch_size=2000)
+        conn.disconnect()
+        report = failed.exception.report
+        packets = [call[0][0] for call in send.call_args_list]
+        self.assertEqual(len(packets), 3)
+        self.assertTrue(all(len(packet) <= 2000 for packet in packets))
+        self.assertEqual([batch['error'] for batch in report], [None, "Can't save usertemplates", None])
+        self.assertEqual(sum(batch['users'] for batch in report), 30)
+        self.assertEqual([batch['size'] for batch in report], [len(packet) for packet in packets])
+        start = report[1]['start']
+        self.assertEqual(bytes(packets[1]), bytes(pack_usertemplates(usertemplates[start:start + report[1]['users']], 72)))
+        sent = [call[0][0] for call in socket.return_value.send.call_args_list]
+        self.assertEqual([unpack('<H', packet[8:10])[0] for packet in sent[1:]], [const._CMD_SAVE_USERTEMPS] * 3 + [const.CMD_REFRESHDATA, const.CMD_EXIT])
+
+    @patch('zk.base.ZK_helper')
+    def test_tcp_windowed_upload(self, helper):
+        """ chunk size probed down to what the device accepts, chunks sent in a window """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        server = socket_module.socket(AF_INET, SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+        thread = threading.Thread(target=serve_upload, args=(server, 10000, received))
+        thread.start()
+        buffer = bytes(bytearray(range(256))) * 400
+        conn = ZK('127.0.0.1', port=server.getsockname()[1], timeout=5, write_window=4, write_chunk=None).connect()
+        upload = conn._send_with_buffer(buffer)
+        self.assertEqual(b''.join(received), buffer)
+        self.assertEqual((upload['chunk'], upload['window'], upload['size']), (0xFFC0 // 8, 4, len(buffer)))
+        self.assertEqual(conn.write_chunk, 0xFFC0 // 8)
+        self.assertTrue(conn._send_with_buffer(buffer[:5000])['throughput'] > 0) # no probe this time
+        self.assertEqual(b''.join(received), buffer[:5000])
+        conn.disconnect()
+        thread.join()
+
+    @patch('zk.base.ZK_helper')
+    def test_tcp_windowed_upload_refused(self, helper):
+        """ a refused window is retried one chunk at a time, at the same chunk size """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        server = socket_module.socket(AF_INET, SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+        thread = threading.Thread(target=serve_upload, args=(server, 0x10000, received, 1))
+        thread.start()
+        buffer = bytes(bytearray(range(256))) * 1000
+        conn = ZK('127.0.0.1', port=server.getsockname()[1], timeout=5, write_window=4, write_chunk=None).connect()
+        upload = conn._send_with_buffer(buffer)
+        self.assertEqual(b''.join(received), buffer)
+        self.assertEqual((upload['chunk'], upload['window']), (0xFFC0, 1))
+        self.assertEqual((conn.write_chunk, conn.write_window), (0xFFC0, 1)) # not halved
+        conn.disconnect()
+        thread.join()
+
+    def test_subscription_policies(self):
+        """ full queue: ring buffer drops the oldest, drop_newest the new one """
+        ring, newest = Subscription(2, DROP_OLDEST), Subscription(2, DROP_NEWEST)
+        for event in [1, 2, 3]:
+            ring.put(event)
+            newest.put(event)
+        ring.close()
+        newest.close()
+        self.assertEqual((list(ring), ring.dropped), ([2, 3], 1))
+        self.assertEqual((list(newest), newest.dropped), ([1, 2], 1))
+        self.assertRaises(ValueError, Subscription, 2, 'unknown')
+
+    def test_live_listener(self):
+        """ events to every subscriber and callback, in order; stop unblocks a full queue """
+        conn = CaptureConn(list(range(1, 6)))
+        listener = LiveListener(conn, timeout=0.1)
+        full, everything, ring = listener.subscribe(1, BLOCK), listener.subscribe(10), listener.subscribe(2, DROP_OLDEST)
+        seen = []
+        listener.add_callback(seen.append)
+        listener.add_callback(lambda event: 1 / 0) # ignored
+        with listener:
+            self.assertEqual(full.get(1), 1) # room for 2, then 3 waits
+            while len(seen) < 3:
+                time.sleep(0.01)
+            self.assertTrue(listener.is_alive())
+        self.assertFalse(listener.is_alive())
+        self.assertTrue(conn.end_live_capture)
+        self.assertIsNone(listener.error)
+        self.assertEqual(seen, [1, 2, 3])
+        self.assertEqual(list(full), [2])
+        self.assertEqual(list(everything), [1, 2])
+        self.assertEqual(list(ring), [2, 3])
+        self.assertEqual(listener.received, 3)
+
+    @patch('zk.base.ZK_helper')
+    def test_live_listener_block(self, helper):
+        """ a full BLOCK subscription stalls the listener, the events sent meanwhile are not lost """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        timehex = pack('6B', 19, 3, 7, 8, 30, 15)
+        events = [pack('<IBB6s', 100 + i, 1, 0, timehex) for i in range(30)]
+        server = socket_module.socket(AF_INET, SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen(1)
+        received = []
+        thread = threading.Thread(target=serve_events, args=(server, events, received))
+        thread.start()
+        conn = ZK('127.0.0.1', port=server.getsockname()[1], timeout=5).connect()
+        listener = conn.live_listener(timeout=0.1)
+        events_queue = listener.subscribe(2, BLOCK)
+        listener.start()
+        time.sleep(0.3) # the device sent everything, the listener waits for room
+        self.assertEqual(len(events_queue), 2)
+        got = [events_queue.get(5) for _ in events]
+        listener.stop()
+        conn.disconnect()
+        thread.join()
+        self.assertIsNone(listener.error)
+        self.assertEqual([event.user_id for event in got], [str(100 + i) for i in range(30)])
+        self.assertEqual((events_queue.dropped, listener.received), (0, 30))
+        self.assertEqual([command for command, payload in received].count(const.CMD_ACK_OK), 30)
+
+    def test_split_event_packets(self):
+        """ event packets read together or split are cut by their top, bogus lengths by the next top """
+        timehex = pack('6B', 19, 3, 7, 8, 30, 15)
+        events = [pack('<IBB6s', 100 + i, 1, 0, timehex) for i in range(3)]
+        stream = b''.join(tcp_packet(const.CMD_REG_EVENT, 0, event, 0x1234) for event in events)
+        packets, rest = split_event_packets(stream + stream[:25])
+        self.assertEqual([packet[8:] for packet in packets], events)
+        self.assertEqual(rest, stream[:25])
+        packets, rest = split_event_packets(rest + stream[25:28])
+        self.assertEqual(([packet[8:] for packet in packets], rest), ([events[0]], b''))
+        bogus = [pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, 0x3f8) + packet[8:] for packet in (tcp_packet(const.CMD_REG_EVENT, 0, event) for event in events)]
+        packets, rest = split_event_packets(b''.join(bogus))
+        self.assertEqual(([packet[8:] for packet in packets], rest), (events, b''))
+        self.assertEqual(split_event_packets(bogus[0][:20]), ([], bogus[0][:20])) # not a whole event yet
+
+    @unittest.skipIf(selectors is None, "selectors required")
+    @patch('zk.base.ZK_helper')
+    def test_live_multiplexer(self, helper):
+        """ events of several devices from one loop, tagged and ACKed, devices released at the end """
+        helper.return_value.test_ping.return_value = True # ping simulated
+        helper.return_value.test_tcp.return_value = 0 # helper tcp ok
+        timehex = pack('6B', 19, 3, 7, 8, 30, 15)
+        events = {'door-1': [pack('<IBB6s', 101, 1, 0, timehex)], 'door-2': [pack('<IBB6s', 200 + i, 1, 0, timehex) for i in range(1, 6)]}
+        received, threads, conns, mux = {}, [], [], LiveMultiplexer(timeout=0.1)
+        for name in sorted(events):
+            server = socket_module.socket(AF_INET, SOCK_STREAM)
+            server.bind(('127.0.0.1', 0))
+            server.listen(1)
+            received[name] = []
+            threads.append(threading.Thread(target=serve_events, args=(server, events[name], received[name])))
+            threads[-1].start()
+            conns.append(ZK('127.0.0.1', port=server.getsockname()[1], timeout=5).connect())
+            mux.add(conns[-1], name)
+        self.assertEqual(len(mux), 2)
+        got = []
+        for item in mux.capture():
+            if item is not None:
+                got.append((item[0], item[1].user_id, item[1].timestamp))
+            if len(got) == 6:
+                mux.end_live_capture = True
+        self.assertEqual(len(mux), 0)
+        for conn, thread in zip(conns, threads):
+            conn.disconnect()
+            thread.join()
+        when = datetime(2019, 3, 7, 8, 30, 15)
+        self.assertEqual(sorted(got), [('door-1', '101', when)] + [('door-2', str(200 + i), when) for i in range(1, 6)])
+        for name in sorted(events):
+            commands = [command for command, payload in received[name]]
+            self.assertEqual(commands.count(const.CMD_ACK_OK), len(events[name]))
+            self.assertEqual(received[name][-2], (const.CMD_REG_EVENT, pack('<I', 0)))
+        self.assertEqual(mux.errors, {})
+
+    def test_checksum(self):
+        """ checksum must match the original zkemsdk.c loop """
+        def legacy_checksum(p):
+            l = len(p)
+            checksum = 0
+            while l > 1:
+                checksum += unpack('H', pack('BB', p[0], p[1]))[0]
+                p = p[2:]
+                if checksum > const.USHRT_MAX:
+                    checksum -= const.USHRT_MAX
+                l -= 2
+            if l:
+                checksum = checksum + p[-1]
+            while checksum > const.USHRT_MAX:
+                checksum -= const.USHRT_MAX
+            checksum = ~checksum
+            while checksum < 0:
+                checksum += const.USHRT_MAX
+            return checksum
+        payloads = [b'', b'\x00', b'\xff', b'\xff' * 2, b'\xff' * 9, b'\x01\x00' * 65535, bytes(bytearray(range(256))) * 5 + b'\x7f']
+        for payload in payloads:
+            expected = legacy_checksum(bytearray(payload))
+            self.assertEqual(create_checksum(payload), expected, "bad checksum for %i bytes" % len(payload))
+
     def test_finger_pack(self):
         fing = Finger(26,1,1,codecs.decode("0123456789ABCDEF", "hex"))
         expected = {
@@ -548,6 +1548,115 @@ class PYZKTest(unittest.TestCase):
         packed_str = json.dumps(data)
         sut = Finger.json_unpack(json.loads(packed_str))
         self.assertEqual(sut.uid, data['uid'])
+    @unittest.skipIf(asyncio is None, "asyncio required")
+    def test_async_get_attendance(self):
+        """ AsyncZK over a local fake device, buffer read in chunks """
+        records = 3
+        when = datetime(2019, 3, 7, 8, 30, 15)
+        data = pack('<I', records * 40) + b''.join(
+            pack('<H24sB4sB8s', i, str(i).encode(), 1, pack('<I', encode_time(when)), 0, b'') for i in range(records)
+        )
+        sizes = [(const.CMD_ACK_OK, pack('20i', *([0] * 8 + [records] + [0] * 11)))]
+        replies = {
+            const.CMD_CONNECT: [[(const.CMD_ACK_OK, b'')]],
+            const.CMD_GET_FREE_SIZES: [sizes, sizes],
+            const._CMD_PREPARE_BUFFER: [[(const.CMD_ACK_OK, b'\x00' + pack('<I', len(data)) + b'\x00' * 4)]],
+            const._CMD_READ_BUFFER: [[
+                (const.CMD_PREPARE_DATA, pack('<I', len(data))),
+                (const.CMD_DATA, data[:50]),
+                (const.CMD_DATA, data[50:]),
+                (const.CMD_ACK_OK, b''),
+            ]],
+            const.CMD_FREE_DATA: [[(const.CMD_ACK_OK, b'')]],
+            const.CMD_EXIT: [[(const.CMD_ACK_OK, b'')]],
+        }
+        loop = asyncio.new_event_loop()
+        try:
+            server = loop.run_until_complete(loop.create_server(lambda: FakeDevice(replies), '127.0.0.1', 0))
+            port = server.sockets[0].getsockname()[1]
+            zk = AsyncZK('127.0.0.1', port=port, timeout=5)
+            loop.run_until_complete(zk.connect())
+            attendances = loop.run_until_complete(zk.get_attendance())
+            loop.run_until_complete(zk.disconnect())
+            server.close()
+            loop.run_until_complete(server.wait_closed())
+        finally:
+            loop.close()
+        self.assertEqual([a.uid for a in attendances], list(range(records)))
+        self.assertEqual(attendances[2].user_id, '2')
+        self.assertEqual(attendances[2].timestamp, when)
+
+    @unittest.skipIf(asyncio is None, "asyncio required")
+    def test_fleet_run(self):
+        """ results and errors captured per device, a silent device times out """
+        when = datetime(2019, 3, 7, 8, 30, 15)
+        replies = {
+            const.CMD_CONNECT: [[(const.CMD_ACK_OK, b'')]],
+            const.CMD_GET_TIME: [[(const.CMD_ACK_OK, pack('I', encode_time(when)))]],
+            const.CMD_EXIT: [[(const.CMD_ACK_OK, b'')]],
+        }
+        loop = asyncio.new_event_loop()
+        try:
+            good = loop.run_until_complete(loop.create_server(lambda: FakeDevice(replies), '127.0.0.1', 0))
+            silent = loop.run_until_complete(loop.create_server(lambda: FakeDevice({}), '127.0.0.1', 0))
+            closed = loop.run_until_complete(loop.create_server(asyncio.Protocol, '127.0.0.1', 0))
+            devices = [{'ip': '127.0.0.1', 'port': server.sockets[0].getsockname()[1]} for server in [good, silent, closed]]
+            closed.close()
+            loop.run_until_complete(closed.wait_closed())
+            fleet = ZKFleet(devices, concurrency=2, timeout=0.5)
+            stream, results = fleet.run('get_time'), []
+            while True: # async for, by hand
+                try:
+                    results.append(loop.run_until_complete(stream.__anext__()))
+                except StopAsyncIteration:
+                    break
+            good.close()
+            silent.close()
+        finally:
+            loop.close()
+        self.assertEqual(len(results), 3)
+        results = dict((result.device['port'], result) for result in results)
+        self.assertTrue(results[devices[0]['port']].ok)
+        self.assertEqual(results[devices[0]['port']].result, when)
+        self.assertIsInstance(results[devices[1]['port']].error, ZKNetworkError)
+        self.assertIsInstance(results[devices[2]['port']].error, ZKNetworkError)
+
+    @unittest.skipIf(asyncio is None, "asyncio required")
+    def test_fleet_distribute(self):
+        """ packets built once for all the devices, same bytes saved on each one, a failed batch reported """
+        usertemplates = [(User(uid, 'u%i' % uid, 0, '', '1', str(uid)), [Finger(uid, 0, 1, b'\x01' * 700)]) for uid in range(1, 6)]
+        received = [[], [], []]
+        refuse = [{}, {}, {const._CMD_SAVE_USERTEMPS: 2}] # the last device refuses its second batch
+        loop = asyncio.new_event_loop()
+        try:
+            servers = [loop.run_until_complete(loop.create_server(lambda received=received, refuse=refuse: AckDevice(received, refuse), '127.0.0.1', 0)) for received, refuse in zip(received, refuse)]
+            devices = [{'ip': '127.0.0.1', 'port': server.sockets[0].getsockname()[1]} for server in servers]
+            fleet = ZKFleet(devices, timeout=5)
+            with patch('zk.fleet.pack_usertemplates', side_effect=pack_usertemplates) as packer:
+                stream, results = fleet.distribute(usertemplates, batch_size=2048), []
+                while True: # async for, by hand
+                    try:
+                        results.append(loop.run_until_complete(stream.__anext__()))
+                    except StopAsyncIteration:
+                        break
+            for server in servers:
+                server.close()
+        finally:
+            loop.close()
+        packets = [bytes(pack_usertemplates(batch, 72, size)) for start, batch, size in split_usertemplates(usertemplates, 72, 2048)]
+        self.assertEqual(packer.call_count, len(packets))
+        results = dict((result.device['port'], result) for result in results)
+        reports = [results[device['port']].result for device in devices[:2]]
+        self.assertTrue(all(results[device['port']].ok for device in devices[:2]))
+        self.assertEqual([[(batch['size'], batch['error']) for batch in report] for report in reports], [[(len(packet), None) for packet in packets]] * 2)
+        self.assertEqual(sum(batch['users'] for batch in reports[0]), 5)
+        failed = results[devices[2]['port']]
+        self.assertIsInstance(failed.error, ZKErrorResponse)
+        self.assertEqual([batch['error'] for batch in failed.error.report], [None, "Can't save usertemplates"] + [None] * (len(packets) - 2))
+        for commands in received:
+            self.assertEqual([command for command, payload in commands].count(const._CMD_SAVE_USERTEMPS), len(packets))
+            self.assertEqual([command for command, payload in commands].count(const.CMD_REFRESHDATA), 1)
+            self.assertEqual(b''.join(payload for command, payload in commands if command == const.CMD_DATA), b''.join(packets))
 
 if __name__ == '__main__':
     unittest.main()
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
+import sys
+
 from .base import ZK
+from .cache import OptionsCache
+from .pool import ZKPool
 
 VERSION = (0, 9, 1)
 
-__all__ = ['ZK']
+__all__ = ['ZK', 'OptionsCache', 'ZKPool']
 
+if sys.version_info >= (3, 6):
+    from .aio import AsyncZK
+    from .fleet import ZKFleet
+    __all__ += ['AsyncZK', 'ZKFleet']
@@ -0,0 +1,572 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from struct import pack
+
+from . import codec, const
+from .base import create_header, create_tcp_top, decode_attendance, decode_time, encode_time, decode_events, decode_sizes, decode_templates, decode_users, make_commkey, next_user_ids, pack_user, pack_usertemplates, split_usertemplates
+from .exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
+from .user import User, UserTable
+
+
+class _DatagramProtocol(asyncio.DatagramProtocol):
+    """
+    queue the datagrams sent by the device
+    """
+
+    def __init__(self):
+        self.packets = asyncio.Queue()
+
+    def datagram_received(self, data, addr):
+        self.packets.put_nowait(data)
+
+    def error_received(self, exc):
+        self.packets.put_nowait(exc)
+
+
+class AsyncZK(object):
+    """
+    ZK asyncio class
+
+    same protocol and packets as ZK, but every operation is a coroutine,
+    tcp runs on asyncio streams and udp on a datagram endpoint, so many
+    devices can be driven from a single event loop.
+    """
+    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, verbose=False, encoding='UTF-8'):
+        """
+        Construct a new 'AsyncZK' object.
+
+        :param ip: machine's IP address
+        :param port: machine's port
+        :param timeout: timeout number
+        :param password: passint
+        :param force_udp: use UDP connection
+        :param verbose: showing log while run the commands
+        :param encoding: user encoding
+        """
+        User.encoding = encoding
+        self.__address = (ip, port)
+        self.__timeout = timeout
+        self.__password = password # passint
+        self.__session_id = 0
+        self.__reply_id = const.USHRT_MAX - 1
+        self.__reader = None
+        self.__writer = None
+        self.__transport = None
+        self.__protocol = None
+        self.__header = None
+        self.__response = None
+        self.__data = None
+
+        self.is_connect = False
+        self.is_enabled = True
+        self.force_udp = force_udp
+        self.verbose = verbose
+        self.encoding = encoding
+        self.tcp = not force_udp
+        self.users = 0
+        self.fingers = 0
+        self.records = 0
+        self.next_uid = 1
+        self.next_user_id = '1'
+        self.user_packet_size = 28 # default zk6
+        self.end_live_capture = False
+
+    async def __open(self):
+        try:
+            if self.tcp:
+                self.__reader, self.__writer = await asyncio.wait_for(asyncio.open_connection(*self.__address), self.__timeout)
+            else:
+                loop = asyncio.get_event_loop()
+                self.__transport, self.__protocol = await loop.create_datagram_endpoint(_DatagramProtocol, remote_addr=self.__address)
+        except Exception as e:
+            raise ZKNetworkError(str(e))
+
+    def __close(self):
+        if self.__writer:
+            self.__writer.close()
+            self.__writer = None
+        if self.__transport:
+            self.__transport.close()
+            self.__transport = None
+
+    async def __send(self, buf):
+        if self.tcp:
+            self.__writer.write(create_tcp_top(buf))
+            await self.__writer.drain()
+        else:
+            self.__transport.sendto(buf)
+
+    async def __recv(self, timeout=None):
+        """
+        recieve a packet (header and data, without the tcp top)
+
+        raise asyncio.TimeoutError if nothing arrives within timeout
+        """
+        if timeout is None:
+            timeout = self.__timeout
+        if self.tcp:
+            top = await asyncio.wait_for(self.__reader.readexactly(8), timeout)
+            magic_1, magic_2, length = codec.TCP_TOP.unpack(top)
+            if magic_1 != const.MACHINE_PREPARE_DATA_1 or magic_2 != const.MACHINE_PREPARE_DATA_2:
+                raise ZKNetworkError("TCP packet invalid")
+            return await asyncio.wait_for(self.__reader.readexactly(length), self.__timeout)
+        packet = await asyncio.wait_for(self.__protocol.packets.get(), timeout)
+        if isinstance(packet, Exception):
+            raise packet
+        return packet
+
+    async def __send_command(self, command, command_string=b''):
+        """
+        send command to the terminal
+        """
+        if command not in [const.CMD_CONNECT, const.CMD_AUTH] and not self.is_connect:
+            raise ZKErrorConnection("instance are not connected.")
+        buf = create_header(command, command_string, self.__session_id, self.__reply_id)
+        try:
+            await self.__send(buf)
+            packet = await self.__recv()
+            self.__header = codec.HEADER.unpack_from(packet)
+        except ZKNetworkError:
+            raise
+        except Exception as e:
+            raise ZKNetworkError(str(e) or e.__class__.__name__)
+        self.__response = self.__header[0]
+        self.__reply_id = self.__header[3]
+        self.__data = packet[8:]
+        if self.__response in [const.CMD_ACK_OK, const.CMD_PREPARE_DATA, const.CMD_DATA]:
+            return {
+                'status': True,
+                'code': self.__response
+            }
+        return {
+            'status': False,
+            'code': self.__response
+        }
+
+    async def __ack_ok(self):
+        """
+        event ack ok
+        """
+        buf = create_header(const.CMD_ACK_OK, b'', self.__session_id, const.USHRT_MAX - 1)
+        try:
+            await self.__send(buf)
+        except Exception as e:
+            raise ZKNetworkError(str(e))
+
+    async def connect(self):
+        """
+        connect to the device (no ping, tcp unless force_udp)
+
+        :return: AsyncZK
+        """
+        self.end_live_capture = False
+        await self.__open()
+        if self.tcp:
+            self.user_packet_size = 72 # default zk8
+        self.__session_id = 0
+        self.__reply_id = const.USHRT_MAX - 1
+        cmd_response = await self.__send_command(const.CMD_CONNECT)
+        self.__session_id = self.__header[2]
+        if cmd_response.get('code') == const.CMD_ACK_UNAUTH:
+            if self.verbose: print ("try auth")
+            command_string = make_commkey(self.__password, self.__session_id)
+            cmd_response = await self.__send_command(const.CMD_AUTH, command_string)
+        if cmd_response.get('status'):
+            self.is_connect = True
+            return self
+        self.__close()
+        if cmd_response["code"] == const.CMD_ACK_UNAUTH:
+            raise ZKErrorResponse("Unauthenticated")
+        if self.verbose: print ("connect err response {} ".format(cmd_response["code"]))
+        raise ZKErrorResponse("Invalid response: Can't connect")
+
+    async def disconnect(self):
+        """
+        diconnect from the connected device
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_EXIT)
+        if cmd_response.get('status'):
+            self.is_connect = False
+            self.__close()
+            return True
+        else:
+            raise ZKErrorResponse("can't disconnect")
+
+    def close(self):
+        """
+        drop the connection without telling the device (CMD_EXIT),
+        safe to call from a cancelled task
+        """
+        self.is_connect = False
+        self.__close()
+
+    async def enable_device(self):
+        """
+        re-enable the connected device
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_ENABLEDEVICE)
+        if cmd_response.get('status'):
+            self.is_enabled = True
+            return True
+        else:
+            raise ZKErrorResponse("Can't enable device")
+
+    async def disable_device(self):
+        """
+        disable (lock) device
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_DISABLEDEVICE)
+        if cmd_response.get('status'):
+            self.is_enabled = False
+            return True
+        else:
+            raise ZKErrorResponse("Can't disable device")
+
+    async def free_data(self):
+        """
+        clear buffer
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_FREE_DATA)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("can't free data")
+
+    async def refresh_data(self):
+        cmd_response = await self.__send_command(const.CMD_REFRESHDATA)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("can't refresh data")
+
+    async def read_sizes(self):
+        """
+        read the memory ussage
+        """
+        cmd_response = await self.__send_command(const.CMD_GET_FREE_SIZES)
+        if cmd_response.get('status'):
+            for name, value in decode_sizes(self.__data).items():
+                setattr(self, name, value)
+            return True
+        else:
+            raise ZKErrorResponse("can't read sizes")
+
+    async def get_time(self):
+        """
+        :return: the machine's time
+        """
+        cmd_response = await self.__send_command(const.CMD_GET_TIME)
+        if cmd_response.get('status'):
+            return decode_time(self.__data[:4])
+        else:
+            raise ZKErrorResponse("can't get time")
+
+    async def set_time(self, timestamp):
+        """
+        set Device time (pass datetime object)
+
+        :param timestamp: python datetime object
+        """
+        cmd_response = await self.__send_command(const.CMD_SET_TIME, pack(b'I', encode_time(timestamp)))
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("can't set time")
+
+    async def unlock(self, time=3):
+        """
+        unlock the door
+
+        :param time: define delay in seconds
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_UNLOCK, pack("I", int(time) * 10))
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("Can't open door")
+
+    async def cancel_capture(self):
+        """
+        cancel capturing finger
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_CANCELCAPTURE)
+        return bool(cmd_response.get('status'))
+
+    async def verify_user(self):
+        """
+        start verify finger mode (after capture)
+
+        :return: bool
+        """
+        cmd_response = await self.__send_command(const.CMD_STARTVERIFY)
+        if cmd_response.get('status'):
+            return True
+        else:
+            raise ZKErrorResponse("Cant Verify")
+
+    async def reg_event(self, flags):
+        """
+        reg events
+        """
+        cmd_response = await self.__send_command(const.CMD_REG_EVENT, pack("I", flags))
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("cant' reg events %i" % flags)
+
+    async def set_user(self, uid=None, name='', privilege=0, password='', group_id='', user_id='', card=0):
+        """
+        create or update user by uid, see ZK.set_user
+        """
+        if uid is None:
+            uid = self.next_uid
+            if not user_id:
+                user_id = self.next_user_id
+        if not user_id:
+            user_id = str(uid) #ZK6 needs uid2 == uid
+        if privilege not in [const.USER_DEFAULT, const.USER_ADMIN]:
+            privilege = const.USER_DEFAULT
+        privilege = int(privilege)
+        try:
+            command_string = pack_user(uid, name, privilege, password, group_id, user_id, card, self.user_packet_size, self.encoding)
+        except Exception as e:
+            if self.verbose: print("Error pack: %s" % e)
+            raise ZKErrorResponse("Can't pack user")
+        cmd_response = await self.__send_command(const.CMD_USER_WRQ, command_string)
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("Can't set user")
+        await self.refresh_data()
+        if self.next_uid == uid:
+            self.next_uid += 1 # better recalculate again
+        if self.next_user_id == user_id:
+            self.next_user_id = str(self.next_uid)
+
+    async def _send_with_buffer(self, buffer):
+        """
+        upload buffer to the device: CMD_PREPARE_DATA, then CMD_DATA chunks
+        (memoryview slices of buffer, no copy)
+        """
+        MAX_CHUNK = 1024
+        view = memoryview(buffer)
+        await self.free_data()
+        cmd_response = await self.__send_command(const.CMD_PREPARE_DATA, codec.UINT.pack(len(view)))
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("Can't prepare data")
+        for start in range(0, len(view), MAX_CHUNK):
+            cmd_response = await self.__send_command(const.CMD_DATA, view[start:start + MAX_CHUNK])
+            if not cmd_response.get('status'):
+                raise ZKErrorResponse("Can't send chunk")
+
+    async def HR_save_packets(self, batches, refresh=True):
+        """
+        save high rate packets already built with pack_usertemplates (for
+        this device user_packet_size), one after the other, as
+        ZK.HR_save_usertemplates: a failed batch doesn't stop the next
+        ones, the data is refreshed once at the end (if a batch was saved),
+        then ZKErrorResponse is raised if any batch failed, with the report
+        in its report attribute.
+
+        :param batches: list of (start, users, packet)
+        :param refresh: refresh the device data when done
+        :return: list of dict per batch: start (index of its first user),
+            users, size, throughput (bytes/s) and error (None if saved)
+        """
+        report = []
+        for start, users, packet in batches:
+            error = None
+            throughput = 0
+            begin = time.monotonic()
+            try:
+                await self._send_with_buffer(packet)
+                elapsed = time.monotonic() - begin
+                throughput = len(packet) / elapsed if elapsed else 0
+                cmd_response = await self.__send_command(const._CMD_SAVE_USERTEMPS, pack('<IHH', 12, 0, 8))
+                if not cmd_response.get('status'):
+                    raise ZKErrorResponse("Can't save usertemplates")
+            except ZKErrorResponse as e:
+                error = str(e)
+                if self.verbose: print ("batch {} ({} users) failed: {}".format(start, users, e))
+            report.append({'start': start, 'users': users, 'size': len(packet), 'throughput': throughput, 'error': error})
+        failed = [batch for batch in report if batch['error']]
+        if refresh and len(failed) < len(report):
+            await self.refresh_data()
+        if failed:
+            error = ZKErrorResponse("Can't save usertemplates ({} of {} batches failed)".format(len(failed), len(report)))
+            error.report = report
+            raise error
+        return report
+
+    async def HR_save_usertemplates(self, usertemplates, refresh=True, batch_size=0x10000):
+        """
+        save users and templates in high rate mode, see ZK.HR_save_usertemplates
+
+        :param [user,[fingers]]
+        :return: list of dict per batch (see HR_save_packets)
+        """
+        batches = [(start, len(batch), pack_usertemplates(batch, self.user_packet_size, size)) for start, batch, size in split_usertemplates(usertemplates, self.user_packet_size, batch_size)]
+        return await self.HR_save_packets(batches, refresh)
+
+    async def __recieve_chunk(self, view):
+        """
+        recieve a chunk into view
+
+        :return: bool
+        """
+        if self.__response == const.CMD_DATA:
+            if len(self.__data) > len(view):
+                return False
+            view[:len(self.__data)] = self.__data
+            return True
+        if self.__response != const.CMD_PREPARE_DATA:
+            if self.verbose: print ("invalid response %s" % self.__response)
+            return False
+        start = 0
+        while True:
+            try:
+                packet = await self.__recv()
+            except asyncio.TimeoutError:
+                raise ZKNetworkError("timeout while reading chunk")
+            response = codec.COMMAND.unpack_from(packet)[0]
+            if response == const.CMD_DATA:
+                length = min(len(packet) - 8, len(view) - start)
+                view[start:start + length] = packet[8:8 + length]
+                start += length
+            elif response == const.CMD_ACK_OK:
+                return True
+            else:
+                if self.verbose: print ("broken!")
+                return False
+
+    async def __read_chunk(self, start, view):
+        """
+        read a chunk from buffer
+        """
+        for _retries in range(3):
+            await self.__send_command(const._CMD_READ_BUFFER, codec.INT_PAIR.pack(start, len(view)))
+            if await self.__recieve_chunk(view):
+                return view
+        raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, len(view)))
+
+    async def read_with_buffer(self, command, fct=0, ext=0):
+        """
+        read info with buffered command, see ZK.read_with_buffer
+
+        :return: memoryview with the data, size
+        """
+        if self.tcp:
+            MAX_CHUNK = 0xFFc0
+        else:
+            MAX_CHUNK = 16 * 1024
+        command_string = codec.PREPARE_BUFFER.pack(1, command, fct, ext)
+        cmd_response = await self.__send_command(const._CMD_PREPARE_BUFFER, command_string)
+        if not cmd_response.get('status'):
+            raise ZKErrorResponse("RWB Not supported")
+        if cmd_response['code'] == const.CMD_DATA:
+            return memoryview(self.__data), len(self.__data)
+        size = codec.UINT.unpack_from(self.__data, 1)[0]
+        data = memoryview(bytearray(size))
+        for start in range(0, size, MAX_CHUNK):
+            await self.__read_chunk(start, data[start:start + MAX_CHUNK])
+        await self.free_data()
+        return data, size
+
+    async def get_users(self):
+        """
+        :return: UserTable
+        """
+        await self.read_sizes()
+        if self.users == 0:
+            self.next_uid = 1
+            self.next_user_id = '1'
+            return UserTable()
+        userdata, size = await self.read_with_buffer(const.CMD_USERTEMP_RRQ, const.FCT_USER)
+        if size <= 4:
+            if self.verbose: print("WRN: missing user data")
+            return UserTable()
+        users, self.user_packet_size = decode_users(userdata, self.users, self.encoding)
+        self.next_uid, self.next_user_id = next_user_ids(users)
+        return users
+
+    async def get_templates(self):
+        """
+        :return: list of Finger object
+        """
+        await self.read_sizes()
+        if self.fingers == 0:
+            return []
+        templatedata, size = await self.read_with_buffer(const.CMD_DB_RRQ, const.FCT_FINGERTMP)
+        if size < 4:
+            if self.verbose: print("WRN: no user data")
+            return []
+        return decode_templates(templatedata)
+
+    async def get_attendance(self):
+        """
+        :return: list of Attendance object
+        """
+        await self.read_sizes()
+        if self.records == 0:
+            return []
+        users = await self.get_users()
+        attendance_data, size = await self.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        if size < 4:
+            if self.verbose: print ("WRN: no attendance data")
+            return []
+        total_size = codec.UINT.unpack_from(attendance_data)[0]
+        record_size = total_size // self.records
+        return list(decode_attendance(attendance_data[4:], record_size, users))
+
+    async def live_capture(self, new_timeout=10):
+        """
+        live capture of events, as an async iterator.
+        yields None every new_timeout seconds without events, set
+        end_live_capture to stop.
+        """
+        was_enabled = self.is_enabled
+        users = await self.get_users()
+        await self.cancel_capture()
+        await self.verify_user()
+        if not self.is_enabled:
+            await self.enable_device()
+        if self.verbose: print ("start live_capture")
+        await self.reg_event(const.EF_ATTLOG)
+        self.end_live_capture = False
+        try:
+            while not self.end_live_capture:
+                try:
+                    packet = await self.__recv(new_timeout)
+                except asyncio.TimeoutError:
+                    if self.verbose: print ("time out")
+                    yield None # return to keep watching
+                    continue
+                await self.__ack_ok()
+                header = codec.HEADER.unpack_from(packet)
+                if not header[0] == const.CMD_REG_EVENT:
+                    if self.verbose: print("not event! %x" % header[0])
+                    continue
+                for attendance in decode_events(packet[8:], users):
+                    yield attendance
+        finally:
+            if self.verbose: print ("exit gracefully")
+            await self.reg_event(0)
+            if not was_enabled:
+                await self.disable_device()
+
+    def __str__(self):
+        """
+        for debug
+        """
+        return "AsyncZK %s://%s:%s users[%i]:%i fingers:%i records:%i" % (
+            "tcp" if self.tcp else "udp", self.__address[0], self.__address[1],
+            self.user_packet_size, self.users, self.fingers, self.records
+        )
@@ -1,12 +1,87 @@
 # -*- coding: utf-8 -*-
+from datetime import datetime
+from struct import unpack
+
+from . import codec
+
+
+def decode_time(t):
+    """
+    Decode a timestamp retrieved from the timeclock
+
+    copied from zkemsdk.c - DecodeTime
+    """
+
+    t = codec.UINT.unpack(t)[0]
+    second = t % 60
+    t = t // 60
+
+    minute = t % 60
+    t = t // 60
+
+    hour = t % 24
+    t = t // 24
+
+    day = t % 31 + 1
+    t = t // 31
+
+    month = t % 12 + 1
+    t = t // 12
+
+    year = t + 2000
+
+    d = datetime(year, month, day, hour, minute, second)
+
+    return d
+
+
+def decode_timehex(timehex):
+    """
+    timehex string of six bytes
+    """
+    year, month, day, hour, minute, second = unpack("6B", timehex)
+    year += 2000
+    d = datetime(year, month, day, hour, minute, second)
+    return d
+
+
+
 class Attendance(object):
+    __slots__ = ['uid', 'user_id', 'status', 'punch', '_timestamp', '_packed']
+
     def __init__(self, user_id, timestamp, status, punch=0, uid=0):
         self.uid = uid # not really used any more
         self.user_id = user_id
-        self.timestamp = timestamp
+        self._timestamp = timestamp
+        self._packed = None
         self.status = status
         self.punch = punch
 
+    @classmethod
+    def packed(cls, user_id, packed_time, status, punch=0, uid=0):
+        """
+        attendance with the timestamp as sent by the device, decoded on
+        first access (4 bytes: decode_time, 6 bytes: decode_timehex)
+        """
+        attendance = cls(user_id, None, status, punch, uid)
+        attendance._packed = packed_time
+        return attendance
+
+    @property
+    def timestamp(self):
+        if self._timestamp is None and self._packed is not None:
+            if len(self._packed) == 6:
+                self._timestamp = decode_timehex(self._packed)
+            else:
+                self._timestamp = decode_time(self._packed)
+            self._packed = None
+        return self._timestamp
+
+    @timestamp.setter
+    def timestamp(self, timestamp):
+        self._timestamp = timestamp
+        self._packed = None
+
     def __str__(self):
         return '<Attendance>: {} : {} ({}, {})'.format(self.user_id, self.timestamp, self.status, self.punch)
 
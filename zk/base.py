@@ -1,14 +1,20 @@
 # -*- coding: utf-8 -*-
 import sys
-from datetime import datetime
-from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, socket, timeout
+import errno
+import time
+from collections import deque
+from select import select
+from socket import AF_INET, SOCK_DGRAM, SOCK_STREAM, SOL_SOCKET, SO_ERROR, error as socket_error, socket, timeout
 from struct import pack, unpack
 import codecs
+import hashlib
+from functools import wraps
+from itertools import chain, islice
 
-from . import const
-from .attendance import Attendance
+from . import codec, const
+from .attendance import Attendance, decode_time, decode_timehex
 from .exception import ZKErrorConnection, ZKErrorResponse, ZKNetworkError
-from .user import User
+from .user import User, UserTable
 from .finger import Finger
 
 
@@ -57,6 +63,492 @@ def make_commkey(key, session_id, ticks=50):
     return k
 
 
+# options whose CMD_ACK_ERROR is cleared (see ZK.get_options)
+CLEARED_OPTIONS = ['~ExtendFmt', '~UserExtFmt', 'FaceFunOn', 'CompatOldFirmware']
+
+
+def decode_option(data):
+    """
+    value of a CMD_OPTIONS_RRQ reply (key=value\x00)
+    """
+    return bytes(data).split(b'=', 1)[-1].split(b'\x00')[0].decode()
+
+
+def option_str(value):
+    return value.replace('=', '') if value is not None else None
+
+
+def option_int(value):
+    return (safe_cast(value, int, 0) if value else 0) if value is not None else None
+
+
+def cached_option(name):
+    """
+    read a static option through ZK.options_cache (when set), keyed by
+    the device serial number
+    """
+    def decorator(method):
+        @wraps(method)
+        def getter(self):
+            cache = self.options_cache
+            if cache is None:
+                return method(self)
+            serial = self.get_serialnumber()
+            if (serial, name) in cache:
+                return cache.get(serial, name)
+            value = method(self)
+            cache.set(serial, name, value)
+            return value
+        return getter
+    return decorator
+
+
+def create_header(command, command_string, session_id, reply_id):
+    """
+    Puts a the parts that make up a packet together and packs them into a byte string
+    """
+    buf = bytearray(8 + len(command_string))
+    codec.HEADER.pack_into(buf, 0, command, 0, session_id, reply_id)
+    buf[8:] = command_string
+    checksum = create_checksum(buf)
+    reply_id += 1
+    if reply_id >= const.USHRT_MAX:
+        reply_id -= const.USHRT_MAX
+
+    codec.HEADER.pack_into(buf, 0, command, checksum, session_id, reply_id)
+    return bytes(buf)
+
+
+def create_checksum(p):
+    """
+    Calculates the checksum of the packet to be sent to the time clock
+    Copied from zkemsdk.c
+
+    the little endian words are summed in one pass over the buffer, the
+    total is then folded like the original loop did on every step
+    (subtract USHRT_MAX while bigger) and complemented.
+
+    :param p: bytes, bytearray or memoryview
+    :return: int
+    """
+    l = len(p)
+    checksum = sum(codec.words(l // 2).unpack_from(p))
+    if l % 2:
+        checksum += bytearray(p[-1:])[0]
+    return (const.USHRT_MAX - 1 - checksum) % const.USHRT_MAX
+
+
+def create_tcp_top(packet):
+    """
+    witch the complete packet set top header
+    """
+    length = len(packet)
+    top = codec.TCP_TOP.pack(const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, length)
+    return top + packet
+
+
+def read_tcp_top(packet):
+    """
+    return size! (0 if it is not a tcp packet)
+    """
+    if len(packet)<=8:
+        return 0
+    tcp_header = codec.TCP_TOP.unpack_from(packet)
+    if tcp_header[0] == const.MACHINE_PREPARE_DATA_1 and tcp_header[1] == const.MACHINE_PREPARE_DATA_2:
+        return tcp_header[2]
+    return 0
+
+
+TCP_MAGIC = codec.TCP_TOP.pack(const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, 0)[:4]
+MAX_EVENT_PACKET = 8 + max(codec.EVENTS) # header and the biggest event
+
+
+def split_event_packets(data_recv):
+    """
+    cut the tcp stream of a live capture in packets, by the length of
+    their top. some firmwares send events with a bogus length (bigger than
+    any event): those packets end where the next top starts, or with the
+    data received if it is a whole event.
+
+    :param data_recv: bytes received (rest of the previous call first)
+    :return: list of packets (header and data, without top), the rest
+        of data_recv (an incomplete packet)
+    """
+    packets = []
+    while len(data_recv) >= 16:
+        length = read_tcp_top(data_recv)
+        if not length:
+            start = data_recv.find(TCP_MAGIC, 1) # out of sync, skip to the next top
+            data_recv = data_recv[start:] if start > 0 else b''
+            continue
+        if length <= MAX_EVENT_PACKET:
+            end = 8 + length
+            if len(data_recv) < end:
+                break
+        else:
+            end = data_recv.find(TCP_MAGIC, 16)
+            if end < 0:
+                if len(data_recv) - 16 not in codec.EVENTS:
+                    break
+                end = len(data_recv)
+        packets.append(data_recv[8:end])
+        data_recv = data_recv[end:]
+    return packets, data_recv
+
+
+def encode_time(t):
+    """
+    Encode a timestamp so that it can be read on the timeclock
+    """
+    # formula taken from zkemsdk.c - EncodeTime
+    # can also be found in the technical manual
+    d = (
+        ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
+        (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
+    )
+    return d
+
+
+def iter_aligned(chunks, record_size):
+    """
+    regroup a stream of chunks in blocks of whole records, the part of a
+    record split between two chunks is carried over to the next block.
+    a trailing incomplete record is dropped.
+
+    :param chunks: iterable of bytes or memoryview
+    :param record_size: record size in bytes
+    :return: generator of memoryview (multiple of record_size long)
+    """
+    carry = bytearray()
+    for chunk in chunks:
+        chunk = memoryview(chunk)
+        if carry:
+            need = record_size - len(carry)
+            carry += chunk[:need].tobytes()
+            chunk = chunk[need:]
+            if len(carry) < record_size:
+                continue
+            yield memoryview(carry)
+        end = len(chunk) - len(chunk) % record_size
+        if end:
+            yield chunk[:end]
+        carry = bytearray(chunk[end:])
+
+
+def decode_sizes(data):
+    """
+    decode the memory usage (CMD_GET_FREE_SIZES)
+
+    :return: dict of counters and capacities
+    """
+    sizes = {}
+    if len(data) >= 80:
+        fields = codec.SIZES.unpack_from(data)
+        sizes['users'] = fields[4]
+        sizes['fingers'] = fields[6]
+        sizes['records'] = fields[8]
+        sizes['dummy'] = fields[10] #???
+        sizes['cards'] = fields[12]
+        sizes['fingers_cap'] = fields[14]
+        sizes['users_cap'] = fields[15]
+        sizes['rec_cap'] = fields[16]
+        sizes['fingers_av'] = fields[17]
+        sizes['users_av'] = fields[18]
+        sizes['rec_av'] = fields[19]
+        data = data[80:]
+    if len(data) >= 12: #face info
+        fields = codec.FACES.unpack_from(data) #dirty hack! we need more information
+        sizes['faces'] = fields[0]
+        sizes['faces_cap'] = fields[2]
+    return sizes
+
+
+def iter_records(record, data):
+    """
+    unpack every whole record of data
+
+    :param record: struct.Struct of a record
+    :return: iterator of tuples
+    """
+    view = memoryview(data)
+    view = view[:len(view) - len(view) % record.size]
+    if hasattr(record, 'iter_unpack'):
+        return record.iter_unpack(view)
+    return (record.unpack_from(view, offset) for offset in range(0, len(view), record.size)) # python 2
+
+
+def decode_users(userdata, users, encoding='UTF-8'):
+    """
+    decode the users table
+
+    :param userdata: buffer read with CMD_USERTEMP_RRQ
+    :param users: number of users (see read_sizes)
+    :param encoding: user encoding
+    :return: UserTable, user packet size
+    """
+    total_size = codec.UINT.unpack_from(userdata)[0]
+    user_packet_size = total_size / users
+    if user_packet_size == 28:
+        record = codec.USER_28
+    else:
+        record = codec.USER_72
+    records = list(iter_records(record, memoryview(userdata)[4:]))
+    if not records:
+        return UserTable(), user_packet_size
+    def decode(fields):
+        return [field.split(b'\x00', 1)[0].decode(encoding, 'ignore') for field in fields]
+    if user_packet_size == 28:
+        uids, privileges, passwords, names, cards, group_ids, _timezones, user_ids = zip(*records)
+        group_ids = [str(group_id) for group_id in group_ids]
+        user_ids = [str(user_id) for user_id in user_ids]
+        #TODO: check card value and find in ver8
+    else:
+        uids, privileges, passwords, names, cards, group_ids, user_ids = zip(*records)
+        group_ids = [group_id.strip() for group_id in decode(group_ids)]
+        user_ids = decode(user_ids)
+    passwords = decode(passwords)
+    names = [name.strip() or "NN-%s" % user_id for name, user_id in zip(decode(names), user_ids)]
+    return UserTable(map(User, uids, names, privileges, passwords, group_ids, user_ids, cards)), user_packet_size
+
+
+def next_user_ids(users):
+    """
+    :return: next free uid, next free user_id
+    """
+    next_uid = max([user.uid for user in users] or [0]) + 1
+    user_ids = set(user.user_id for user in users)
+    next_user_id = next_uid
+    while str(next_user_id) in user_ids:
+        next_user_id += 1
+    return next_uid, str(next_user_id)
+
+
+def pack_user(uid, name, privilege, password, group_id, user_id, card, user_packet_size=28, encoding='UTF-8'):
+    """
+    pack a user for CMD_USER_WRQ
+
+    :return: command string
+    """
+    if user_packet_size == 28: #self.firmware == 6:
+        if not group_id:
+            group_id = 0
+        return codec.USER_WRQ_28.pack(uid, privilege, password.encode(encoding, errors='ignore'), name.encode(encoding, errors='ignore'), card, int(group_id), 0, int(user_id))
+    name_pad = name.encode(encoding, errors='ignore').ljust(24, b'\x00')[:24]
+    card_str = codec.UINT.pack(int(card))
+    return codec.USER_WRQ_72.pack(uid, privilege, password.encode(encoding, errors='ignore'), name_pad, card_str, group_id.encode(), user_id.encode())
+
+
+def usertemplates_size(user, fingers, user_packet_size=28):
+    """
+    :return: bytes taken by a user and its templates in a high rate packet
+    """
+    if not isinstance(user, User):
+        raise ZKErrorResponse("Invalid user in usertemplates list")
+    size = 29 if user_packet_size == 28 else 73
+    for finger in fingers:
+        if not isinstance(finger, Finger):
+            raise ZKErrorResponse("Invalid finger template in usertemplates list")
+        size += codec.TEMPLATE_ENTRY.size + 2 + finger.size
+    return size
+
+
+def split_usertemplates(usertemplates, user_packet_size=28, max_size=0x10000):
+    """
+    split usertemplates in batches of at most max_size bytes of high rate
+    packet (a bigger user goes alone), everything is checked first
+
+    :return: list of (first index, usertemplates batch, packet size)
+    """
+    sizes = [usertemplates_size(user, fingers, user_packet_size) for user, fingers in usertemplates]
+    batches = []
+    start, size = 0, codec.HR_HEAD.size
+    for index, entry_size in enumerate(sizes):
+        if index > start and size + entry_size > max_size:
+            batches.append((start, usertemplates[start:index], size))
+            start, size = index, codec.HR_HEAD.size
+        size += entry_size
+    if len(usertemplates) > start:
+        batches.append((start, usertemplates[start:], size))
+    return batches
+
+
+def pack_usertemplates(usertemplates, user_packet_size=28, size=None):
+    """
+    pack users and templates for _CMD_SAVE_USERTEMPS in one preallocated
+    buffer: header, users, templates table and templates
+
+    :param size: packet size, if already known (split_usertemplates)
+    :return: bytearray
+    """
+    users = len(usertemplates)
+    fingers = sum(len(fingers) for user, fingers in usertemplates)
+    user_size = 29 if user_packet_size == 28 else 73
+    if size is None:
+        size = codec.HR_HEAD.size + sum(usertemplates_size(user, fingers, user_packet_size) for user, fingers in usertemplates)
+    packet = bytearray(size)
+    table_size = fingers * codec.TEMPLATE_ENTRY.size
+    codec.HR_HEAD.pack_into(packet, 0, users * user_size, table_size, size - codec.HR_HEAD.size - users * user_size - table_size)
+    user_offset = codec.HR_HEAD.size
+    table_offset = user_offset + users * user_size
+    template_offset = table_offset + table_size
+    tstart = 0
+    for user, fingers in usertemplates:
+        packet[user_offset:user_offset + user_size] = user.repack29() if user_packet_size == 28 else user.repack73()
+        user_offset += user_size
+        for finger in fingers:
+            codec.TEMPLATE_ENTRY.pack_into(packet, table_offset, 2, user.uid, 0x10 + finger.fid, tstart)
+            table_offset += codec.TEMPLATE_ENTRY.size
+            codec.TEMPLATE_ONLY.pack_into(packet, template_offset + tstart, finger.size)
+            packet[template_offset + tstart + 2:template_offset + tstart + 2 + finger.size] = finger.template
+            tstart += 2 + finger.size
+    return packet
+
+
+def decode_templates(templatedata):
+    """
+    decode the fingerprint templates table, walking the buffer by offset
+
+    :param templatedata: buffer read with CMD_DB_RRQ (FCT_FINGERTMP)
+    :return: list of Finger object, templates are memoryview slices of templatedata
+    """
+    view = memoryview(templatedata)
+    total_size = codec.INT.unpack_from(view)[0]
+    return list(iter_templates(view, 4, min(4 + total_size, len(view))))
+
+
+def iter_template_offsets(view, offset, end):
+    """
+    :return: generator of (offset, size) of each whole template in view[offset:end]
+    """
+    unpack_size = codec.TEMPLATE_ONLY.unpack_from
+    while offset + 6 <= end:
+        size = unpack_size(view, offset)[0]
+        if size < 6 or offset + size > end:
+            break # broken template
+        yield offset, size
+        offset += size
+
+
+def iter_templates(view, offset, end):
+    """
+    :return: generator of Finger object for the templates in view[offset:end]
+    """
+    for offset, size in iter_template_offsets(view, offset, end):
+        _size, uid, fid, valid = codec.TEMPLATE.unpack_from(view, offset)
+        yield Finger(uid, fid, valid, view[offset + 6:offset + size])
+
+
+def diff_usertemplates(device_users, device_fingers, users, fingers, user_packet_size=28):
+    """
+    compare the wanted users and templates with the ones of the device,
+    users by uid and packed fields, templates by (uid, fid) and content hash
+
+    :param device_users: list of User object read from the device
+    :param device_fingers: list of Finger object read from the device
+    :param users: list of User object wanted on the device
+    :param fingers: list of Finger object wanted on the device
+    :param user_packet_size: 28 or 72 (how fields are compared)
+    :return: dict of lists: users_added, users_changed, users_removed (User)
+        and templates_added, templates_changed, templates_removed (Finger)
+    """
+    def record(user):
+        return user.repack29() if user_packet_size == 28 else user.repack73()
+
+    def digest(finger):
+        return finger.valid, hashlib.sha1(finger.template).digest()
+
+    wanted = dict((user.uid, user) for user in users)
+    current = dict((user.uid, user) for user in device_users)
+    wanted_fingers = dict(((finger.uid, finger.fid), finger) for finger in fingers)
+    current_fingers = dict(((finger.uid, finger.fid), finger) for finger in device_fingers)
+    for uid, fid in wanted_fingers:
+        if uid not in wanted:
+            raise ZKErrorResponse("Finger template of unknown user uid %s" % uid)
+    return {
+        'users_added': [user for user in users if user.uid not in current],
+        'users_changed': [user for user in users if user.uid in current and record(user) != record(current[user.uid])],
+        'users_removed': [user for user in device_users if user.uid not in wanted],
+        'templates_added': [finger for key, finger in wanted_fingers.items() if key not in current_fingers],
+        'templates_changed': [finger for key, finger in wanted_fingers.items() if key in current_fingers and digest(finger) != digest(current_fingers[key])],
+        'templates_removed': [finger for key, finger in current_fingers.items() if key not in wanted_fingers],
+    }
+
+
+def decode_attendance(attendance_data, record_size, users):
+    """
+    decode attendance records
+
+    :param attendance_data: buffer with the records
+    :param record_size: 8, 16 or 40 bytes (or bigger)
+    :param users: UserTable (or list of User object), to match uid and user_id
+    :return: generator of Attendance object
+    """
+    if not isinstance(users, UserTable):
+        users = UserTable(users or [])
+    if record_size == 8:
+        unpack_record = codec.ATTENDANCE_8.unpack_from
+        for offset in range(0, len(attendance_data) - 7, 8):
+            uid, status, timestamp, punch = unpack_record(attendance_data, offset)
+            tuser = users.by_uid(uid)
+            if not tuser:
+                user_id = str(uid)
+            else:
+                user_id = tuser.user_id
+            yield Attendance.packed(user_id, timestamp, status, punch, uid)
+    elif record_size == 16:
+        unpack_record = codec.ATTENDANCE_16.unpack_from
+        for offset in range(0, len(attendance_data) - 15, 16):
+            user_id, timestamp, status, punch, reserved, workcode = unpack_record(attendance_data, offset)
+            user_id = str(user_id)
+            tuser = users.by_user_id(user_id)
+            if not tuser:
+                uid = str(user_id)
+                tuser = users.by_uid(user_id)
+                if not tuser:
+                    uid = str(user_id)
+                else:
+                    uid = tuser.uid
+                    user_id = tuser.user_id
+            else:
+                uid = tuser.uid
+            yield Attendance.packed(user_id, timestamp, status, punch, uid)
+    else:
+        record_size = max(record_size, 40)
+        unpack_record = codec.ATTENDANCE_40.unpack_from
+        for offset in range(0, len(attendance_data) - 39, record_size):
+            uid, user_id, status, timestamp, punch, space = unpack_record(attendance_data, offset)
+            user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
+            yield Attendance.packed(user_id, timestamp, status, punch, uid)
+
+
+def decode_events(data, users):
+    """
+    decode the attendance events sent with CMD_REG_EVENT (live capture)
+
+    :param data: event data, without header
+    :param users: UserTable (or list of User object), to match user_id and uid
+    :return: generator of Attendance object
+    """
+    if not isinstance(users, UserTable):
+        users = UserTable(users or [])
+    while len(data) >= 10:
+        size = len(data) if len(data) < 52 else 52
+        if size not in codec.EVENTS:
+            break # unknown event size
+        user_id, status, punch, timehex = codec.EVENTS[size].unpack_from(data)
+        data = data[size:]
+        if isinstance(user_id, int):
+            user_id = str(user_id)
+        else:
+            user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
+        tuser = users.by_user_id(user_id)
+        if not tuser:
+            uid = int(user_id)
+        else:
+            uid = tuser.uid
+        yield Attendance.packed(user_id, timehex, status, punch, uid)
+
+
 class ZK_helper(object):
     """
     ZK helper class
@@ -110,7 +602,7 @@ class ZK(object):
     """
     ZK main class
     """
-    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, ommit_ping=False, verbose=False, encoding='UTF-8'):
+    def __init__(self, ip, port=4370, timeout=60, password=0, force_udp=False, ommit_ping=False, verbose=False, encoding='UTF-8', read_window=1, fast_connect=False, options_cache=None, write_window=1, write_chunk=1024):
         """
         Construct a new 'ZK' object.
 
@@ -122,6 +614,11 @@ class ZK(object):
         :param omit_ping: check ip using ping before connect
         :param verbose: showing log while run the commands
         :param encoding: user encoding
+        :param read_window: buffer reads kept in flight (tcp), 1 waits every chunk
+        :param fast_connect: no ping nor tcp probe, race tcp against udp on connect
+        :param options_cache: OptionsCache for the static options (firmware, serial...)
+        :param write_window: buffer upload chunks kept in flight (tcp), 1 waits every chunk
+        :param write_chunk: buffer upload chunk size, None probes the biggest the device accepts (tcp)
         """
         User.encoding = encoding
         self.__address = (ip, port)
@@ -159,6 +656,13 @@ class ZK(object):
         self.next_user_id='1'
         self.user_packet_size = 28 # default zk6
         self.end_live_capture = False
+        self.__live_data = b''
+        self.__serialnumber = None
+        self.read_window = read_window
+        self.write_window = write_window
+        self.write_chunk = write_chunk
+        self.fast_connect = fast_connect
+        self.options_cache = options_cache
 
     def __nonzero__(self):
         """
@@ -175,64 +679,122 @@ class ZK(object):
             self.__sock = socket(AF_INET, SOCK_DGRAM)
             self.__sock.settimeout(self.__timeout)
 
-    def __create_tcp_top(self, packet):
-        """
-        witch the complete packet set top header
-        """
-        length = len(packet)
-        top = pack('<HHI', const.MACHINE_PREPARE_DATA_1, const.MACHINE_PREPARE_DATA_2, length)
-        return top + packet
-
-    def __create_header(self, command, command_string, session_id, reply_id):
-        """
-        Puts a the parts that make up a packet together and packs them into a byte string
-        """
-        buf = pack('<4H', command, 0, session_id, reply_id) + command_string
-        buf = unpack('8B' + '%sB' % len(command_string), buf)
-        checksum = unpack('H', self.__create_checksum(buf))[0]
-        reply_id += 1
-        if reply_id >= const.USHRT_MAX:
-            reply_id -= const.USHRT_MAX
-
-        buf = pack('<4H', command, checksum, session_id, reply_id)
-        return buf + command_string
+    def __race_connect(self):
+        """
+        send CMD_CONNECT on a single socket per transport: tcp first, udp
+        after a short head start (or as soon as tcp fails). the first
+        answer wins and sets tcp and user_packet_size, the other socket is
+        closed (after CMD_EXIT if it answered too, see __exit_loser).
+
+        :return: command response, as __send_command
+        """
+        buf = create_header(const.CMD_CONNECT, b'', self.__session_id, self.__reply_id)
+        deadline = time.time() + self.__timeout if self.__timeout else None
+        tcp = udp = winner = None
+        tcp_sent = False
+        tcp_data = b''
+        if not self.force_udp:
+            tcp = socket(AF_INET, SOCK_STREAM)
+            tcp.setblocking(False)
+            if tcp.connect_ex(self.__address) not in [0, errno.EINPROGRESS, errno.EWOULDBLOCK, 10035]:
+                tcp.close()
+                tcp = None
+        udp_at = time.time() + (0.25 if tcp else 0) # tcp head start
+        try:
+            while winner is None:
+                now = time.time()
+                if deadline and now >= deadline:
+                    raise ZKNetworkError("can't reach device (%s:%s)" % self.__address)
+                if udp is None and now >= udp_at:
+                    if self.verbose: print ("racing udp")
+                    udp = socket(AF_INET, SOCK_DGRAM)
+                    udp.setblocking(False)
+                    udp.sendto(buf, self.__address)
+                readers = [sock for sock in [tcp if tcp_sent else None, udp] if sock]
+                writers = [tcp] if tcp and not tcp_sent else []
+                limits = [limit for limit in [deadline, None if udp else udp_at] if limit]
+                wait = max(min(limits) - now, 0) if limits else None
+                readable, writable, _ = select(readers, writers, [], wait)
+                if writable:
+                    if tcp.getsockopt(SOL_SOCKET, SO_ERROR):
+                        tcp.close()
+                        tcp = None
+                        udp_at = now
+                    else:
+                        tcp.send(create_tcp_top(buf))
+                        tcp_sent = True
+                for sock in readable:
+                    try:
+                        data = sock.recv(1024)
+                    except socket_error:
+                        data = b''
+                    if sock is udp:
+                        packet = data
+                    else:
+                        tcp_data += data
+                        if data and len(tcp_data) < 16 and (len(tcp_data) <= 8 or read_tcp_top(tcp_data)):
+                            continue # short read, wait for the rest of top and header
+                        if not data or not read_tcp_top(tcp_data): # tcp refused or closed
+                            tcp.close()
+                            tcp = None
+                            udp_at = now
+                            continue
+                        packet = tcp_data[8:]
+                    if len(packet) >= 8:
+                        winner = sock
+                        break
+        finally:
+            for sock in [tcp, udp]:
+                if sock and sock is not winner:
+                    if winner is not None and (sock is udp or tcp_sent):
+                        self.__exit_loser(sock, sock is tcp, tcp_data if sock is tcp else b'')
+                    sock.close()
+        if self.verbose: print ("%s won the connect race" % ("tcp" if winner is tcp else "udp"))
+        winner.settimeout(self.__timeout)
+        self.__sock = winner
+        self.tcp = winner is tcp
+        if self.tcp:
+            self.user_packet_size = 72 # default zk8
+        self.__header = codec.HEADER.unpack_from(packet)
+        self.__data_recv = packet
+        self.__response = self.__header[0]
+        self.__reply_id = self.__header[3]
+        self.__data = packet[8:]
+        return {
+            'status': self.__response == const.CMD_ACK_OK,
+            'code': self.__response
+        }
 
-    def __create_checksum(self, p):
+    def __exit_loser(self, sock, tcp, data_recv, wait=0.1):
         """
-        Calculates the checksum of the packet to be sent to the time clock
-        Copied from zkemsdk.c
-        """
-        l = len(p)
-        checksum = 0
-        while l > 1:
-            checksum += unpack('H', pack('BB', p[0], p[1]))[0]
-            p = p[2:]
-            if checksum > const.USHRT_MAX:
-                checksum -= const.USHRT_MAX
-            l -= 2
-        if l:
-            checksum = checksum + p[-1]
-
-        while checksum > const.USHRT_MAX:
-            checksum -= const.USHRT_MAX
-
-        checksum = ~checksum
-
-        while checksum < 0:
-            checksum += const.USHRT_MAX
-
-        return pack('H', checksum)
+        end the session the losing socket of __race_connect may have opened
+        (devices allow a few sessions only): wait up to wait seconds for its
+        CMD_CONNECT reply, then send CMD_EXIT with its session id
 
-    def __test_tcp_top(self, packet):
+        :param data_recv: what was already read from sock
         """
-        return size!
-        """
-        if len(packet)<=8:
-            return 0
-        tcp_header = unpack('<HHI', packet[:8])
-        if tcp_header[0] == const.MACHINE_PREPARE_DATA_1 and tcp_header[1] == const.MACHINE_PREPARE_DATA_2:
-            return tcp_header[2]
-        return 0
+        deadline = time.time() + wait
+        try:
+            while True:
+                packet = data_recv[8:] if tcp else data_recv
+                if len(packet) >= 8 and (not tcp or read_tcp_top(data_recv)):
+                    break
+                remaining = deadline - time.time()
+                if remaining <= 0 or not select([sock], [], [], remaining)[0]:
+                    return
+                data = sock.recv(1024)
+                if not data:
+                    return
+                data_recv = data_recv + data if tcp else data
+            session_id, reply_id = codec.HEADER.unpack_from(packet)[2:]
+            buf = create_header(const.CMD_EXIT, b'', session_id, reply_id)
+            if tcp:
+                sock.send(create_tcp_top(buf))
+            else:
+                sock.sendto(buf, self.__address)
+            if self.verbose: print ("sent CMD_EXIT to the %s session %s" % ("tcp" if tcp else "udp", session_id))
+        except socket_error:
+            pass
 
     def __send_command(self, command, command_string=b'', response_size=8):
         """
@@ -241,21 +803,21 @@ class ZK(object):
         if command not in [const.CMD_CONNECT, const.CMD_AUTH] and not self.is_connect:
             raise ZKErrorConnection("instance are not connected.")
 
-        buf = self.__create_header(command, command_string, self.__session_id, self.__reply_id)
+        buf = create_header(command, command_string, self.__session_id, self.__reply_id)
         try:
             if self.tcp:
-                top = self.__create_tcp_top(buf)
+                top = create_tcp_top(buf)
                 self.__sock.send(top)
                 self.__tcp_data_recv = self.__sock.recv(response_size + 8)
-                self.__tcp_length = self.__test_tcp_top(self.__tcp_data_recv)
+                self.__tcp_length = read_tcp_top(self.__tcp_data_recv)
                 if self.__tcp_length == 0:
                     raise ZKNetworkError("TCP packet invalid")
-                self.__header = unpack('<4H', self.__tcp_data_recv[8:16])
+                self.__header = codec.HEADER.unpack_from(self.__tcp_data_recv, 8)
                 self.__data_recv = self.__tcp_data_recv[8:]
             else:
                 self.__sock.sendto(buf, self.__address)
                 self.__data_recv = self.__sock.recv(response_size)
-                self.__header = unpack('<4H', self.__data_recv[:8])
+                self.__header = codec.HEADER.unpack(self.__data_recv[:8])
         except Exception as e:
             raise ZKNetworkError(str(e))
 
@@ -276,10 +838,10 @@ class ZK(object):
         """
         event ack ok
         """
-        buf = self.__create_header(const.CMD_ACK_OK, b'', self.__session_id, const.USHRT_MAX - 1)
+        buf = create_header(const.CMD_ACK_OK, b'', self.__session_id, const.USHRT_MAX - 1)
         try:
             if self.tcp:
-                top = self.__create_tcp_top(buf)
+                top = create_tcp_top(buf)
                 self.__sock.send(top)
             else:
                 self.__sock.sendto(buf, self.__address)
@@ -295,7 +857,7 @@ class ZK(object):
         """
         response = self.__response
         if response == const.CMD_PREPARE_DATA:
-            size = unpack('I', self.__data[:4])[0]
+            size = codec.UINT.unpack_from(self.__data)[0]
             return size
         else:
             return 0
@@ -306,56 +868,6 @@ class ZK(object):
             data += hex[i * 2:(i * 2) + 2]
         return data
 
-    def __decode_time(self, t):
-        """
-        Decode a timestamp retrieved from the timeclock
-
-        copied from zkemsdk.c - DecodeTime
-        """
-
-        t = unpack("<I", t)[0]
-        second = t % 60
-        t = t // 60
-
-        minute = t % 60
-        t = t // 60
-
-        hour = t % 24
-        t = t // 24
-
-        day = t % 31 + 1
-        t = t // 31
-
-        month = t % 12 + 1
-        t = t // 12
-
-        year = t + 2000
-
-        d = datetime(year, month, day, hour, minute, second)
-
-        return d
-
-    def __decode_timehex(self, timehex):
-        """
-        timehex string of six bytes
-        """
-        year, month, day, hour, minute, second = unpack("6B", timehex)
-        year += 2000
-        d = datetime(year, month, day, hour, minute, second)
-        return d
-
-    def __encode_time(self, t):
-        """
-        Encode a timestamp so that it can be read on the timeclock
-        """
-        # formula taken from zkemsdk.c - EncodeTime
-        # can also be found in the technical manual
-        d = (
-            ((t.year % 100) * 12 * 31 + ((t.month - 1) * 31) + t.day - 1) *
-            (24 * 60 * 60) + (t.hour * 60 + t.minute) * 60 + t.second
-        )
-        return d
-
     def connect(self):
         """
         connect to the device
@@ -363,14 +875,18 @@ class ZK(object):
         :return: bool
         """
         self.end_live_capture = False
-        if not self.ommit_ping and not self.helper.test_ping():
-            raise ZKNetworkError("can't reach device (ping %s)" % self.__address[0])
-        if not self.force_udp and self.helper.test_tcp() == 0:
-            self.user_packet_size = 72 # default zk8
-        self.__create_socket()
+        self.__serialnumber = None
         self.__session_id = 0
         self.__reply_id = const.USHRT_MAX - 1
-        cmd_response = self.__send_command(const.CMD_CONNECT)
+        if self.fast_connect:
+            cmd_response = self.__race_connect()
+        else:
+            if not self.ommit_ping and not self.helper.test_ping():
+                raise ZKNetworkError("can't reach device (ping %s)" % self.__address[0])
+            if not self.force_udp and self.helper.test_tcp() == 0:
+                self.user_packet_size = 72 # default zk8
+            self.__create_socket()
+            cmd_response = self.__send_command(const.CMD_CONNECT)
         self.__session_id = self.__header[2]
         if cmd_response.get('code') == const.CMD_ACK_UNAUTH:
             if self.verbose: print ("try auth")
@@ -400,6 +916,15 @@ class ZK(object):
         else:
             raise ZKErrorResponse("can't disconnect")
 
+    def close(self):
+        """
+        drop the connection without telling the device (CMD_EXIT),
+        ie: after a network error
+        """
+        self.is_connect = False
+        if self.__sock:
+            self.__sock.close()
+
     def enable_device(self):
         """
         re-enable the connected device and allow user activity in device again
@@ -426,6 +951,7 @@ class ZK(object):
         else:
             raise ZKErrorResponse("Can't disable device")
 
+    @cached_option('firmware_version')
     def get_firmware_version(self):
         """
         :return: the firmware version
@@ -437,51 +963,132 @@ class ZK(object):
         else:
             raise ZKErrorResponse("Can't read frimware version")
 
+    def get_options(self, keys, cached=False):
+        """
+        read several options (CMD_OPTIONS_RRQ) at once, on tcp all the
+        requests are sent before reading the replies, matched by reply_id.
+        the keys not answered that way are read one by one. if keys of
+        CLEARED_OPTIONS are not supported (CMD_ACK_ERROR), the error is
+        cleared once for the batch, with the request of the first one.
+
+        :param keys: option names, ie: ['~SerialNumber', 'MAC']
+        :param cached: read through options_cache (static options only)
+        :return: dict of key: value (str), None if not supported
+        """
+        keys = list(keys)
+        values = {}
+        cache = self.options_cache if cached else None
+        if cache is not None:
+            serial = self.get_serialnumber()
+            for key in keys:
+                if (serial, key) in cache:
+                    values[key] = cache.get(serial, key)
+        missing = [key for key in keys if key not in values]
+        if self.tcp and len(missing) > 1:
+            fetched = self.__read_options_pipelined(missing)
+        else:
+            fetched = {}
+        for key in missing:
+            if key not in fetched:
+                cmd_response = self.__send_command(const.CMD_OPTIONS_RRQ, key.encode() + b'\x00', 1024)
+                fetched[key] = decode_option(self.__data) if cmd_response.get('status') else None
+        failed = [key for key in missing if fetched[key] is None and key in CLEARED_OPTIONS]
+        if failed:
+            self._clear_error(failed[0].encode() + b'\x00')
+        if cache is not None:
+            for key, value in fetched.items():
+                cache.set(serial, key, value)
+        values.update(fetched)
+        return values
+
+    def __read_options_pipelined(self, keys):
+        """
+        send every CMD_OPTIONS_RRQ, then collect the replies (tcp)
+
+        :return: dict of the options read, the missing ones must be read again
+        """
+        values = {}
+        pending = {}
+        reply_id = self.__reply_id
+        try:
+            for key in keys:
+                reply_id = self.__send_pipelined(const.CMD_OPTIONS_RRQ, key.encode() + b'\x00', reply_id)
+                pending[reply_id] = key
+            data_recv = b''
+            while pending:
+                data_recv = self.__recieve_at_least(data_recv, 16)
+                tcp_length = read_tcp_top(data_recv)
+                if not tcp_length:
+                    break
+                data_recv = self.__recieve_at_least(data_recv, tcp_length + 8)
+                response, _checksum, _session_id, reply = codec.HEADER.unpack_from(data_recv, 8)
+                if reply not in pending:
+                    if self.verbose: print ("unexpected reply {}".format(reply))
+                    break
+                key = pending.pop(reply)
+                values[key] = decode_option(data_recv[16:tcp_length + 8]) if response == const.CMD_ACK_OK else None
+                data_recv = data_recv[tcp_length + 8:]
+        except timeout:
+            pass
+        finally:
+            if pending:
+                if self.verbose: print ("pipelined options failed, {} left".format(len(pending)))
+                self.__drain()
+            self.__reply_id = reply_id
+        return values
+
+    def get_device_info(self):
+        """
+        read every static option in a single exchange (through options_cache)
+
+        :return: dict, None for the options not supported
+        """
+        options = self.get_options([
+            '~Platform', 'MAC', '~DeviceName', 'ZKFaceVersion', '~ZKFPVersion',
+            '~ExtendFmt', '~UserExtFmt', 'FaceFunOn', 'CompatOldFirmware'
+        ], cached=True)
+        return {
+            'serialnumber': self.get_serialnumber(),
+            'platform': option_str(options['~Platform']),
+            'mac': options['MAC'],
+            'device_name': options['~DeviceName'],
+            'face_version': option_int(options['ZKFaceVersion']),
+            'fp_version': option_int(option_str(options['~ZKFPVersion'])),
+            'extend_fmt': option_int(options['~ExtendFmt']),
+            'user_extend_fmt': option_int(options['~UserExtFmt']),
+            'face_fun_on': option_int(options['FaceFunOn']),
+            'compat_old_firmware': option_int(options['CompatOldFirmware']),
+        }
+
     def get_serialnumber(self):
         """
-        :return: the serial number
+        :return: the serial number (read once per connection, it keys the
+            options_cache: the device behind an address may change)
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'~SerialNumber\x00'
-        response_size = 1024
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            serialnumber = self.__data.split(b'=', 1)[-1].split(b'\x00')[0]
-            serialnumber = serialnumber.replace(b'=', b'')
-            return serialnumber.decode() # string?
-        else:
-            raise ZKErrorResponse("Can't read serial number")
+        if self.__serialnumber is None:
+            serialnumber = option_str(self.get_options(['~SerialNumber'])['~SerialNumber'])
+            if serialnumber is None:
+                raise ZKErrorResponse("Can't read serial number")
+            self.__serialnumber = serialnumber
+        return self.__serialnumber
 
     def get_platform(self):
         """
         :return: the platform name
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'~Platform\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            platform = self.__data.split(b'=', 1)[-1].split(b'\x00')[0]
-            platform = platform.replace(b'=', b'')
-            return platform.decode()
-        else:
+        platform = option_str(self.get_options(['~Platform'], True)['~Platform'])
+        if platform is None:
             raise ZKErrorResponse("Can't read platform name")
+        return platform
 
     def get_mac(self):
         """
         :return: the machine's mac address
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'MAC\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            mac = self.__data.split(b'=', 1)[-1].split(b'\x00')[0]
-            return mac.decode()
-        else:
+        mac = self.get_options(['MAC'], True)['MAC']
+        if mac is None:
             raise ZKErrorResponse("can't read mac address")
+        return mac
 
     def get_device_name(self):
         """
@@ -489,47 +1096,22 @@ class ZK(object):
 
         :return: str
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'~DeviceName\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            device = self.__data.split(b'=', 1)[-1].split(b'\x00')[0]
-            return device.decode()
-        else:
-            return ""
+        return self.get_options(['~DeviceName'], True)['~DeviceName'] or ""
 
     def get_face_version(self):
         """
         :return: the face version
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'ZKFaceVersion\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            response = self.__data.split(b'=', 1)[-1].split(b'\x00')[0]
-            return safe_cast(response, int, 0)  if response else 0
-        else:
-            return None
+        return option_int(self.get_options(['ZKFaceVersion'], True)['ZKFaceVersion'])
 
     def get_fp_version(self):
         """
         :return: the fingerprint version
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'~ZKFPVersion\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            response = self.__data.split(b'=', 1)[-1].split(b'\x00')[0]
-            response = response.replace(b'=', b'')
-            return safe_cast(response, int, 0) if response else 0
-        else:
+        response = self.get_options(['~ZKFPVersion'], True)['~ZKFPVersion']
+        if response is None:
             raise ZKErrorResponse("can't read fingerprint version")
+        return option_int(option_str(response))
 
     def _clear_error(self, command_string=b''):
         """
@@ -544,84 +1126,38 @@ class ZK(object):
         """
         determine extend fmt
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'~ExtendFmt\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            fmt = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-            return safe_cast(fmt, int, 0) if fmt else 0
-        else:
-            self._clear_error(command_string)
-            return None
+        return option_int(self.get_options(['~ExtendFmt'], True)['~ExtendFmt'])
 
     def get_user_extend_fmt(self):
         """
         determine user extend fmt
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'~UserExtFmt\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            fmt = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-            return safe_cast(fmt, int, 0) if fmt else 0
-        else:
-            self._clear_error(command_string)
-            return None
+        return option_int(self.get_options(['~UserExtFmt'], True)['~UserExtFmt'])
 
     def get_face_fun_on(self):
         """
         determine extend fmt
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'FaceFunOn\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            response = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-            return safe_cast(response, int ,0) if response else 0
-        else:
-            self._clear_error(command_string)
-            return None
+        return option_int(self.get_options(['FaceFunOn'], True)['FaceFunOn'])
 
     def get_compat_old_firmware(self):
         """
         determine old firmware
         """
-        command = const.CMD_OPTIONS_RRQ
-        command_string = b'CompatOldFirmware\x00'
-        response_size = 1024
-
-        cmd_response = self.__send_command(command, command_string, response_size)
-        if cmd_response.get('status'):
-            response = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-            return safe_cast(response, int, 0) if response else 0
-        else:
-            self._clear_error(command_string)
-            return None
+        return option_int(self.get_options(['CompatOldFirmware'], True)['CompatOldFirmware'])
 
     def get_network_params(self):
         """
         get network params
         """
-        ip = self.__address[0]
-        mask = b''
-        gate = b''
-        cmd_response = self.__send_command(const.CMD_OPTIONS_RRQ, b'IPAddress\x00', 1024)
-        if cmd_response.get('status'):
-            ip = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-        cmd_response = self.__send_command(const.CMD_OPTIONS_RRQ, b'NetMask\x00', 1024)
-        if cmd_response.get('status'):
-            mask = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-        cmd_response = self.__send_command(const.CMD_OPTIONS_RRQ, b'GATEIPAddress\x00', 1024)
-        if cmd_response.get('status'):
-            gate = (self.__data.split(b'=', 1)[-1].split(b'\x00')[0])
-        return {'ip': ip.decode(), 'mask': mask.decode(), 'gateway': gate.decode()}
+        options = self.get_options(['IPAddress', 'NetMask', 'GATEIPAddress'])
+        return {
+            'ip': options['IPAddress'] or self.__address[0],
+            'mask': options['NetMask'] or '',
+            'gateway': options['GATEIPAddress'] or ''
+        }
 
+    @cached_option('pin_width')
     def get_pin_width(self):
         """
         :return: the PIN width
@@ -658,25 +1194,8 @@ class ZK(object):
         cmd_response = self.__send_command(command,b'', response_size)
         if cmd_response.get('status'):
             if self.verbose: print(codecs.encode(self.__data,'hex'))
-            size = len(self.__data)
-            if len(self.__data) >= 80:
-                fields = unpack('20i', self.__data[:80])
-                self.users = fields[4]
-                self.fingers = fields[6]
-                self.records = fields[8]
-                self.dummy = fields[10] #???
-                self.cards = fields[12]
-                self.fingers_cap = fields[14]
-                self.users_cap = fields[15]
-                self.rec_cap = fields[16]
-                self.fingers_av = fields[17]
-                self.users_av = fields[18]
-                self.rec_av = fields[19]
-                self.__data = self.__data[80:]
-            if len(self.__data) >= 12: #face info
-                fields = unpack('3i', self.__data[:12]) #dirty hack! we need more information
-                self.faces = fields[0]
-                self.faces_cap = fields[2]
+            for name, value in decode_sizes(self.__data).items():
+                setattr(self, name, value)
             return True
         else:
             raise ZKErrorResponse("can't read sizes")
@@ -768,7 +1287,7 @@ class ZK(object):
         response_size = 1032
         cmd_response = self.__send_command(command, b'', response_size)
         if cmd_response.get('status'):
-            return self.__decode_time(self.__data[:4])
+            return decode_time(self.__data[:4])
         else:
             raise ZKErrorResponse("can't get time")
 
@@ -779,7 +1298,7 @@ class ZK(object):
         :param timestamp: python datetime object
         """
         command = const.CMD_SET_TIME
-        command_string = pack(b'I', self.__encode_time(timestamp))
+        command_string = pack(b'I', encode_time(timestamp))
         cmd_response = self.__send_command(command, command_string)
         if cmd_response.get('status'):
             return True
@@ -903,19 +1422,12 @@ class ZK(object):
         if privilege not in [const.USER_DEFAULT, const.USER_ADMIN]:
             privilege = const.USER_DEFAULT
         privilege = int(privilege)
-        if self.user_packet_size == 28: #self.firmware == 6:
-            if not group_id:
-                group_id = 0
-            try:
-                command_string = pack('HB5s8sIxBHI', uid, privilege, password.encode(self.encoding, errors='ignore'), name.encode(self.encoding, errors='ignore'), card, int(group_id), 0, int(user_id))
-            except Exception as e:
-                if self.verbose: print("s_h Error pack: %s" % e)
-                if self.verbose: print("Error pack: %s" % sys.exc_info()[0])
-                raise ZKErrorResponse("Can't pack user")
-        else:
-            name_pad = name.encode(self.encoding, errors='ignore').ljust(24, b'\x00')[:24]
-            card_str = pack('<I', int(card))[:4]
-            command_string = pack('HB8s24s4sx7sx24s', uid, privilege, password.encode(self.encoding, errors='ignore'), name_pad, card_str, group_id.encode(), user_id.encode())
+        try:
+            command_string = pack_user(uid, name, privilege, password, group_id, user_id, card, self.user_packet_size, self.encoding)
+        except Exception as e:
+            if self.verbose: print("s_h Error pack: %s" % e)
+            if self.verbose: print("Error pack: %s" % sys.exc_info()[0])
+            raise ZKErrorResponse("Can't pack user")
         response_size = 1024 #TODO check response?
         cmd_response = self.__send_command(command, command_string, response_size)
         if self.verbose: print("Response: %s" % cmd_response)
@@ -936,79 +1448,175 @@ class ZK(object):
         """
         if not isinstance(user, User):
             users = self.get_users()
-            tusers = list(filter(lambda x: x.uid==user, users))
-            if len(tusers) == 1:
-                user = tusers[0]
-            else:
-                tusers = list(filter(lambda x: x.user_id==str(user), users))
-                if len(tusers) == 1:
-                    user = tusers[0]
-                else:
-                    raise ZKErrorResponse("Can't find user")
+            tuser = users.by_uid(user) or users.by_user_id(str(user))
+            if not tuser:
+                raise ZKErrorResponse("Can't find user")
+            user = tuser
         if isinstance(fingers, Finger):
             fingers = [fingers]
         self.HR_save_usertemplates ([(user, fingers)])
 
-    def HR_save_usertemplates(self, usertemplates):
+    def HR_save_usertemplates(self, usertemplates, refresh=True, batch_size=0x10000):
         """
-        save users and templates in high rate mode
+        save users and templates in high rate mode, in batches of at most
+        batch_size bytes uploaded one after the other. a failed batch
+        doesn't stop the next ones, the data is refreshed once at the end
+        (if a batch was saved), then ZKErrorResponse is raised if any batch
+        failed, with the report in its report attribute.
 
         :param [user,[fingers]]
+        :param refresh: refresh the device data when done
+        :param batch_size: max bytes per batch (a fixed size, not read
+            from the device; chunks are sized by write_chunk)
+        :return: list of dict per batch: start (index of its first user),
+            users, size, throughput (bytes/s) and error (None if saved)
+        """
+        batches = split_usertemplates(usertemplates, self.user_packet_size, batch_size)
+        report = []
+        for start, batch, size in batches:
+            error = None
+            throughput = 0
+            try:
+                throughput = self._send_with_buffer(pack_usertemplates(batch, self.user_packet_size, size))['throughput']
+                cmd_response = self.__send_command(const._CMD_SAVE_USERTEMPS, pack('<IHH', 12,0,8))
+                if not cmd_response.get('status'):
+                    raise ZKErrorResponse("Can't save usertemplates")
+            except ZKErrorResponse as e:
+                error = str(e)
+                if self.verbose: print ("batch {} ({} users) failed: {}".format(start, len(batch), e))
+            report.append({'start': start, 'users': len(batch), 'size': size, 'throughput': throughput, 'error': error})
+        failed = [batch for batch in report if batch['error']]
+        if refresh and len(failed) < len(report):
+            self.refresh_data()
+        if failed:
+            error = ZKErrorResponse("Can't save usertemplates ({} of {} batches failed)".format(len(failed), len(report)))
+            error.report = report
+            raise error
+        return report
+
+    def sync_usertemplates(self, users, fingers=[]):
+        """
+        make the device hold exactly these users and templates, sending
+        only the differences: removed templates and users are deleted,
+        added or changed ones are saved in high rate mode, then the data
+        is refreshed once (nothing is sent if nothing changed). a failed
+        upload raises ZKErrorResponse, after the refresh.
+
+        :param users: list of User object
+        :param fingers: list of Finger object (of those users)
+        :return: change report, see diff_usertemplates
+        """
+        device_users = self.get_users()
+        device_fingers = self.get_templates()
+        report = diff_usertemplates(device_users, device_fingers, users, fingers, self.user_packet_size)
+        if self.verbose: print ("sync: %s" % dict((key, len(value)) for key, value in report.items()))
+        removed_uids = set(user.uid for user in report['users_removed'])
+        for finger in report['templates_removed']:
+            if finger.uid not in removed_uids: # deleted with the user
+                self.delete_user_template(finger.uid, finger.fid)
+        for user in report['users_removed']:
+            self.delete_user(user.uid, refresh=False)
+        upload = dict((user.uid, []) for user in chain(report['users_added'], report['users_changed']))
+        for finger in chain(report['templates_added'], report['templates_changed']):
+            upload.setdefault(finger.uid, []).append(finger)
+        try:
+            if upload:
+                self.HR_save_usertemplates([(user, upload[user.uid]) for user in users if user.uid in upload], refresh=False)
+        finally:
+            if any(report.values()):
+                self.refresh_data()
+        self.next_uid, self.next_user_id = next_user_ids(users)
+        return report
+
+    def _send_with_buffer(self, buffer):
         """
-        upack = b""
-        fpack = b""
-        table = b""
-        fnum = 0x10
-        tstart = 0
-        for user, fingers in usertemplates:
-            if not isinstance(user, User):
-                raise ZKErrorResponse("Invalid user in usertemplates list")
-            if self.user_packet_size == 28:
-                upack += user.repack29()
+        upload buffer to the device: CMD_PREPARE_DATA, then CMD_DATA chunks
+
+        on tcp, up to write_window chunks are sent before waiting for their
+        ACKs, matched by reply_id; if the device refuses them, the upload is
+        restarted with the same chunk size, one chunk at a time. with
+        write_chunk None, the upload starts with the biggest chunk a read
+        uses and is restarted with half the size each time the device
+        refuses a single chunk (down to 1024 bytes); the size that worked is
+        kept in write_chunk. write_window is set back to 1 if only that
+        worked.
+
+        :return: dict with size, chunk, window, elapsed and throughput (bytes/s)
+        """
+        MIN_CHUNK = 1024
+        view = memoryview(buffer)
+        size = len(view)
+        chunk = self.write_chunk or (self.__max_chunk() if self.tcp else MIN_CHUNK)
+        begin = time.time()
+        window = self.write_window if self.tcp else 1
+        while True:
+            self.free_data()
+            command = const.CMD_PREPARE_DATA
+            command_string = codec.UINT.pack(size)
+            cmd_response = self.__send_command(command, command_string)
+            if not cmd_response.get('status'):
+                raise ZKErrorResponse("Can't prepare data")
+            if self.__send_chunks(view, chunk, window):
+                break
+            if window > 1: # pipelining may be the problem, not the size
+                window = 1
+            elif self.write_chunk is None and chunk > MIN_CHUNK:
+                chunk = max(chunk // 2, MIN_CHUNK)
+                window = self.write_window if self.tcp else 1
             else:
-                upack += user.repack73()
-            for finger in fingers:
-                if not isinstance(finger, Finger):
-                    raise ZKErrorResponse("Invalid finger template in usertemplates list")
-                tfp = finger.repack_only()
-                table += pack("<bHbI", 2, user.uid, fnum + finger.fid, tstart)
-                tstart += len(tfp)
-                fpack += tfp
-        head = pack("III", len(upack), len(table), len(fpack))
-        packet = head + upack + table + fpack
-        self._send_with_buffer(packet)
-        command = const._CMD_SAVE_USERTEMPS
-        command_string = pack('<IHH', 12,0,8)
-        cmd_response = self.__send_command(command, command_string)
-        if not cmd_response.get('status'):
-            raise ZKErrorResponse("Can't save usertemplates")
-        self.refresh_data()
+                raise ZKErrorResponse("Can't send chunk")
+            if self.verbose: print ("upload refused, retry with chunk {} window {}".format(chunk, window))
+        if self.write_chunk is None:
+            self.write_chunk = chunk
+        if self.tcp and window < self.write_window:
+            self.write_window = window
+        elapsed = time.time() - begin
+        if self.verbose: print ("uploaded {} bytes in {:.3f}s".format(size, elapsed))
+        return {
+            'size': size,
+            'chunk': chunk,
+            'window': window,
+            'elapsed': elapsed,
+            'throughput': size / elapsed if elapsed else 0
+        }
 
-    def _send_with_buffer(self, buffer):
-        MAX_CHUNK = 1024
-        size = len(buffer)
-        self.free_data()
-        command = const.CMD_PREPARE_DATA
-        command_string = pack('I', size)
-        cmd_response = self.__send_command(command, command_string)
-        if not cmd_response.get('status'):
-            raise ZKErrorResponse("Can't prepare data")
-        remain = size % MAX_CHUNK
-        packets = (size - remain) // MAX_CHUNK
-        start = 0
-        for _wlk in range(packets):
-            self.__send_chunk(buffer[start:start+MAX_CHUNK])
-            start += MAX_CHUNK
-        if remain:
-            self.__send_chunk(buffer[start:start+remain])
-
-    def __send_chunk(self, command_string):
-        command = const.CMD_DATA
-        cmd_response = self.__send_command(command, command_string)
-        if cmd_response.get('status'):
+    def __send_chunks(self, view, chunk, window):
+        """
+        send view in CMD_DATA chunks, keeping up to window of them in
+        flight (tcp)
+
+        :return: bool, False if a chunk was refused or a reply didn't match
+        """
+        chunks = (view[start:start + chunk] for start in range(0, len(view), chunk))
+        if not self.tcp or window <= 1:
+            for data in chunks:
+                if not self.__send_command(const.CMD_DATA, data).get('status'):
+                    return False
             return True
-        else:
-            raise ZKErrorResponse("Can't send chunk")
+        pending = deque()
+        reply_id = self.__reply_id
+        data_recv = b''
+        try:
+            while True:
+                for data in islice(chunks, window - len(pending)):
+                    reply_id = self.__send_pipelined(const.CMD_DATA, data, reply_id)
+                    pending.append(reply_id)
+                if not pending:
+                    return True
+                data_recv = self.__recieve_at_least(data_recv, 16)
+                tcp_length = read_tcp_top(data_recv)
+                response, _checksum, _session_id, reply = codec.HEADER.unpack_from(data_recv, 8)
+                if not tcp_length or reply != pending[0] or response != const.CMD_ACK_OK:
+                    if self.verbose: print ("chunk refused, response {} reply {} (expecting {})".format(response, reply, pending[0]))
+                    return False
+                data_recv = self.__recieve_at_least(data_recv, tcp_length + 8)[tcp_length + 8:]
+                self.__reply_id = pending.popleft()
+        except timeout:
+            return False
+        finally:
+            if pending:
+                self.__drain()
+                self.__reply_id = reply_id
 
     def delete_user_template(self, uid=0, temp_id=0, user_id=''):
         """
@@ -1027,11 +1635,10 @@ class ZK(object):
             else:
                 return False # probably empty!
         if not uid:
-            users = self.get_users()
-            users = list(filter(lambda x: x.user_id==str(user_id), users))
-            if not users:
+            tuser = self.get_users().by_user_id(str(user_id))
+            if not tuser:
                 return False
-            uid = users[0].uid
+            uid = tuser.uid
         command = const.CMD_DELETE_USERTEMP
         command_string = pack('hb', uid, temp_id)
         cmd_response = self.__send_command(command, command_string)
@@ -1040,26 +1647,27 @@ class ZK(object):
         else:
             return False # probably empty!
 
-    def delete_user(self, uid=0, user_id=''):
+    def delete_user(self, uid=0, user_id='', refresh=True):
         """
         delete specific user by uid or user_id
 
         :param uid: user ID that are generated from device
         :param user_id: your own user ID
+        :param refresh: refresh the device data when done
         :return: bool
         """
         if not uid:
-            users = self.get_users()
-            users = list(filter(lambda x: x.user_id==str(user_id), users))
-            if not users:
+            tuser = self.get_users().by_user_id(str(user_id))
+            if not tuser:
                 return False
-            uid = users[0].uid
+            uid = tuser.uid
         command = const.CMD_DELETE_USER
         command_string = pack('h', uid)
         cmd_response = self.__send_command(command, command_string)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("Can't delete user")
-        self.refresh_data()
+        if refresh:
+            self.refresh_data()
         if uid == (self.next_uid - 1):
             self.next_uid = uid
 
@@ -1070,11 +1678,10 @@ class ZK(object):
         :return: list Finger object of the selected user
         """
         if not uid:
-            users = self.get_users()
-            users = list(filter(lambda x: x.user_id==str(user_id), users))
-            if not users:
+            tuser = self.get_users().by_user_id(str(user_id))
+            if not tuser:
                 return False
-            uid = users[0].uid
+            uid = tuser.uid
         for _retries in range(3):
             command = const._CMD_GET_USERTEMP # command secret!!! GET_USER_TEMPLATE
             command_string = pack('hb', uid, temp_id)
@@ -1082,7 +1689,7 @@ class ZK(object):
             cmd_response = self.__send_command(command, command_string, response_size)
             data = self.__recieve_chunk()
             if data is not None:
-                resp = data[:-1]
+                resp = data[:-1].tobytes() # not bytes(view), its repr on python 2
                 if resp[-6:] == b'\x00\x00\x00\x00\x00\x00': # padding? bug?
                     resp = resp[:-6]
                 return Finger(uid, temp_id, 1, resp)
@@ -1091,89 +1698,47 @@ class ZK(object):
             if self.verbose: print ("Can't read/find finger")
             return None
 
-    def get_templates(self):
+    def get_templates(self, processes=1):
         """
+        :param processes: decode big tables in a pool of processes, None for
+            one per cpu (see zk.parallel)
         :return: list of Finger object
         """
         self.read_sizes()
         if self.fingers == 0:
             return []
-        templates = []
         templatedata, size = self.read_with_buffer(const.CMD_DB_RRQ, const.FCT_FINGERTMP)
         if size < 4:
             if self.verbose: print("WRN: no user data")
             return []
-        total_size = unpack('i', templatedata[0:4])[0]
-        if self.verbose: print ("get template total size {}, size {} len {}".format(total_size, size, len(templatedata)))
-        templatedata = templatedata[4:]
-        while total_size:
-            size, uid, fid, valid = unpack('HHbb',templatedata[:6])
-            template = unpack("%is" % (size-6), templatedata[6:size])[0]
-            finger = Finger(uid, fid, valid, template)
-            if self.verbose: print(finger)
-            templates.append(finger)
-            templatedata = templatedata[size:]
-            total_size -= size
+        if self.verbose: print ("get template size {} len {}".format(size, len(templatedata)))
+        if processes != 1:
+            from .parallel import decode_templates_parallel
+            templates = decode_templates_parallel(templatedata, processes)
+        else:
+            templates = decode_templates(templatedata)
+        if self.verbose: print(templates)
         return templates
 
     def get_users(self):
         """
-        :return: list of User object
+        :return: UserTable (list of User object, indexed by uid and user_id)
         """
         self.read_sizes()
         if self.users == 0:
             self.next_uid = 1
             self.next_user_id='1'
-            return []
-        users = []
-        max_uid = 0
+            return UserTable()
         userdata, size = self.read_with_buffer(const.CMD_USERTEMP_RRQ, const.FCT_USER)
         if self.verbose: print("user size {} (= {})".format(size, len(userdata)))
         if size <= 4:
             print("WRN: missing user data")
-            return []
-        total_size = unpack("I",userdata[:4])[0]
-        self.user_packet_size = total_size / self.users
+            return UserTable()
+        users, self.user_packet_size = decode_users(userdata, self.users, self.encoding)
         if not self.user_packet_size in [28, 72]:
             if self.verbose: print("WRN packet size would be  %i" % self.user_packet_size)
-        userdata = userdata[4:]
-        if self.user_packet_size == 28:
-            while len(userdata) >= 28:
-                uid, privilege, password, name, card, group_id, timezone, user_id = unpack('<HB5s8sIxBhI',userdata.ljust(28, b'\x00')[:28])
-                if uid > max_uid: max_uid = uid
-                password = (password.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                name = (name.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                group_id = str(group_id)
-                user_id = str(user_id)
-                #TODO: check card value and find in ver8
-                if not name:
-                    name = "NN-%s" % user_id
-                user = User(uid, name, privilege, password, group_id, user_id, card)
-                users.append(user)
-                if self.verbose: print("[6]user:",uid, privilege, password, name, card, group_id, timezone, user_id)
-                userdata = userdata[28:]
-        else:
-            while len(userdata) >= 72:
-                uid, privilege, password, name, card, group_id, user_id = unpack('<HB8s24sIx7sx24s', userdata.ljust(72, b'\x00')[:72])
-                password = (password.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                name = (name.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                group_id = (group_id.split(b'\x00')[0]).decode(self.encoding, errors='ignore').strip()
-                user_id = (user_id.split(b'\x00')[0]).decode(self.encoding, errors='ignore')
-                if uid > max_uid: max_uid = uid
-                if not name:
-                    name = "NN-%s" % user_id
-                user = User(uid, name, privilege, password, group_id, user_id, card)
-                users.append(user)
-                userdata = userdata[72:]
-        max_uid += 1
-        self.next_uid = max_uid
-        self.next_user_id = str(max_uid)
-        while True:
-            if any(u for u in users if u.user_id == self.next_user_id):
-                max_uid += 1
-                self.next_user_id = str(max_uid)
-            else:
-                break
+        if self.verbose: print(users)
+        self.next_uid, self.next_user_id = next_user_ids(users)
         return users
 
     def cancel_capture(self):
@@ -1229,10 +1794,9 @@ class ZK(object):
         command = const.CMD_STARTENROLL
         done = False
         if  not user_id:
-            users = self.get_users()
-            users = list(filter(lambda x: x.uid==uid, users))
-            if len(users) >= 1:
-                user_id = users[0].user_id
+            tuser = self.get_users().by_uid(uid)
+            if tuser:
+                user_id = tuser.user_id
             else:
                 return False
         if self.tcp:
@@ -1316,68 +1880,13 @@ class ZK(object):
         """
         try live capture of events
         """
-        was_enabled = self.is_enabled
-        users = self.get_users()
-        self.cancel_capture()
-        self.verify_user()
-        if not self.is_enabled:
-            self.enable_device()
-        if self.verbose: print ("start live_capture")
-        self.reg_event(const.EF_ATTLOG)
-        self.__sock.settimeout(new_timeout)
+        users, was_enabled = self._live_capture_start(new_timeout)
         self.end_live_capture = False
         while not self.end_live_capture:
             try:
                 if self.verbose: print ("esperando event")
-                data_recv = self.__sock.recv(1032)
-                self.__ack_ok()
-                if self.tcp:
-                    size = unpack('<HHI', data_recv[:8])[2]
-                    header = unpack('HHHH', data_recv[8:16])
-                    data = data_recv[16:]
-                else:
-                    size = len(data_recv)
-                    header = unpack('<4H', data_recv[:8])
-                    data = data_recv[8:]
-                if not header[0] == const.CMD_REG_EVENT:
-                    if self.verbose: print("not event! %x" % header[0])
-                    continue
-                if not len(data):
-                    if self.verbose: print ("empty")
-                    continue
-                while len(data) >= 10:
-                    if len(data) == 10:
-                        user_id, status, punch, timehex = unpack('<HBB6s', data)
-                        data = data[10:]
-                    elif len(data) == 12:
-                        user_id, status, punch, timehex = unpack('<IBB6s', data)
-                        data = data[12:]
-                    elif len(data) == 14:
-                        user_id, status, punch, timehex, _other = unpack('<HBB6s4s', data)
-                        data = data[14:]
-                    elif len(data) == 32:
-                        user_id,  status, punch, timehex = unpack('<24sBB6s', data[:32])
-                        data = data[32:]
-                    elif len(data) == 36:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s4s', data[:36])
-                        data = data[36:]
-                    elif len(data) == 37:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s5s', data[:37])
-                        data = data[37:]
-                    elif len(data) >= 52:
-                        user_id,  status, punch, timehex, _other = unpack('<24sBB6s20s', data[:52])
-                        data = data[52:]
-                    if isinstance(user_id, int):
-                        user_id = str(user_id)
-                    else:
-                        user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
-                    timestamp = self.__decode_timehex(timehex)
-                    tuser = list(filter(lambda x: x.user_id == user_id, users))
-                    if not tuser:
-                        uid = int(user_id)
-                    else:
-                        uid = tuser[0].uid
-                    yield Attendance(user_id, timestamp, status, punch, uid)
+                for attendance in self._live_capture_read(users):
+                    yield attendance
             except timeout:
                 if self.verbose: print ("time out")
                 yield None # return to keep watching
@@ -1385,11 +1894,81 @@ class ZK(object):
                 if self.verbose: print ("break")
                 break
         if self.verbose: print ("exit gracefully")
+        self._live_capture_stop(was_enabled)
+
+    def _live_capture_start(self, new_timeout=10):
+        """
+        register for attendance events
+
+        :return: users (to match the events), was_enabled (for _live_capture_stop)
+        """
+        was_enabled = self.is_enabled
+        users = self.get_users()
+        self.cancel_capture()
+        self.verify_user()
+        if not self.is_enabled:
+            self.enable_device()
+        if self.verbose: print ("start live_capture")
+        self.reg_event(const.EF_ATTLOG)
+        self.__sock.settimeout(new_timeout)
+        self.__live_data = b''
+        return users, was_enabled
+
+    def _live_capture_read(self, users):
+        """
+        recieve what the device sent (raise timeout if nothing comes), ACK
+        and decode every whole event packet. on tcp, packets sent together
+        are split (see split_event_packets) and a partial one is kept for
+        the next call.
+
+        :return: list of Attendance object, empty if no whole event came
+        """
+        data_recv = self.__sock.recv(1032)
+        if not data_recv:
+            raise ZKNetworkError("connection closed")
+        if self.tcp:
+            packets, self.__live_data = split_event_packets(self.__live_data + data_recv)
+        else:
+            packets = [data_recv]
+        events = []
+        for packet in packets:
+            self.__ack_ok()
+            header = codec.HEADER.unpack_from(packet)
+            if not header[0] == const.CMD_REG_EVENT:
+                if self.verbose: print("not event! %x" % header[0])
+                continue
+            if len(packet) == 8:
+                if self.verbose: print ("empty")
+                continue
+            events.extend(decode_events(packet[8:], users))
+        return events
+
+    def _live_capture_stop(self, was_enabled):
+        """
+        unregister events, restore the timeout and the device state
+        """
         self.__sock.settimeout(self.__timeout)
         self.reg_event(0)
         if not was_enabled:
             self.disable_device()
 
+    def fileno(self):
+        """
+        file descriptor of the socket, for select/selectors
+        """
+        return self.__sock.fileno()
+
+    def live_listener(self, timeout=1):
+        """
+        live_capture in a background thread, events handed to bounded
+        queues and callbacks (see zk.listener)
+
+        :param timeout: seconds between checks for stop()
+        :return: LiveListener, to start
+        """
+        from .listener import LiveListener
+        return LiveListener(self, timeout)
+
     def clear_data(self):
         """
         clear all data (included: user, attendance report, finger database)
@@ -1405,202 +1984,340 @@ class ZK(object):
         else:
             raise ZKErrorResponse("can't clear data")
 
-    def __recieve_tcp_data(self, data_recv, size):
-        """ data_recv, raw tcp packet
-         must analyze tcp_length
-
-         must return data, broken
-         """
-        data = []
-        tcp_length = self.__test_tcp_top(data_recv)
-        if self.verbose: print ("tcp_length {}, size {}".format(tcp_length, size))
-        if tcp_length <= 0:
-            if self.verbose: print ("Incorrect tcp packet")
-            return None, b""
-        if (tcp_length - 8) < size:
-            if self.verbose: print ("tcp length too small... retrying")
-            resp, bh = self.__recieve_tcp_data(data_recv, tcp_length - 8)
-            data.append(resp)
-            size -= len(resp)
-            if self.verbose: print ("new tcp DATA packet to fill misssing {}".format(size))
-            data_recv = bh + self.__sock.recv(size + 16 )
-            if self.verbose: print ("new tcp DATA starting with {} bytes".format(len(data_recv)))
-            resp, bh = self.__recieve_tcp_data(data_recv, size)
-            data.append(resp)
-            if self.verbose: print ("for misssing {} recieved {} with extra {}".format(size, len(resp), len(bh)))
-            return b''.join(data), bh
-        recieved = len(data_recv)
-        if self.verbose: print ("recieved {}, size {}".format(recieved, size))
-        response = unpack('HHHH', data_recv[8:16])[0]
-        if recieved >= (size + 32):
-            if response == const.CMD_DATA:
-                resp = data_recv[16 : size + 16]
-                if self.verbose: print ("resp complete len {}".format(len(resp)))
-                return resp, data_recv[size + 16:]
-            else:
-                if self.verbose: print("incorrect response!!! {}".format(response))
-                return None, b""
-        else:
-            if self.verbose: print ("try DATA incomplete (actual valid {})".format(recieved-16))
-            data.append(data_recv[16 : size + 16 ])
-            size -= recieved - 16
-            broken_header = b""
-            if size < 0:
-                broken_header = data_recv[size:]
-                if self.verbose: print ("broken", (broken_header).encode('hex'))
-            if size > 0:
-                data_recv = self.__recieve_raw_data(size)
-                data.append(data_recv)
-            return b''.join(data), broken_header
-
-    def __recieve_raw_data(self, size):
-        """ partial data ? """
-        data = []
-        if self.verbose: print ("expecting {} bytes raw data".format(size))
-        while size > 0:
-            data_recv = self.__sock.recv(size)
-            recieved = len(data_recv)
+    def __recieve_tcp_data(self, view, data_recv):
+        """
+        fill view with the payload of the CMD_DATA tcp packets that follow
+
+        :param view: memoryview to fill, its size is the expected data size
+        :param data_recv: bytes already read from the socket
+        :return: bytes read past the last packet, or None if broken
+        """
+        size = len(view)
+        start = 0
+        while start < size:
+            data_recv = self.__recieve_at_least(data_recv, 16)
+            tcp_length = read_tcp_top(data_recv)
+            response = codec.COMMAND.unpack_from(data_recv, 8)[0]
+            if self.verbose: print ("tcp_length {}, still need {}".format(tcp_length, size - start))
+            if tcp_length <= 8 or response != const.CMD_DATA:
+                if self.verbose: print ("incorrect tcp packet, response {}".format(response))
+                return None
+            length = tcp_length - 8
+            if length > size - start:
+                if self.verbose: print ("tcp packet too long, {} > {}".format(length, size - start))
+                return None
+            available = data_recv[16:16 + length]
+            view[start:start + len(available)] = available
+            self.__recieve_raw_data(view[start + len(available):start + length])
+            data_recv = data_recv[16 + len(available):]
+            start += length
+        return data_recv
+
+    def __recieve_at_least(self, data_recv, size):
+        """ read from socket until data_recv has at least size bytes """
+        while len(data_recv) < size:
+            more = self.__sock.recv(size - len(data_recv))
+            if not more:
+                raise ZKNetworkError("connection closed")
+            data_recv += more
+        return data_recv
+
+    def __recieve_raw_data(self, view):
+        """ fill the whole view with raw data, straight from the socket """
+        size = len(view)
+        start = 0
+        if size and self.verbose: print ("expecting {} bytes raw data".format(size))
+        while start < size:
+            recieved = self.__sock.recv_into(view[start:], size - start)
+            if not recieved:
+                raise ZKNetworkError("connection closed")
             if self.verbose: print ("partial recv {}".format(recieved))
-            if recieved < 100 and self.verbose: print ("   recv {}".format(codecs.encode(data_recv, 'hex')))
-            data.append(data_recv)
-            size -= recieved
-            if self.verbose: print ("still need {}".format(size))
-        return b''.join(data)
-
-    def __recieve_chunk(self):
-        """ recieve a chunk """
+            start += recieved
+        return view
+
+    def __recieve_chunk(self, view=None):
+        """
+        recieve a chunk
+
+        :param view: memoryview where the chunk is stored, allocated if None
+        :return: memoryview with the data or None
+        """
         if self.__response == const.CMD_DATA:
             if self.tcp:
+                size = self.__tcp_length - 8
                 if self.verbose: print ("_rc_DATA! is {} bytes, tcp length is {}".format(len(self.__data), self.__tcp_length))
-                if len(self.__data) < (self.__tcp_length - 8):
-                    need = (self.__tcp_length - 8) - len(self.__data)
-                    if self.verbose: print ("need more data: {}".format(need))
-                    more_data = self.__recieve_raw_data(need)
-                    return b''.join([self.__data, more_data])
-                else:
-                    if self.verbose: print ("Enough data")
-                    return self.__data
             else:
-                if self.verbose: print ("_rc len is {}".format(len(self.__data)))
-                return self.__data
+                size = len(self.__data)
+                if self.verbose: print ("_rc len is {}".format(size))
+            if view is None:
+                view = memoryview(bytearray(size))
+            elif len(view) < size:
+                if self.verbose: print ("chunk too big {} > {}".format(size, len(view)))
+                return None
+            available = self.__data[:size]
+            view[:len(available)] = available
+            self.__recieve_raw_data(view[len(available):size])
+            return view[:size]
         elif self.__response == const.CMD_PREPARE_DATA:
-            data = []
             size = self.__get_data_size()
             if self.verbose: print ("recieve chunk: prepare data size is {}".format(size))
+            if view is None:
+                view = memoryview(bytearray(size))
+            view = view[:size]
             if self.tcp:
-                if len(self.__data) >= (8 + size):
-                    data_recv = self.__data[8:]
-                else:
-                    data_recv = self.__data[8:] + self.__sock.recv(size + 32)
-                resp, broken_header = self.__recieve_tcp_data(data_recv, size)
-                data.append(resp)
+                data_recv = self.__recieve_tcp_data(view, self.__data[8:])
+                if data_recv is None:
+                    return None
                 # get CMD_ACK_OK
-                if len(broken_header) < 16:
-                    data_recv = broken_header + self.__sock.recv(16)
-                else:
-                    data_recv = broken_header
-                if len(data_recv) < 16:
-                    print ("trying to complete broken ACK %s /16" % len(data_recv))
-                    if self.verbose: print (data_recv.encode('hex'))
-                    data_recv += self.__sock.recv(16 - len(data_recv)) #TODO: CHECK HERE_!
-                if not self.__test_tcp_top(data_recv):
+                data_recv = self.__recieve_at_least(data_recv, 16)
+                if not read_tcp_top(data_recv):
                     if self.verbose: print ("invalid chunk tcp ACK OK")
                     return None
-                response = unpack('HHHH', data_recv[8:16])[0]
+                response = codec.COMMAND.unpack_from(data_recv, 8)[0]
                 if response == const.CMD_ACK_OK:
                     if self.verbose: print ("chunk tcp ACK OK!")
-                    return b''.join(data)
+                    return view
                 if self.verbose: print("bad response %s" % data_recv)
-                if self.verbose: print (codecs.encode(data,'hex'))
                 return None
-
-                return resp
+            packet = bytearray(1024 + 8)
+            packet_view = memoryview(packet)
+            start = 0
             while True:
-                data_recv = self.__sock.recv(1024+8)
-                response = unpack('<4H', data_recv[:8])[0]
+                recieved = self.__sock.recv_into(packet)
+                response = codec.COMMAND.unpack_from(packet)[0]
                 if self.verbose: print ("# packet response is: {}".format(response))
                 if response == const.CMD_DATA:
-                    data.append(data_recv[8:])
-                    size -= 1024
+                    length = min(recieved - 8, size - start)
+                    view[start:start + length] = packet_view[8:8 + length]
+                    start += length
                 elif response == const.CMD_ACK_OK:
                     break
                 else:
                     if self.verbose: print ("broken!")
                     break
-                if self.verbose: print ("still needs %s" % size)
-            return b''.join(data)
+                if self.verbose: print ("still needs %s" % (size - start))
+            return view[:start]
         else:
             if self.verbose: print ("invalid response %s" % self.__response)
             return None
 
-    def __read_chunk(self, start, size):
+    def __read_chunk(self, start, size, view=None):
         """
         read a chunk from buffer
+
+        :param view: memoryview where the chunk is stored, allocated if None
         """
         for _retries in range(3):
             command = const._CMD_READ_BUFFER
-            command_string = pack('<ii', start, size)
-            if self.tcp:
-                response_size = size + 32
-            else:
-                response_size = 1024 + 8
+            command_string = codec.INT_PAIR.pack(start, size)
+            response_size = 1024 + 8 # the rest goes straight into view
             cmd_response = self.__send_command(command, command_string, response_size)
-            data = self.__recieve_chunk()
+            data = self.__recieve_chunk(view)
             if data is not None:
                 return data
         else:
             raise ZKErrorResponse("can't read chunk %i:[%i]" % (start, size))
 
-    def read_with_buffer(self, command, fct=0 ,ext=0):
+    def __send_read_chunk(self, start, size, reply_id):
         """
-        Test read info with buffered command (ZK6: 1503)
+        send a _CMD_READ_BUFFER request without waiting for the reply (tcp)
+
+        :return: reply_id of the request
+        """
+        return self.__send_pipelined(const._CMD_READ_BUFFER, codec.INT_PAIR.pack(start, size), reply_id)
+
+    def __send_pipelined(self, command, command_string, reply_id):
+        """
+        send a command without waiting for the reply (tcp)
+
+        :return: reply_id of the request
+        """
+        buf = create_header(command, command_string, self.__session_id, reply_id)
+        try:
+            self.__sock.send(create_tcp_top(buf))
+        except Exception as e:
+            raise ZKNetworkError(str(e))
+        return codec.USHORT.unpack_from(buf, 6)[0]
+
+    def __recieve_read_reply(self, reply_id, view, data_recv):
+        """
+        recieve the whole tcp reply of a pipelined _CMD_READ_BUFFER into view
+
+        :param data_recv: bytes already read from the socket
+        :return: bytes read past the reply, or None if it's not the expected one
+        """
+        data_recv = self.__recieve_at_least(data_recv, 16)
+        tcp_length = read_tcp_top(data_recv)
+        response, _checksum, _session_id, reply = codec.HEADER.unpack_from(data_recv, 8)
+        if not tcp_length or reply != reply_id:
+            if self.verbose: print ("unexpected reply {} (expecting {})".format(reply, reply_id))
+            return None
+        if response == const.CMD_DATA:
+            if tcp_length - 8 != len(view):
+                return None
+            available = data_recv[16:tcp_length + 8]
+            view[:len(available)] = available
+            self.__recieve_raw_data(view[len(available):])
+            return data_recv[16 + len(available):]
+        if response != const.CMD_PREPARE_DATA:
+            if self.verbose: print ("unexpected response {}".format(response))
+            return None
+        data_recv = self.__recieve_at_least(data_recv, tcp_length + 8)
+        if codec.UINT.unpack_from(data_recv, 16)[0] != len(view):
+            return None
+        data_recv = self.__recieve_tcp_data(view, data_recv[tcp_length + 8:])
+        if data_recv is None:
+            return None
+        data_recv = self.__recieve_at_least(data_recv, 16)
+        response, _checksum, _session_id, reply = codec.HEADER.unpack_from(data_recv, 8)
+        if not read_tcp_top(data_recv) or response != const.CMD_ACK_OK or reply != reply_id:
+            if self.verbose: print ("invalid pipelined ACK OK")
+            return None
+        return data_recv[16:]
+
+    def __drain(self, wait=0.5):
+        """
+        discard whatever the device still has to send
+        """
+        self.__sock.settimeout(wait)
+        try:
+            while self.__sock.recv(0xFFFF):
+                pass
+        except Exception:
+            pass
+        finally:
+            self.__sock.settimeout(self.__timeout)
+
+    def __read_chunks(self, chunks):
+        """
+        read chunks from buffer, in offset order
+
+        on tcp, up to read_window _CMD_READ_BUFFER requests are kept in
+        flight and the replies are matched by reply_id. if the device
+        misbehaves, read_window is set back to 1 and the chunks not read
+        yet are read one at a time.
+
+        :param chunks: iterable of (start, memoryview)
+        :return: generator of (start, memoryview)
+        """
+        chunks = iter(chunks)
+        pending = deque()
+        if self.tcp and self.read_window > 1:
+            reply_id = self.__reply_id
+            data_recv = b''
+            broken = False
+            try:
+                while not broken:
+                    for start, view in islice(chunks, self.read_window - len(pending)):
+                        reply_id = self.__send_read_chunk(start, len(view), reply_id)
+                        pending.append((reply_id, start, view))
+                    if not pending:
+                        break
+                    data_recv = self.__recieve_read_reply(pending[0][0], pending[0][2], data_recv)
+                    if data_recv is None:
+                        broken = True
+                    else:
+                        self.__reply_id, start, view = pending.popleft()
+                        yield start, view
+            except timeout:
+                broken = True
+            finally:
+                if pending:
+                    self.__drain()
+                    self.__reply_id = reply_id
+            if broken:
+                if self.verbose: print ("pipelined read failed, fallback to one chunk at a time")
+                self.read_window = 1
+        for start, view in chain([(start, view) for _reply_id, start, view in pending], chunks):
+            yield start, self.__read_chunk(start, len(view), view)
+
+    def __max_chunk(self):
+        """
+        biggest chunk asked to the device in a single read
         """
         if self.tcp:
-            MAX_CHUNK = 0xFFc0
-        else:
-            MAX_CHUNK = 16 * 1024
-        command_string = pack('<bhii', 1, command, fct, ext)
+            return 0xFFc0
+        return 16 * 1024
+
+    def __prepare_buffer(self, command, fct=0, ext=0):
+        """
+        ask the device to prepare the data in its buffer
+
+        :return: size of the data, data if it was sent right away (or None)
+        """
+        command_string = codec.PREPARE_BUFFER.pack(1, command, fct, ext)
         if self.verbose: print ("rwb cs", command_string)
         response_size = 1024
-        data = []
-        start = 0
         cmd_response = self.__send_command(const._CMD_PREPARE_BUFFER, command_string, response_size)
         if not cmd_response.get('status'):
             raise ZKErrorResponse("RWB Not supported")
         if cmd_response['code'] == const.CMD_DATA:
-            if self.tcp:
-                if self.verbose: print ("DATA! is {} bytes, tcp length is {}".format(len(self.__data), self.__tcp_length))
-                if len(self.__data) < (self.__tcp_length - 8):
-                    need = (self.__tcp_length - 8) - len(self.__data)
-                    if self.verbose: print ("need more data: {}".format(need))
-                    more_data = self.__recieve_raw_data(need)
-                    return b''.join([self.__data, more_data]), len(self.__data) + len(more_data)
-                else:
-                    if self.verbose: print ("Enough data")
-                    size = len(self.__data)
-                    return self.__data, size
-            else:
-                size = len(self.__data)
-                return self.__data, size
-        size = unpack('I', self.__data[1:5])[0]
+            data = self.__recieve_chunk()
+            return len(data), data
+        size = codec.UINT.unpack_from(self.__data, 1)[0]
         if self.verbose: print ("size fill be %i" % size)
-        remain = size % MAX_CHUNK
-        packets = (size-remain) // MAX_CHUNK # should be size /16k
-        if self.verbose: print ("rwb: #{} packets of max {} bytes, and extra {} bytes remain".format(packets, MAX_CHUNK, remain))
-        for _wlk in range(packets):
-            data.append(self.__read_chunk(start,MAX_CHUNK))
-            start += MAX_CHUNK
-        if remain:
-            data.append(self.__read_chunk(start, remain))
-            start += remain
+        return size, None
+
+    def read_with_buffer(self, command, fct=0 ,ext=0):
+        """
+        Test read info with buffered command (ZK6: 1503)
+
+        the data is stored in a single buffer, allocated once the device
+        announces the total size.
+
+        :return: memoryview with the data, size
+        """
+        size, data = self.__prepare_buffer(command, fct, ext)
+        if data is not None:
+            return data, size
+        data = self.__read_buffer(0, size)
         self.free_data()
-        if self.verbose: print ("_read w/chunk %i bytes" % start)
-        return b''.join(data), start
+        if self.verbose: print ("_read w/chunk %i bytes" % size)
+        return data, size
 
-    def get_attendance(self):
+    def __read_buffer(self, start, size):
+        """
+        read a range of the prepared buffer
+
+        :return: memoryview with the data
+        """
+        MAX_CHUNK = self.__max_chunk()
+        data = memoryview(bytearray(size))
+        chunks = [(start + offset, data[offset:offset + MAX_CHUNK]) for offset in range(0, size, MAX_CHUNK)]
+        if self.verbose: print ("rwb: #{} packets of max {} bytes".format(len(chunks), MAX_CHUNK))
+        for _start, _chunk in self.__read_chunks(chunks):
+            pass
+        return data
+
+    def iter_with_buffer(self, command, fct=0, ext=0):
+        """
+        like read_with_buffer, but every chunk is yielded as soon as it is
+        read, so the whole data is never kept in memory. use iter_aligned
+        to get the records split between two chunks back together.
+        free_data is sent even if the generator is closed early.
+
+        :return: generator of memoryview
+        """
+        MAX_CHUNK = self.__max_chunk()
+        size, data = self.__prepare_buffer(command, fct, ext)
+        if data is not None:
+            yield data
+            return
+        chunks = ((start, memoryview(bytearray(min(MAX_CHUNK, size - start)))) for start in range(0, size, MAX_CHUNK))
+        reader = self.__read_chunks(chunks)
+        try:
+            for _start, chunk in reader:
+                yield chunk
+        finally:
+            reader.close()
+            self.free_data()
+
+    def get_attendance(self, processes=1):
         """
         return attendance record
 
+        :param processes: decode big logs in a pool of processes, None for
+            one per cpu (see zk.parallel)
         :return: List of Attendance object
         """
         self.read_sizes()
@@ -1608,60 +2325,118 @@ class ZK(object):
             return []
         users = self.get_users()
         if self.verbose: print (users)
-        attendances = []
         attendance_data, size = self.read_with_buffer(const.CMD_ATTLOG_RRQ)
         if size < 4:
             if self.verbose: print ("WRN: no attendance data")
             return []
-        total_size = unpack("I", attendance_data[:4])[0]
+        total_size = codec.UINT.unpack_from(attendance_data)[0]
         record_size = total_size // self.records
         if self.verbose: print ("record_size is ", record_size)
-        attendance_data = attendance_data[4:]
-        if record_size == 8:
-            while len(attendance_data) >= 8:
-                uid, status, timestamp, punch = unpack('HB4sB', attendance_data.ljust(8, b'\x00')[:8])
-                if self.verbose: print (codecs.encode(attendance_data[:8], 'hex'))
-                attendance_data = attendance_data[8:]
-                tuser = list(filter(lambda x: x.uid == uid, users))
-                if not tuser:
-                    user_id = str(uid)
-                else:
-                    user_id = tuser[0].user_id
-                timestamp = self.__decode_time(timestamp)
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-        elif record_size == 16:
-            while len(attendance_data) >= 16:
-                user_id, timestamp, status, punch, reserved, workcode = unpack('<I4sBB2sI', attendance_data.ljust(16, b'\x00')[:16])
-                user_id = str(user_id)
-                if self.verbose: print(codecs.encode(attendance_data[:16], 'hex'))
-                attendance_data = attendance_data[16:]
-                tuser = list(filter(lambda x: x.user_id == user_id, users))
-                if not tuser:
-                    if self.verbose: print("no uid {}", user_id)
-                    uid = str(user_id)
-                    tuser = list(filter(lambda x: x.uid == user_id, users))
-                    if not tuser:
-                        uid = str(user_id)
-                    else:
-                        uid = tuser[0].uid
-                        user_id = tuser[0].user_id
-                else:
-                    uid = tuser[0].uid
-                timestamp = self.__decode_time(timestamp)
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
+        if processes != 1:
+            from .parallel import decode_attendance_parallel
+            return decode_attendance_parallel(memoryview(attendance_data)[4:], record_size, users, processes)
+        return list(decode_attendance(attendance_data[4:], record_size, users))
+
+    def get_attendance_columns(self):
+        """
+        same records as get_attendance, decoded in columns: vectorized
+        with numpy when it is installed (timestamps as datetime64[s]),
+        lists of values otherwise.
+
+        :return: dict of column: array (uid, user_id, timestamp, status, punch)
+        """
+        from .columnar import COLUMNS, decode_attendance_columns
+        self.read_sizes()
+        if self.records == 0:
+            return dict((name, []) for name in COLUMNS)
+        users = self.get_users()
+        attendance_data, size = self.read_with_buffer(const.CMD_ATTLOG_RRQ)
+        if size < 4:
+            if self.verbose: print ("WRN: no attendance data")
+            return dict((name, []) for name in COLUMNS)
+        total_size = codec.UINT.unpack_from(attendance_data)[0]
+        record_size = total_size // self.records
+        return decode_attendance_columns(attendance_data[4:], record_size, users)
+
+    def iter_attendance(self):
+        """
+        like get_attendance, but records are decoded while the log is
+        downloaded, so memory stays flat whatever the log size
+
+        :return: generator of Attendance object
+        """
+        self.read_sizes()
+        if self.records == 0:
+            return
+        users = self.get_users()
+        chunks = self.iter_with_buffer(const.CMD_ATTLOG_RRQ)
+        try:
+            data = next(chunks, b'')
+            if len(data) < 4:
+                if self.verbose: print ("WRN: no attendance data")
+                return
+            total_size = codec.UINT.unpack_from(data)[0]
+            record_size = total_size // self.records
+            if self.verbose: print ("record_size is ", record_size)
+            if record_size not in [8, 16]:
+                record_size = max(record_size, 40)
+            for block in iter_aligned(chain([data[4:]], chunks), record_size):
+                for attendance in decode_attendance(block, record_size, users):
+                    yield attendance
+        finally:
+            chunks.close()
+
+    def get_new_attendance(self, cursor=None, users=None):
+        """
+        return the attendance records added since the cursor, only the end
+        of the log is transferred. if the log was cleared or rotated (its
+        first records don't match the cursor anymore) the whole log is read.
+
+        :param cursor: cursor returned by the previous call, None reads all
+        :param users: list of User object, read from the device if needed
+        :return: list of Attendance object, new cursor
+        """
+        FINGERPRINT = 4 # records
+        self.read_sizes()
+        if self.records == 0:
+            return [], {'records': 0, 'record_size': 0, 'fingerprint': ''}
+        size, data = self.__prepare_buffer(const.CMD_ATTLOG_RRQ)
+        if data is None:
+            read = self.__read_buffer
         else:
-            while len(attendance_data) >= 40:
-                uid, user_id, status, timestamp, punch, space = unpack('<H24sB4sB8s', attendance_data.ljust(40, b'\x00')[:40])
-                if self.verbose: print (codecs.encode(attendance_data[:40], 'hex'))
-                user_id = (user_id.split(b'\x00')[0]).decode(errors='ignore')
-                timestamp = self.__decode_time(timestamp)
-
-                attendance = Attendance(user_id, timestamp, status, punch, uid)
-                attendances.append(attendance)
-                attendance_data = attendance_data[record_size:]
-        return attendances
+            read = lambda start, length: data[start:start + length]
+        try:
+            if size < 4:
+                if self.verbose: print ("WRN: no attendance data")
+                return [], {'records': 0, 'record_size': 0, 'fingerprint': ''}
+            total_size = codec.UINT.unpack_from(read(0, 4))[0]
+            if cursor and cursor['record_size']:
+                record_size = cursor['record_size']
+            else:
+                record_size = total_size // self.records
+            if record_size not in [8, 16]:
+                record_size = max(record_size, 40)
+            records = (size - 4) // record_size
+            head = read(4, min(FINGERPRINT, records) * record_size)
+            start = 0
+            if cursor and cursor['record_size'] == record_size and cursor['records'] <= records:
+                known = min(FINGERPRINT, cursor['records']) * record_size
+                if hashlib.sha1(head[:known]).hexdigest() == cursor['fingerprint']:
+                    start = cursor['records']
+                elif self.verbose: print ("attendance log changed, full read")
+            if self.verbose: print ("new records {} from {}".format(records - start, start))
+            attendance_data = read(4 + start * record_size, (records - start) * record_size)
+        finally:
+            if data is None:
+                self.free_data()
+        cursor = {
+            'records': records,
+            'record_size': record_size,
+            'fingerprint': hashlib.sha1(head).hexdigest()
+        }
+        if users is None and record_size in [8, 16] and start < records:
+            users = self.get_users()
+        return list(decode_attendance(attendance_data, record_size, users)), cursor
 
     def clear_attendance(self):
         """
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import threading
+import time
+
+
+class OptionsCache(object):
+    """
+    cache of the device options that (almost) never change: firmware,
+    platform, mac...
+
+    values are kept per serial number for `ttl` seconds; the serial number
+    itself is read from the device on each connection (ZK.get_serialnumber),
+    a device swapped behind an address gets its own values. with a path,
+    the cache is loaded from and saved to a json file, so it can be shared
+    between runs (last writer wins).
+    """
+    def __init__(self, ttl=24 * 3600, path=None):
+        """
+        Construct a new 'OptionsCache' object.
+
+        :param ttl: seconds a value stays valid
+        :param path: json file to load/save the cache (optional)
+        """
+        self.ttl = ttl
+        self.path = path
+        self.__devices = {} # serial: {name: [value, expires]}
+        self.__lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.load()
+
+    def __contains__(self, key):
+        serial, name = key
+        with self.__lock:
+            entry = self.__devices.get(serial, {}).get(name)
+            return entry is not None and entry[1] > time.time()
+
+    def get(self, serial, name, default=None):
+        """
+        :return: the cached value, default if missing or expired
+        """
+        with self.__lock:
+            entry = self.__devices.get(serial, {}).get(name)
+            if entry is None or entry[1] <= time.time():
+                return default
+            return entry[0]
+
+    def set(self, serial, name, value, ttl=None):
+        """
+        cache a value (ttl overrides the default)
+        """
+        expires = time.time() + (self.ttl if ttl is None else ttl)
+        with self.__lock:
+            self.__devices.setdefault(serial, {})[name] = [value, expires]
+
+    def invalidate(self, serial=None, name=None):
+        """
+        drop cached values: all of them, those of one device (serial) or
+        a single one (serial and name)
+        """
+        with self.__lock:
+            if serial is None:
+                self.__devices.clear()
+            elif name is None:
+                self.__devices.pop(serial, None)
+            else:
+                self.__devices.get(serial, {}).pop(name, None)
+
+    def load(self, path=None):
+        """
+        load the cache from a json file (expired values are skipped)
+        """
+        with open(path or self.path) as infile:
+            data = json.load(infile)
+        now = time.time()
+        with self.__lock:
+            for serial, options in data.get('devices', {}).items():
+                options = dict((name, entry) for name, entry in options.items() if entry[1] > now)
+                self.__devices.setdefault(serial, {}).update(options)
+
+    def save(self, path=None):
+        """
+        save the cache to a json file (atomic replace)
+        """
+        path = path or self.path
+        with self.__lock:
+            data = json.dumps({'devices': self.__devices}, sort_keys=True)
+        tmp = '%s.%i.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as outfile:
+            outfile.write(data)
+        if os.name == 'nt' and os.path.exists(path):
+            os.remove(path) # no atomic replace on py2/windows
+        os.rename(tmp, path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if self.path:
+            self.save()
+
+    def __len__(self):
+        with self.__lock:
+            return sum(len(options) for options in self.__devices.values())
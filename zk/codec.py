@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""
+precompiled struct layouts of the protocol
+
+every packet and record format is compiled once here, the hot paths use
+them with pack_into/unpack_from (no intermediate slices).
+"""
+from struct import Struct
+
+# framing
+HEADER = Struct('<4H') # command, checksum, session_id, reply_id
+TCP_TOP = Struct('<HHI') # MACHINE_PREPARE_DATA_1, MACHINE_PREPARE_DATA_2, length
+COMMAND = Struct('<H')
+
+# scalars
+UINT = Struct('<I')
+INT = Struct('<i')
+USHORT = Struct('<H')
+INT_PAIR = Struct('<ii') # _CMD_READ_BUFFER start, size
+PREPARE_BUFFER = Struct('<bhii') # _CMD_PREPARE_BUFFER 1, command, fct, ext
+SIZES = Struct('<20i') # CMD_GET_FREE_SIZES
+FACES = Struct('<3i')
+
+# users
+USER_28 = Struct('<HB5s8sIxBhI') # read (zk6)
+USER_72 = Struct('<HB8s24sIx7sx24s') # read (zk8)
+USER_WRQ_28 = Struct('<HB5s8sIxBHI') # CMD_USER_WRQ (zk6)
+USER_WRQ_72 = Struct('<HB8s24s4sx7sx24s') # CMD_USER_WRQ (zk8)
+USER_29 = Struct('<BHB5s8sIxBhI') # high rate upload (zk6)
+USER_73 = Struct('<BHB8s24sIB7sx24s') # high rate upload (zk8)
+
+# templates
+TEMPLATE = Struct('<HHbb') # size (with header), uid, fid, valid
+TEMPLATE_ONLY = Struct('<H') # size
+TEMPLATE_ENTRY = Struct('<bHbI') # high rate table: 2, uid, fid, offset
+HR_HEAD = Struct('<III') # users, table, templates sizes
+
+# attendance records
+ATTENDANCE_8 = Struct('<HB4sB')
+ATTENDANCE_16 = Struct('<I4sBB2sI')
+ATTENDANCE_40 = Struct('<H24sB4sB8s')
+
+# live capture events, by size
+EVENTS = {
+    10: Struct('<HBB6s'),
+    12: Struct('<IBB6s'),
+    14: Struct('<HBB6s4x'),
+    32: Struct('<24sBB6s'),
+    36: Struct('<24sBB6s4x'),
+    37: Struct('<24sBB6s5x'),
+    52: Struct('<24sBB6s20x'),
+}
+
+_WORDS = {}
+
+
+def words(count):
+    """
+    :return: Struct of count little endian unsigned shorts (cached)
+    """
+    record = _WORDS.get(count)
+    if record is None:
+        if len(_WORDS) >= 256:
+            _WORDS.clear()
+        record = _WORDS[count] = Struct('<%iH' % count)
+    return record
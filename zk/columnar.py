@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+columnar attendance decoding, vectorized with numpy when available
+"""
+from struct import pack
+
+from .user import UserTable
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+COLUMNS = ['uid', 'user_id', 'timestamp', 'status', 'punch']
+
+# fields and offsets of the fixed record layouts (as in decode_attendance)
+RECORD_8 = {'names': ['uid', 'status', 'time', 'punch'], 'formats': ['<u2', 'u1', '<u4', 'u1'], 'offsets': [0, 2, 3, 7], 'itemsize': 8}
+RECORD_16 = {'names': ['user_id', 'time', 'status', 'punch'], 'formats': ['<u4', '<u4', 'u1', 'u1'], 'offsets': [0, 4, 8, 9], 'itemsize': 16}
+RECORD_40 = {'names': ['uid', 'user_id', 'status', 'time', 'punch'], 'formats': ['<u2', 'S24', 'u1', '<u4', 'u1'], 'offsets': [0, 2, 26, 27, 31], 'itemsize': 40}
+
+
+_DAYS = [] # datetime64[D] of every packed day number, NaT if impossible
+
+
+def _days_table():
+    if not _DAYS:
+        numbers = numpy.arange((0xFFFFFFFF // 86400) + 1, dtype='int64')
+        day = numbers % 31
+        months = (numbers // 31 // 12 + 30) * 12 + numbers // 31 % 12 # since 1970
+        first = months.astype('datetime64[M]').astype('datetime64[D]')
+        days = first + day.astype('timedelta64[D]')
+        days[days.astype('datetime64[M]') != first.astype('datetime64[M]')] = numpy.datetime64('NaT')
+        _DAYS.append(days)
+    return _DAYS[0]
+
+
+def decode_times(times):
+    """
+    vectorized decode_time, packed timestamps to datetime64[s]
+
+    raise ValueError on impossible dates, as datetime() does
+    """
+    times = times.astype('int64')
+    days = _days_table()[times // 86400]
+    if numpy.isnat(days).any():
+        raise ValueError("day is out of range for month")
+    return days.astype('datetime64[s]') + (times % 86400).astype('timedelta64[s]')
+
+
+def _map_unique(values, function):
+    """
+    apply function once per distinct value
+
+    :return: object array
+    """
+    if values.dtype.kind == 'u' and values.dtype.itemsize <= 2:
+        # small integers: direct lookup table, no sort
+        present = numpy.zeros(1 << (8 * values.dtype.itemsize), dtype=bool)
+        present[values] = True
+        mapped = numpy.empty(len(present), dtype=object)
+        uniques = numpy.flatnonzero(present)
+        mapped[uniques] = [function(value) for value in uniques.tolist()]
+        return mapped[values]
+    uniques, inverse = numpy.unique(values, return_inverse=True)
+    mapped = numpy.empty(len(uniques), dtype=object)
+    mapped[:] = [function(value) for value in uniques.tolist()]
+    return mapped[inverse.reshape(-1)]
+
+
+def _map_user_ids(raw, function):
+    """
+    _map_unique for the 24 bytes user_id field, compared as a number
+    when no user_id is longer than 8 bytes (the usual case)
+    """
+    words = numpy.ascontiguousarray(raw).view('<u8').reshape(-1, 3)
+    if len(words) and not words[:, 1:].any():
+        return _map_unique(words[:, 0], lambda word: function(pack('<Q', word)))
+    return _map_unique(raw, function)
+
+
+def _records(attendance_data, layout, step):
+    """
+    structured view over the records, without copy
+    """
+    size = len(attendance_data)
+    count = (size - layout['itemsize']) // step + 1 if size >= layout['itemsize'] else 0
+    return numpy.ndarray((count,), dtype=numpy.dtype(layout), buffer=attendance_data, strides=(step,))
+
+
+def decode_attendance_numpy(attendance_data, record_size, users):
+    """
+    numpy version of decode_attendance, same values in columns
+
+    :return: dict of numpy arrays (see COLUMNS)
+    """
+    users = users if isinstance(users, UserTable) else UserTable(users or [])
+    if record_size == 8:
+        records = _records(attendance_data, RECORD_8, 8)
+        def user_id_of(uid):
+            tuser = users.by_uid(uid)
+            return tuser.user_id if tuser else str(uid)
+        user_id = _map_unique(records['uid'], user_id_of)
+        uid = records['uid'].astype('int64')
+    elif record_size == 16:
+        records = _records(attendance_data, RECORD_16, 16)
+        def resolve(number):
+            user_id = str(number)
+            tuser = users.by_user_id(user_id)
+            if tuser:
+                return tuser.uid, user_id
+            tuser = users.by_uid(user_id)
+            if tuser:
+                return tuser.uid, tuser.user_id
+            return str(user_id), user_id
+        resolved = _map_unique(records['user_id'], resolve)
+        uid = numpy.empty(len(resolved), dtype=object)
+        user_id = numpy.empty(len(resolved), dtype=object)
+        uid[:] = [item[0] for item in resolved]
+        user_id[:] = [item[1] for item in resolved]
+    else:
+        records = _records(attendance_data, RECORD_40, max(record_size, 40))
+        uid = records['uid'].astype('int64')
+        user_id = _map_user_ids(records['user_id'], lambda raw: raw.split(b'\x00')[0].decode(errors='ignore'))
+    return {
+        'uid': uid,
+        'user_id': user_id,
+        'timestamp': decode_times(records['time']),
+        'status': records['status'].astype('int64'),
+        'punch': records['punch'].astype('int64'),
+    }
+
+
+def decode_attendance_columns(attendance_data, record_size, users):
+    """
+    decode attendance records in columns, with numpy if installed,
+    otherwise with decode_attendance (lists of values).
+
+    :return: dict of column: array or list (see COLUMNS)
+    """
+    if numpy is not None:
+        return decode_attendance_numpy(attendance_data, record_size, users)
+    from .base import decode_attendance
+    columns = dict((name, []) for name in COLUMNS)
+    for attendance in decode_attendance(attendance_data, record_size, users):
+        for name in COLUMNS:
+            columns[name].append(getattr(attendance, name))
+    return columns
@@ -1,24 +1,57 @@
 # -*- coding: utf-8 -*-
-from struct import pack #, unpack
 import codecs
 
+from . import codec
+
 
 class Finger(object):
+    __slots__ = ['uid', 'fid', 'valid', '_template', '_mark']
 
     def __init__(self, uid, fid, valid, template):
-        self.size = len(template) # template only
         self.uid = int(uid)
         self.fid = int(fid)
         self.valid = int(valid)
-        self.template = template
-        #self.mark = str().encode("hex")
-        self.mark = codecs.encode(template[:8], 'hex') + b'...' + codecs.encode(template[-8:], 'hex')
+        self._template = template # bytes or memoryview
+        self._mark = None
+
+    @property
+    def template(self):
+        """
+        template bytes, a memoryview is copied (once) on first access
+        """
+        if not isinstance(self._template, bytes):
+            self._template = self._template.tobytes() # bytes(view) is its repr on python 2
+        return self._template
+
+    @template.setter
+    def template(self, template):
+        self._template = template
+        self._mark = None
+
+    @property
+    def size(self): # template only
+        return len(self._template)
+
+    @property
+    def mark(self):
+        if self._mark is None:
+            head, tail = self._template[:8], self._template[-8:]
+            if not isinstance(head, bytes):
+                head, tail = head.tobytes(), tail.tobytes()
+            self._mark = codecs.encode(head, 'hex') + b'...' + codecs.encode(tail, 'hex')
+        return self._mark
+
+    def __reduce__(self):
+        """
+        pickle (and copy) the template bytes, a memoryview can't be pickled
+        """
+        return (Finger, (self.uid, self.fid, self.valid, self.template))
 
     def repack(self): #full
-        return pack("<HHbb%is" % (self.size), self.size+6, self.uid, self.fid, self.valid, self.template)
+        return codec.TEMPLATE.pack(self.size+6, self.uid, self.fid, self.valid) + self.template
 
     def repack_only(self): #only template
-        return pack("<H%is" % (self.size), self.size, self.template)
+        return codec.TEMPLATE_ONLY.pack(self.size) + self.template
 
     @staticmethod
     def json_unpack(json):
@@ -39,7 +72,13 @@ class Finger(object):
         }
 
     def __eq__(self, other):
-        return self.__dict__ == other.__dict__
+        if not isinstance(other, Finger):
+            return NotImplemented
+        return (self.uid, self.fid, self.valid, self.template) == (other.uid, other.fid, other.valid, other.template)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
 
     def __str__(self):
         return "<Finger> [uid:{:>3}, fid:{}, size:{:>4} v:{} t:{}]".format(self.uid, self.fid, self.size, self.valid, self.mark)
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+import asyncio
+import time
+from collections import namedtuple
+
+from .aio import AsyncZK
+from .base import pack_usertemplates, split_usertemplates, usertemplates_size
+from .exception import ZKNetworkError
+
+
+class DeviceResult(namedtuple('DeviceResult', ['device', 'result', 'error', 'elapsed'])):
+    """
+    outcome of an operation on one device
+
+    device is the entry given to ZKFleet, result what the operation
+    returned (None on error), error the exception raised (None on success)
+    and elapsed the seconds spent on the device (connect to disconnect).
+    """
+    __slots__ = ()
+
+    @property
+    def ok(self):
+        return self.error is None
+
+
+class PackedUsertemplates(object):
+    """
+    high rate packets of a list of users and templates, packed once per
+    user format (28 or 72 bytes) on first use and then shared by every
+    device with that format
+    """
+    def __init__(self, usertemplates, batch_size=0x10000):
+        """
+        Construct a new 'PackedUsertemplates' object.
+
+        :param usertemplates: [user,[fingers]] (checked here)
+        :param batch_size: max bytes per batch (fixed, not read from the devices)
+        """
+        for user, fingers in usertemplates:
+            usertemplates_size(user, fingers)
+        self.usertemplates = usertemplates
+        self.batch_size = batch_size
+        self.__packets = {}
+
+    def batches(self, user_packet_size):
+        """
+        :return: list of (start, users, packet) for user_packet_size, see
+            AsyncZK.HR_save_packets
+        """
+        if user_packet_size not in self.__packets:
+            batches = split_usertemplates(self.usertemplates, user_packet_size, self.batch_size)
+            self.__packets[user_packet_size] = [(start, len(batch), bytes(pack_usertemplates(batch, user_packet_size, size))) for start, batch, size in batches]
+        return self.__packets[user_packet_size]
+
+
+async def _save_packed(conn, packed):
+    return await conn.HR_save_packets(packed.batches(conn.user_packet_size))
+
+
+class ZKFleet(object):
+    """
+    run the same operation on many devices at once
+
+    a device is an ip string or a dict of AsyncZK arguments (with 'ip').
+    each device gets its own connection, at most `concurrency` devices are
+    worked at the same time and each one must finish within `timeout`
+    seconds, results are given back as they complete.
+    """
+    def __init__(self, devices, concurrency=32, timeout=60, **options):
+        """
+        Construct a new 'ZKFleet' object.
+
+        :param devices: list of ip or dict of AsyncZK arguments
+        :param concurrency: devices worked at the same time
+        :param timeout: seconds allowed per device (connect, operation and disconnect)
+        :param options: default AsyncZK arguments (port, password, force_udp...)
+        """
+        self.devices = list(devices)
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.options = options
+
+    def __connection(self, device):
+        options = dict(self.options)
+        options.setdefault('timeout', self.timeout)
+        if isinstance(device, dict):
+            options.update(device)
+        else:
+            options['ip'] = device
+        return AsyncZK(**options)
+
+    async def __job(self, conn, operation, args, kwargs):
+        await conn.connect()
+        if callable(operation):
+            result = await operation(conn, *args, **kwargs)
+        else:
+            result = await getattr(conn, operation)(*args, **kwargs)
+        await conn.disconnect()
+        return result
+
+    async def __run_device(self, semaphore, device, operation, args, kwargs):
+        async with semaphore:
+            start = time.monotonic()
+            result = error = None
+            conn = self.__connection(device)
+            try:
+                result = await asyncio.wait_for(self.__job(conn, operation, args, kwargs), self.timeout)
+            except asyncio.TimeoutError:
+                error = ZKNetworkError("timeout after %ss" % self.timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                error = e
+            finally:
+                conn.close()
+            return DeviceResult(device, result, error, time.monotonic() - start)
+
+    async def run(self, operation, *args, **kwargs):
+        """
+        run operation on every device, as an async iterator of DeviceResult
+        in completion order.
+
+        :param operation: AsyncZK method name (ie: 'get_attendance') or
+            coroutine function called as operation(conn, *args, **kwargs)
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks = [
+            asyncio.ensure_future(self.__run_device(semaphore, device, operation, args, kwargs))
+            for device in self.devices
+        ]
+        try:
+            for task in asyncio.as_completed(tasks):
+                yield await task
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    def run_sync(self, operation, *args, **kwargs):
+        """
+        same as run, for code without an event loop: a generator of
+        DeviceResult in completion order.
+        """
+        loop = asyncio.new_event_loop()
+        results = self.run(operation, *args, **kwargs)
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(results.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(results.aclose())
+            loop.close()
+
+    def distribute(self, usertemplates, batch_size=0x10000):
+        """
+        save the same users and templates on every device: the high rate
+        packets are built once per user format and uploaded to the devices
+        concurrently. an async iterator of DeviceResult, result is the
+        report per batch (see AsyncZK.HR_save_packets) and elapsed the
+        latency of the device. if a batch failed, error is the
+        ZKErrorResponse, with the report in its report attribute.
+
+        :param usertemplates: [user,[fingers]] or PackedUsertemplates
+        :param batch_size: max bytes per batch (fixed, not read from the devices)
+        """
+        if not isinstance(usertemplates, PackedUsertemplates):
+            usertemplates = PackedUsertemplates(usertemplates, batch_size)
+        return self.run(_save_packed, usertemplates)
+
+    def distribute_sync(self, usertemplates, batch_size=0x10000):
+        """
+        same as distribute, for code without an event loop
+        """
+        if not isinstance(usertemplates, PackedUsertemplates):
+            usertemplates = PackedUsertemplates(usertemplates, batch_size)
+        return self.run_sync(_save_packed, usertemplates)
+
+    def __len__(self):
+        return len(self.devices)
+
+    def __repr__(self):
+        return "<ZKFleet: %i devices, concurrency %i, timeout %ss>" % (len(self.devices), self.concurrency, self.timeout)
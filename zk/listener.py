@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+import threading
+from collections import deque
+from socket import timeout
+
+try:
+    import selectors
+except ImportError: # python 2
+    selectors = None
+
+BLOCK = 'block'
+DROP_OLDEST = 'drop_oldest'
+DROP_NEWEST = 'drop_newest'
+POLICIES = [BLOCK, DROP_OLDEST, DROP_NEWEST]
+
+
+class Subscription(object):
+    """
+    bounded queue of the events of a LiveListener, for one consumer
+
+    when the queue is full, the policy decides: block the listener until
+    there is room, drop the oldest event (ring buffer) or drop the new one.
+    dropped events are counted. blocking only stalls the listener thread:
+    events are ACKed as soon as they are read, so the device keeps sending
+    and they pile up in the socket buffer meanwhile; they are read (packet
+    by packet, none lost) once there is room again.
+    """
+    def __init__(self, maxsize=1000, policy=BLOCK):
+        """
+        Construct a new 'Subscription' object.
+
+        :param maxsize: events kept at most
+        :param policy: BLOCK, DROP_OLDEST or DROP_NEWEST
+        """
+        if policy not in POLICIES:
+            raise ValueError("unknown policy %s" % policy)
+        self.maxsize = maxsize
+        self.policy = policy
+        self.dropped = 0
+        self.closed = False
+        self.__events = deque()
+        self.__condition = threading.Condition()
+
+    def put(self, event):
+        """
+        queue an event (listener side)
+
+        :return: bool, False if the event was dropped
+        """
+        with self.__condition:
+            if self.closed:
+                return False
+            if len(self.__events) >= self.maxsize:
+                if self.policy == DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                if self.policy == DROP_OLDEST:
+                    self.__events.popleft()
+                    self.dropped += 1
+                else:
+                    while len(self.__events) >= self.maxsize and not self.closed:
+                        self.__condition.wait()
+                    if self.closed:
+                        return False
+            self.__events.append(event)
+            self.__condition.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """
+        next event, waiting up to timeout seconds
+
+        :return: Attendance object, None on timeout or once closed and empty
+        """
+        with self.__condition:
+            if not self.__events and not self.closed:
+                self.__condition.wait(timeout)
+            if not self.__events:
+                return None
+            event = self.__events.popleft()
+            self.__condition.notify_all()
+            return event
+
+    def close(self):
+        """
+        stop receiving events, the ones already queued can still be read
+        """
+        with self.__condition:
+            self.closed = True
+            self.__condition.notify_all()
+
+    def __iter__(self):
+        """
+        events until the subscription is closed and empty
+        """
+        while True:
+            event = self.get()
+            if event is None:
+                return
+            yield event
+
+    def __len__(self):
+        with self.__condition:
+            return len(self.__events)
+
+
+class LiveListener(object):
+    """
+    run live_capture of a connected ZK in a background thread and hand the
+    events to subscribers (bounded queues) and callbacks
+
+    the thread owns the connection while it runs: no other command can be
+    sent until stop(). callbacks are called from the thread, before the
+    events are queued, so a slow callback slows the listener down too.
+    """
+    def __init__(self, conn, timeout=1):
+        """
+        Construct a new 'LiveListener' object.
+
+        :param conn: connected ZK
+        :param timeout: seconds between checks for stop()
+        """
+        self.conn = conn
+        self.timeout = timeout
+        self.received = 0
+        self.error = None
+        self.__subscriptions = []
+        self.__callbacks = []
+        self.__lock = threading.Lock()
+        self.__thread = None
+
+    def subscribe(self, maxsize=1000, policy=BLOCK):
+        """
+        :return: a new Subscription, for the events received from now on
+        """
+        subscription = Subscription(maxsize, policy)
+        with self.__lock:
+            self.__subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.__lock:
+            if subscription in self.__subscriptions:
+                self.__subscriptions.remove(subscription)
+        subscription.close()
+
+    def add_callback(self, callback):
+        """
+        call callback(attendance) for each event (from the listener thread),
+        its exceptions are ignored
+        """
+        with self.__lock:
+            self.__callbacks.append(callback)
+
+    def remove_callback(self, callback):
+        with self.__lock:
+            if callback in self.__callbacks:
+                self.__callbacks.remove(callback)
+
+    def __dispatch(self, attendance):
+        with self.__lock:
+            callbacks = list(self.__callbacks)
+            subscriptions = list(self.__subscriptions)
+        for callback in callbacks:
+            try:
+                callback(attendance)
+            except Exception as e:
+                if self.conn.verbose: print ("callback error: %s" % e)
+        for subscription in subscriptions:
+            subscription.put(attendance)
+
+    def __run(self):
+        try:
+            for attendance in self.conn.live_capture(self.timeout):
+                if attendance is not None:
+                    self.received += 1
+                    self.__dispatch(attendance)
+        except Exception as e:
+            self.error = e
+            if self.conn.verbose: print ("listener error: %s" % e)
+        finally:
+            with self.__lock:
+                subscriptions = list(self.__subscriptions)
+            for subscription in subscriptions:
+                subscription.close()
+
+    def start(self):
+        """
+        start the listener thread
+
+        :return: LiveListener
+        """
+        if self.is_alive():
+            return self
+        self.error = None
+        self.conn.end_live_capture = False
+        self.__thread = threading.Thread(target=self.__run, name='zk-live-listener')
+        self.__thread.daemon = True
+        self.__thread.start()
+        return self
+
+    def stop(self, wait=True):
+        """
+        end the capture (within timeout seconds), the device is left as it
+        was found. subscriptions are closed, their queued events can still
+        be read.
+        """
+        self.conn.end_live_capture = True
+        with self.__lock:
+            subscriptions = list(self.__subscriptions)
+        for subscription in subscriptions:
+            if subscription.policy == BLOCK:
+                subscription.close() # wake the listener up if it waits for room
+        if wait and self.__thread is not None and self.__thread is not threading.current_thread():
+            self.__thread.join()
+
+    def is_alive(self):
+        return self.__thread is not None and self.__thread.is_alive()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def __repr__(self):
+        return "<LiveListener: %s, %i events, %i subscribers>" % ('running' if self.is_alive() else 'stopped', self.received, len(self.__subscriptions))
+
+
+class LiveMultiplexer(object):
+    """
+    live capture of many connected devices from a single thread
+
+    every device socket is registered in a selector (epoll, kqueue...), so
+    an idle device costs nothing but its socket: one loop waits for all of
+    them, ACKs the event packets and yields the events tagged with their
+    device. a device whose connection fails is dropped, the error is kept
+    in errors.
+    """
+    def __init__(self, timeout=1):
+        """
+        Construct a new 'LiveMultiplexer' object.
+
+        :param timeout: seconds without events before capture yields None
+        """
+        if selectors is None:
+            raise RuntimeError("LiveMultiplexer needs the selectors module (python 3.4+)")
+        self.timeout = timeout
+        self.errors = {}
+        self.end_live_capture = False
+        self.__selector = selectors.DefaultSelector()
+        self.__state = {} # conn: (device, users, was_enabled)
+
+    def add(self, conn, device=None):
+        """
+        register a connected ZK for attendance events
+
+        :param device: tag of its events (default conn)
+        """
+        users, was_enabled = conn._live_capture_start(self.timeout)
+        device = conn if device is None else device
+        self.__state[conn] = (device, users, was_enabled)
+        self.__selector.register(conn, selectors.EVENT_READ, device)
+
+    def remove(self, conn):
+        """
+        unregister conn, its events are stopped and the device restored
+        """
+        device, users, was_enabled = self.__drop(conn)
+        conn._live_capture_stop(was_enabled)
+
+    def __drop(self, conn):
+        self.__selector.unregister(conn)
+        return self.__state.pop(conn)
+
+    def capture(self):
+        """
+        events of every registered device, until end_live_capture is set
+        (or no device is left); all of them are removed when it ends
+
+        :return: generator of (device, Attendance), None after timeout
+            seconds without events
+        """
+        self.end_live_capture = False
+        try:
+            while not self.end_live_capture and self.__state:
+                ready = self.__selector.select(self.timeout)
+                if not ready:
+                    yield None # return to keep watching
+                    continue
+                for key, _mask in ready:
+                    conn = key.fileobj
+                    device, users, was_enabled = self.__state[conn]
+                    try:
+                        events = conn._live_capture_read(users)
+                    except timeout:
+                        continue
+                    except Exception as e:
+                        self.errors[device] = e
+                        self.__drop(conn)
+                        continue
+                    for attendance in events:
+                        yield device, attendance
+        finally:
+            self.close()
+
+    def close(self):
+        """
+        remove every device (errors are kept in errors)
+        """
+        for conn in list(self.__state):
+            device = self.__state[conn][0]
+            try:
+                self.remove(conn)
+            except Exception as e:
+                self.errors[device] = e
+
+    def __len__(self):
+        return len(self.__state)
+
+    def __repr__(self):
+        return "<LiveMultiplexer: %i devices, %i errors>" % (len(self.__state), len(self.errors))
@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+"""
+multi-process decoding of big attendance and template dumps
+
+the downloaded buffer is copied once to shared memory, split in record
+aligned shards and decoded by a process pool; each worker attaches to the
+shared memory (no pickling of the buffer) and sends back plain tuples,
+cheaper to pickle than the objects, which are built by the parent. results
+keep the order of the records in the buffer.
+"""
+from itertools import chain
+import multiprocessing
+
+from . import codec
+from .attendance import Attendance
+from .base import decode_attendance, decode_templates, iter_template_offsets, iter_templates
+from .finger import Finger
+from .user import UserTable
+
+try:
+    from multiprocessing import shared_memory
+except ImportError: # python < 3.8
+    shared_memory = None
+
+MIN_SHARD = 20000 # records, smaller dumps are decoded in process
+SHARDS_PER_PROCESS = 4
+
+_worker = {} # per worker process: shared memory and users
+
+
+def _attach(name, users):
+    _worker['memory'] = shared_memory.SharedMemory(name=name)
+    _worker['users'] = users
+
+
+def _decode_attendance_shard(shard):
+    start, end, record_size = shard
+    view = _worker['memory'].buf[start:end]
+    try:
+        return [(a.user_id, a.timestamp, a.status, a.punch, a.uid) for a in decode_attendance(view, record_size, _worker['users'])]
+    finally:
+        view.release()
+
+
+def _decode_templates_shard(shard):
+    start, end = shard
+    view = _worker['memory'].buf
+    return [(finger.uid, finger.fid, finger.valid, finger.template) for finger in iter_templates(view, start, end)]
+
+
+def _shards(size, step, count):
+    """
+    split size bytes of step bytes records in about count shards
+
+    :return: list of (start, end)
+    """
+    records = size // step
+    per_shard = max(-(-records // count), 1)
+    bounds = list(range(0, records, per_shard)) or [0]
+    return [(start * step, (bounds[i + 1] * step) if i + 1 < len(bounds) else size) for i, start in enumerate(bounds)]
+
+
+def _run(data, function, shards, processes, users=None):
+    """
+    decode shards of data with function in a pool of processes
+
+    :return: iterator of the decoded rows, in shards order
+    """
+    memory = shared_memory.SharedMemory(create=True, size=max(len(data), 1))
+    try:
+        memory.buf[:len(data)] = data
+        pool = multiprocessing.Pool(processes, initializer=_attach, initargs=(memory.name, users))
+        try:
+            results = pool.map(function, shards, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        return chain.from_iterable(results)
+    finally:
+        memory.close()
+        memory.unlink()
+
+
+def decode_attendance_parallel(attendance_data, record_size, users, processes=None):
+    """
+    decode_attendance in a pool of processes, timestamps are decoded by
+    the workers. dumps smaller than MIN_SHARD records per process (or
+    without shared memory, python < 3.8) are decoded in process.
+
+    :param attendance_data: buffer with the records
+    :param record_size: 8, 16 or 40 bytes (or bigger)
+    :param users: UserTable (or list of User object), to match uid and user_id
+    :param processes: number of processes (default cpu count)
+    :return: list of Attendance object, in records order
+    """
+    processes = processes or multiprocessing.cpu_count()
+    step = max(record_size, 40) if record_size not in (8, 16) else record_size
+    if shared_memory is None or processes < 2 or len(attendance_data) // step < 2 * MIN_SHARD:
+        return list(decode_attendance(attendance_data, record_size, users))
+    users = users if isinstance(users, UserTable) else UserTable(users or [])
+    processes = min(processes, len(attendance_data) // step // MIN_SHARD)
+    shards = [(start, end, record_size) for start, end in _shards(len(attendance_data), step, processes * SHARDS_PER_PROCESS)]
+    return [Attendance(*row) for row in _run(attendance_data, _decode_attendance_shard, shards, processes, users)]
+
+
+def decode_templates_parallel(templatedata, processes=None):
+    """
+    decode_templates in a pool of processes. the parent only walks the
+    template sizes to split the buffer; templates are bytes, not views.
+
+    :param templatedata: buffer read with CMD_DB_RRQ (FCT_FINGERTMP)
+    :param processes: number of processes (default cpu count)
+    :return: list of Finger object, in buffer order
+    """
+    processes = processes or multiprocessing.cpu_count()
+    view = memoryview(templatedata)
+    total_size = codec.INT.unpack_from(view)[0]
+    end = min(4 + total_size, len(view))
+    offsets = [offset for offset, size in iter_template_offsets(view, 4, end)]
+    if shared_memory is None or processes < 2 or len(offsets) < 2 * MIN_SHARD:
+        return decode_templates(templatedata)
+    processes = min(processes, len(offsets) // MIN_SHARD)
+    last = offsets[-1] + codec.TEMPLATE_ONLY.unpack_from(view, offsets[-1])[0]
+    per_shard = -(-len(offsets) // (processes * SHARDS_PER_PROCESS))
+    bounds = offsets[::per_shard] + [last]
+    shards = list(zip(bounds[:-1], bounds[1:]))
+    return [Finger(*row) for row in _run(view, _decode_templates_shard, shards, processes)]
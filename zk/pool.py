@@ -0,0 +1,190 @@
+# -*- coding: utf-8 -*-
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+from .base import ZK
+from .exception import ZKNetworkError
+
+
+class PooledSession(object):
+    """
+    connected ZK handed out by ZKPool
+
+    behaves like the ZK object (attributes are read from and set on it),
+    but a command failing with ZKNetworkError reconnects the session; the
+    read only or idempotent ones (RETRY) are then sent once again, the
+    others raise (the device may have run them: unlock, restart, set_user...).
+    """
+    RETRY = frozenset([
+        'free_data', 'get_attendance', 'get_attendance_columns', 'get_compat_old_firmware',
+        'get_device_info', 'get_device_name', 'get_extend_fmt', 'get_face_fun_on',
+        'get_face_version', 'get_firmware_version', 'get_fp_version', 'get_lock_state',
+        'get_mac', 'get_network_params', 'get_new_attendance', 'get_options', 'get_pin_width',
+        'get_platform', 'get_serialnumber', 'get_templates', 'get_time', 'get_user_extend_fmt',
+        'get_user_template', 'get_users', 'read_sizes', 'read_with_buffer', 'refresh_data',
+        'set_time',
+    ])
+
+    def __init__(self, conn):
+        object.__setattr__(self, 'conn', conn)
+
+    def reconnect(self):
+        self.conn.close()
+        self.conn.connect()
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if not callable(attr):
+            return attr
+        def call(*args, **kwargs):
+            try:
+                return attr(*args, **kwargs)
+            except ZKNetworkError as e:
+                if self.conn.verbose: print ("session lost ({}), reconnecting".format(e))
+                self.reconnect()
+                if name not in self.RETRY:
+                    raise
+                return getattr(self.conn, name)(*args, **kwargs)
+        return call
+
+    def __setattr__(self, name, value):
+        if name == 'conn' or name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self.conn, name, value) # ie: end_live_capture, read_window
+
+    def __str__(self):
+        return str(self.conn)
+
+
+class ZKPool(object):
+    """
+    keep authenticated sessions open, per device
+
+    sessions are borrowed with the session() context manager and given
+    back to the pool when done, idle sessions get a cheap command every
+    `keepalive` seconds so the device doesn't drop them.
+    """
+    def __init__(self, keepalive=30, max_idle=4, **options):
+        """
+        Construct a new 'ZKPool' object.
+
+        :param keepalive: seconds between keepalive commands (0 disables it)
+        :param max_idle: idle sessions kept per device
+        :param options: ZK arguments (timeout, password, force_udp...)
+        """
+        self.keepalive = keepalive
+        self.max_idle = max_idle
+        self.options = options
+        self.__idle = {} # (ip, port): deque([(conn, last_used)])
+        self.__keys = {} # conn: (ip, port)
+        self.__lock = threading.Lock()
+        self.__stop = threading.Event()
+        self.__thread = None
+
+    def acquire(self, ip, port=4370):
+        """
+        :return: connected ZK, idle one if any
+        """
+        key = (ip, port)
+        with self.__lock:
+            idle = self.__idle.get(key)
+            conn = idle.pop()[0] if idle else None
+            if self.keepalive and not self.__thread:
+                self.__thread = threading.Thread(target=self.__keepalive_loop, name='ZKPool-keepalive')
+                self.__thread.daemon = True
+                self.__thread.start()
+        if conn is None:
+            conn = ZK(ip, port, **self.options)
+            conn.connect()
+            with self.__lock:
+                self.__keys[conn] = key
+        return conn
+
+    def release(self, conn):
+        """
+        give a session back to the pool (dropped if disconnected or
+        already max_idle sessions for the device)
+        """
+        with self.__lock:
+            key = self.__keys.get(conn)
+            idle = self.__idle.setdefault(key, deque()) if key else None
+            if conn.is_connect and idle is not None and len(idle) < self.max_idle:
+                idle.append((conn, time.time()))
+                return
+            self.__keys.pop(conn, None)
+        self.__disconnect(conn)
+
+    @contextmanager
+    def session(self, ip, port=4370):
+        """
+        borrow a session, ie:
+
+            with pool.session('192.168.1.201') as conn:
+                conn.unlock()
+        """
+        session = PooledSession(self.acquire(ip, port))
+        try:
+            yield session
+        finally:
+            self.release(session.conn)
+
+    def __disconnect(self, conn):
+        if not conn.is_connect:
+            conn.close()
+            return
+        try:
+            conn.disconnect()
+        except Exception:
+            conn.close()
+
+    def __keepalive_loop(self):
+        while not self.__stop.wait(self.keepalive):
+            self.ping_idle(self.keepalive)
+
+    def ping_idle(self, idle_time=0):
+        """
+        send a keepalive to sessions idle for at least idle_time seconds,
+        broken ones are dropped.
+        """
+        now = time.time()
+        stale = []
+        with self.__lock:
+            for idle in self.__idle.values():
+                for item in [item for item in idle if now - item[1] >= idle_time]:
+                    idle.remove(item)
+                    stale.append(item[0])
+        for conn in stale:
+            try:
+                conn.get_time()
+            except Exception as e:
+                if conn.verbose: print ("keepalive failed: {}".format(e))
+                conn.close()
+            self.release(conn)
+
+    def close(self):
+        """
+        stop keepalives and disconnect every idle session
+        """
+        self.__stop.set()
+        if self.__thread:
+            self.__thread.join()
+            self.__thread = None
+        with self.__lock:
+            conns = [item[0] for idle in self.__idle.values() for item in idle]
+            self.__idle.clear()
+            self.__keys.clear()
+        for conn in conns:
+            self.__disconnect(conn)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        with self.__lock:
+            return sum(len(idle) for idle in self.__idle.values())
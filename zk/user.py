@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
-from struct import pack #, unpack
+from . import codec
+
+
 class User(object):
+    __slots__ = ['uid', 'name', 'privilege', 'password', 'group_id', 'user_id', 'card']
     encoding = 'UTF-8'
 
     def __init__(self, uid, name, privilege, password='', group_id='', user_id='', card=0):
@@ -25,13 +28,16 @@ class User(object):
             card=json['card']
         )
 
+    def json_pack(self): #packs for json
+        return dict((name, getattr(self, name)) for name in User.__slots__)
+
     def repack29(self): # with 02 for zk6 (size 29)
-        return pack("<BHB5s8sIxBhI", 2, self.uid, self.privilege, self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, int(self.group_id) if self.group_id else 0, 0, int(self.user_id))
+        return codec.USER_29.pack(2, self.uid, self.privilege, self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, int(self.group_id) if self.group_id else 0, 0, int(self.user_id))
 
     def repack73(self): #with 02 for zk8 (size73)
         #password 6s + 0x00 + 0x77
         # 0,0 => 7sx group id, timezone?
-        return pack("<BHB8s24sIB7sx24s", 2, self.uid, self.privilege,self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, 1, str(self.group_id).encode(User.encoding, errors='ignore'), str(self.user_id).encode(User.encoding, errors='ignore'))
+        return codec.USER_73.pack(2, self.uid, self.privilege,self.password.encode(User.encoding, errors='ignore'), self.name.encode(User.encoding, errors='ignore'), self.card, 1, str(self.group_id).encode(User.encoding, errors='ignore'), str(self.user_id).encode(User.encoding, errors='ignore'))
 
     def is_disabled(self):
         return bool(self.privilege & 1)
@@ -47,3 +53,65 @@ class User(object):
 
     def __repr__(self):
         return u'<User>: [uid:{}, name:{} user_id:{}]'.format(self.uid, self.name, self.user_id)
+
+
+def _reindex(method):
+    """ list method that drops the UserTable indexes """
+    def mutator(self, *args, **kwargs):
+        self._uids = self._user_ids = None
+        return method(self, *args, **kwargs)
+    mutator.__name__ = method.__name__ # no wraps: method descriptors have no __module__ on python 2
+    mutator.__doc__ = method.__doc__
+    return mutator
+
+
+class UserTable(list):
+    """
+    list of User, indexed by uid and user_id
+
+    the indexes are built on the first lookup and dropped when the list
+    changes (not when a User in it is modified). like filter()[0], a
+    lookup gives the first matching user.
+    """
+    def __init__(self, users=()):
+        list.__init__(self, users)
+        self._uids = self._user_ids = None
+
+    def __index(self):
+        self._uids = {}
+        self._user_ids = {}
+        for user in self:
+            self._uids.setdefault(user.uid, user)
+            self._user_ids.setdefault(user.user_id, user)
+
+    def by_uid(self, uid, default=None):
+        """
+        :return: User with this uid, or default
+        """
+        if self._uids is None:
+            self.__index()
+        return self._uids.get(uid, default)
+
+    def by_user_id(self, user_id, default=None):
+        """
+        :return: User with this user_id (str), or default
+        """
+        if self._user_ids is None:
+            self.__index()
+        return self._user_ids.get(user_id, default)
+
+    append = _reindex(list.append)
+    extend = _reindex(list.extend)
+    insert = _reindex(list.insert)
+    remove = _reindex(list.remove)
+    pop = _reindex(list.pop)
+    sort = _reindex(list.sort)
+    reverse = _reindex(list.reverse)
+    __setitem__ = _reindex(list.__setitem__)
+    __delitem__ = _reindex(list.__delitem__)
+    __iadd__ = _reindex(list.__iadd__)
+    if hasattr(list, 'clear'):
+        clear = _reindex(list.clear)
+    if hasattr(list, '__setslice__'): # python 2
+        __setslice__ = _reindex(list.__setslice__)
+        __delslice__ = _reindex(list.__delslice__)